@@ -0,0 +1,52 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+
+def synthetic_grid(
+    num_edges: int,
+    block_length: float = 100.0,
+    removed_fraction: float = 0.1,
+    seed: int = 0,
+) -> tuple[gpd.GeoDataFrame, pd.DataFrame]:
+    """
+    A road-like network for benchmarking, which is a square grid of streets with jittered
+        intersections, curvy streets (edge lengths up to 30% longer than the straight line)
+        and a fraction of the blocks merged by removing streets.  Every street is two-way,
+        so each one is an edge in both directions.
+    :param num_edges: The rough number of (directed) edges, from which the size of the
+        grid is picked
+    :param block_length: The distance between intersections, in meters
+    :param removed_fraction: The fraction of streets to remove
+    :param seed: The random seed, the same arguments always return the same network
+    :return: nodes (with point geometries in EPSG:3857) and edges (with u, v and length
+        columns), which can be passed straight to PandanaNetwork
+    """
+    rng = np.random.default_rng(seed)
+    n = max(int(np.sqrt(num_edges / (4 * (1 - removed_fraction)))), 2)
+
+    ids = np.arange(n * n).reshape(n, n)
+    x = np.tile(np.arange(n) * block_length, n)
+    y = np.repeat(np.arange(n) * block_length, n)
+    x = x + rng.uniform(-0.2, 0.2, n * n) * block_length
+    y = y + rng.uniform(-0.2, 0.2, n * n) * block_length
+
+    u = np.concatenate([ids[:, :-1].ravel(), ids[:-1, :].ravel()])
+    v = np.concatenate([ids[:, 1:].ravel(), ids[1:, :].ravel()])
+    keep = rng.random(len(u)) >= removed_fraction
+    u, v = u[keep], v[keep]
+    length = np.hypot(x[u] - x[v], y[u] - y[v]) * rng.uniform(1.0, 1.3, len(u))
+
+    nodes = gpd.GeoDataFrame(
+        index=pd.Index(ids.ravel(), name="osmid"),
+        geometry=gpd.points_from_xy(x, y),
+        crs="EPSG:3857",
+    )
+    edges = pd.DataFrame(
+        {
+            "u": np.concatenate([u, v]),
+            "v": np.concatenate([v, u]),
+            "length": np.concatenate([length, length]),
+        }
+    )
+    return nodes, edges
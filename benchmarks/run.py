@@ -0,0 +1,209 @@
+"""
+Benchmarks of pandana2 on synthetic networks (see networks.py), which report the time,
+    peak memory and throughput of each step for each network size.  Run with e.g.
+
+    python -m benchmarks.run --edges 10000 100000 1000000 --csv results.csv
+
+and pass --compare results.csv on a later run to see the change in time for each case.
+"""
+
+import argparse
+import os
+import resource
+import tempfile
+import time
+from typing import Callable, get_args
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from benchmarks.networks import synthetic_grid
+from pandana2 import ExponentialDecay, LinearDecay, NoDecay, PandanaNetwork
+from pandana2.dijkstra import dijkstra_all_pairs
+from pandana2.utils import Aggregation
+
+DECAYS = {
+    "none": NoDecay,
+    "linear": LinearDecay,
+    "exponential": ExponentialDecay,
+}
+
+
+def _rss_kb(field: str) -> int | None:
+    """
+    A memory field (VmRSS or VmHWM) of this process from /proc, or None off Linux
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def measure(func: Callable) -> tuple[float, float, object]:
+    """
+    Run func and measure its wall time and peak memory.  On Linux the peak resident memory
+        is reset before func runs, so the peak is for func alone (relative to the memory in
+        use when it started).  Elsewhere the peak for the whole process is reported.
+    :return: seconds, peak memory in MB and the result of func
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        before = _rss_kb("VmRSS")
+    except OSError:
+        before = None
+
+    t0 = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - t0
+
+    if before is not None and _rss_kb("VmHWM") is not None:
+        peak_mb = (_rss_kb("VmHWM") - before) / 1024
+    else:
+        # ru_maxrss is in kB on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_mb = maxrss / (1024 * 1024 if os.uname().sysname == "Darwin" else 1024)
+    return seconds, peak_mb, result
+
+
+def run_benchmarks(
+    num_edges: int, weight_cutoff: float = 500.0, n_threads: int = 1
+) -> pd.DataFrame:
+    """
+    Run every benchmark on a synthetic network of about num_edges edges
+    :return: A DataFrame with a row per benchmark
+    """
+    nodes, edges = synthetic_grid(num_edges)
+    rows = []
+
+    def record(name: str, func: Callable, items: int = None, unit: str = None):
+        seconds, peak_mb, result = measure(func)
+        items = items(result) if callable(items) else items
+        rows.append(
+            {
+                "edges": len(edges),
+                "benchmark": name,
+                "seconds": seconds,
+                "peak_mb": peak_mb,
+                "throughput": items / seconds if items and seconds > 0 else np.nan,
+                "unit": unit,
+            }
+        )
+        return result
+
+    record(
+        "dijkstra_all_pairs",
+        lambda: dijkstra_all_pairs(
+            edges.rename(columns={"u": "from", "v": "to", "length": "edge_cost"}),
+            weight_cutoff,
+            n_threads=n_threads,
+        ),
+        len,
+        "pairs/s",
+    )
+
+    network = PandanaNetwork(edges, nodes)
+    record(
+        "preprocess",
+        lambda: network.preprocess(weight_cutoff, n_threads=n_threads),
+        lambda _: len(network.reachability.destinations),
+        "pairs/s",
+    )
+    num_pairs = len(network.reachability.destinations)
+
+    # about one value per node, at random nodes
+    rng = np.random.default_rng(0)
+    values = pd.Series(
+        rng.random(len(nodes)), index=rng.choice(nodes.index, len(nodes))
+    )
+    for decay_name, decay in DECAYS.items():
+        for aggregation in get_args(Aggregation):
+            record(
+                f"aggregate_{aggregation}_{decay_name}",
+                lambda: network.aggregate(values, decay(weight_cutoff), aggregation),
+                num_pairs,
+                "pairs/s",
+            )
+
+    bounds = nodes.total_bounds
+    x = rng.uniform(bounds[0], bounds[2], len(nodes))
+    y = rng.uniform(bounds[1], bounds[3], len(nodes))
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs="EPSG:3857")
+    record("nearest_nodes", lambda: network.nearest_nodes(points), len(x), "points/s")
+    record(
+        "nearest_nodes_xy",
+        lambda: network.nearest_nodes_xy(x, y, crs="EPSG:3857"),
+        len(x),
+        "points/s",
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "preprocessed")
+        record(
+            "save_preprocessed",
+            lambda: network.save_preprocessed(path),
+            num_pairs,
+            "pairs/s",
+        )
+        loaded = PandanaNetwork(edges, nodes)
+        record(
+            "load_preprocessed",
+            lambda: loaded.load_preprocessed(path),
+            num_pairs,
+            "pairs/s",
+        )
+
+    return pd.DataFrame(rows)
+
+
+def _format(results: pd.DataFrame) -> pd.DataFrame:
+    formatted = results.copy()
+    formatted["seconds"] = formatted.seconds.map("{:.3f}".format)
+    formatted["peak_mb"] = formatted.peak_mb.map("{:.0f}".format)
+    formatted["throughput"] = [
+        "" if np.isnan(rate) else f"{rate:,.0f} {unit}"
+        for rate, unit in zip(results.throughput, results.unit)
+    ]
+    return formatted.drop(columns="unit")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--edges",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+        help="Network sizes, in edges (up to 10M or so, depending on memory)",
+    )
+    parser.add_argument("--cutoff", type=float, default=500.0, help="In meters")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--csv", help="Write the results to this file")
+    parser.add_argument("--compare", help="A csv from an earlier run to compare to")
+    args = parser.parse_args()
+
+    # compile (or load the cached) numba functions first so they aren't timed
+    run_benchmarks(1000, args.cutoff, args.threads)
+
+    results = pd.concat(
+        [run_benchmarks(edges, args.cutoff, args.threads) for edges in args.edges],
+        ignore_index=True,
+    )
+    formatted = _format(results)
+    if args.compare:
+        baseline = pd.read_csv(args.compare).set_index(["edges", "benchmark"])
+        ratio = results.seconds.values / baseline.seconds.reindex(
+            pd.MultiIndex.from_frame(results[["edges", "benchmark"]])
+        )
+        formatted["vs_baseline"] = ["" if np.isnan(r) else f"{r:.2f}x" for r in ratio]
+    print(formatted.to_string(index=False))
+    if args.csv:
+        results.to_csv(args.csv, index=False)
+
+
+if __name__ == "__main__":
+    main()
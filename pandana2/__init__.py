@@ -1,4 +1,15 @@
-from pandana2.decay_functions import ExponentialDecay, LinearDecay, NoDecay
+from pandana2.decay_functions import (
+    CompiledDecay,
+    ExponentialDecay,
+    LinearDecay,
+    NoDecay,
+)
 from pandana2.network import PandanaNetwork
 
-__all__ = ["ExponentialDecay", "LinearDecay", "NoDecay", "PandanaNetwork"]
+__all__ = [
+    "CompiledDecay",
+    "ExponentialDecay",
+    "LinearDecay",
+    "NoDecay",
+    "PandanaNetwork",
+]
@@ -0,0 +1,645 @@
+import numba
+import numpy as np
+import pandas as pd
+
+from pandana2.decay_functions import (
+    DECAYED,
+    CompiledDecay,
+    PandanaDecayFunction,
+    decay_weight,
+)
+from pandana2.reachability import ChunkedReachability, Reachability
+from pandana2.stats import Stats
+from pandana2.utils import Aggregation
+
+# the aggregations computed by _aggregate_segments, and the code passed to it for each
+AGGREGATION_CODES = {
+    "sum": 0,
+    "mean": 1,
+    "min": 2,
+    "max": 3,
+    "std": 4,
+    "count": 5,
+    "median": 6,
+}
+SUM, MEAN, MIN, MAX, STD, COUNT, MEDIAN = range(7)
+
+# CompiledDecay weights are decayed into an array before they're aggregated, so chunks are
+#   split into parts of about this many pairs within max_weight, see _split_chunks
+DECAY_BATCH_PAIRS = 1 << 20
+
+
+def values_to_csr(
+    node_ids: pd.Index, values: pd.DataFrame
+) -> tuple[np.array, np.array]:
+    """
+    Group the rows of values by the dense index of the node they are located at, so the
+        values at node i are value_data[value_offsets[i]:value_offsets[i + 1]], with one
+        column per column of values.  Values at nodes which are not in node_ids can't be
+        reached from anywhere and are dropped.
+    :return: value_offsets, value_data
+    """
+    value_indexes = node_ids.get_indexer(values.index)
+    found = value_indexes >= 0
+    value_indexes = value_indexes[found]
+    order = np.argsort(value_indexes, kind="stable")
+
+    value_offsets = np.zeros(len(node_ids) + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(value_indexes, minlength=len(node_ids)), out=value_offsets[1:]
+    )
+    value_data = np.ascontiguousarray(values.to_numpy(dtype=np.float64)[found][order])
+    return value_offsets, value_data
+
+
+@numba.jit(nogil=True, cache=True)
+def _weighted_median(values: np.array, weights: np.array) -> float:
+    """
+    Same as pandana2.utils.weighted_median
+    """
+    order = np.argsort(values)
+    target = weights.sum() / 2
+    cumulative_weight = 0.0
+    for i in order:
+        cumulative_weight += weights[i]
+        if cumulative_weight >= target:
+            return values[i]
+    return values[order[-1]]
+
+
+@numba.jit(nogil=True, cache=True)
+def _aggregate_segments(
+    offsets: np.array,  # reachability offsets, one segment per origin
+    destinations: np.array,  # reachability destinations (dense ints)
+    prefix_offsets: np.array,  # offsets of the pairs of each origin within max_weight
+    weights: np.array,  # reachability weights aligned with destinations, or DECAYED ones
+    #   aligned with prefix_offsets
+    decay_code: int,  # see PandanaDecayFunction.compiled_code, or DECAYED
+    max_weight: float,
+    decay_params: np.array,  # see PandanaDecayFunction.params
+    value_offsets: np.array,  # see values_to_csr
+    value_data: np.array,  # see values_to_csr, one column per value column
+    codes: np.array,  # the aggregations to compute, see AGGREGATION_CODES
+):
+    """
+    Compute every aggregation in codes of every value column for every origin, in a single
+        pass over the prefix of its segment of the reachability arrays that is within the
+        max_weight of the decay function (see Reachability.prefix_indexes).  Each weight is
+        decayed as it's read (see decay_weight).  Returns the number of values seen by each
+        origin (origins x columns) and an (origins x columns x codes) array of results.
+        NaN values are skipped.
+    """
+    num_origins = len(offsets) - 1
+    num_columns = value_data.shape[1]
+    counts = np.zeros((num_origins, num_columns), dtype=np.int64)
+    out = np.full((num_origins, num_columns, len(codes)), np.nan)
+    need_std = (codes == STD).any()
+    need_median = (codes == MEDIAN).any()
+
+    # running totals for the current origin, one per column
+    count = np.zeros(num_columns, dtype=np.int64)
+    sum_weights = np.zeros(num_columns)
+    sum_weighted_values = np.zeros(num_columns)
+    min_value = np.zeros(num_columns)
+    max_value = np.zeros(num_columns)
+    sum_squares = np.zeros(num_columns)
+
+    # the median needs all the values for an origin at once, which are gathered here
+    median_values = np.empty((1024, num_columns))
+    median_weights = np.empty((1024, num_columns))
+
+    for i in range(num_origins):
+        count[:] = 0
+        sum_weights[:] = 0.0
+        sum_weighted_values[:] = 0.0
+        min_value[:] = np.inf
+        max_value[:] = -np.inf
+        sum_squares[:] = 0.0
+
+        # the pair at prefix_offsets[i] + p is destinations[offsets[i] + p]
+        shift = offsets[i] - prefix_offsets[i]
+        for j in range(prefix_offsets[i], prefix_offsets[i + 1]):
+            weight = decay_weight(
+                decay_code,
+                max_weight,
+                decay_params,
+                weights[j if decay_code == DECAYED else shift + j],
+            )
+            destination = destinations[shift + j]
+            for k in range(value_offsets[destination], value_offsets[destination + 1]):
+                for col in range(num_columns):
+                    value = value_data[k, col]
+                    if np.isnan(value):
+                        continue
+                    count[col] += 1
+                    sum_weighted_values[col] += weight * value
+                    min_value[col] = min(min_value[col], value)
+                    max_value[col] = max(max_value[col], value)
+                    sum_weights[col] += weight
+
+                    if need_median:
+                        if count[col] > len(median_values):
+                            median_values = _grow(median_values)
+                            median_weights = _grow(median_weights)
+                        median_values[count[col] - 1, col] = value
+                        median_weights[count[col] - 1, col] = weight
+
+        counts[i] = count
+        if count.max() == 0:
+            continue
+
+        if need_std:
+            # a second pass over the segment (which is now in cache) is more accurate than
+            #   a running variance
+            mean = sum_weighted_values / sum_weights
+            for j in range(prefix_offsets[i], prefix_offsets[i + 1]):
+                weight = decay_weight(
+                    decay_code,
+                    max_weight,
+                    decay_params,
+                    weights[j if decay_code == DECAYED else shift + j],
+                )
+                destination = destinations[shift + j]
+                for k in range(
+                    value_offsets[destination], value_offsets[destination + 1]
+                ):
+                    for col in range(num_columns):
+                        value = value_data[k, col]
+                        if not np.isnan(value):
+                            sum_squares[col] += weight * (value - mean[col]) ** 2
+
+        for col in range(num_columns):
+            if count[col] == 0:
+                continue
+            for c in range(len(codes)):
+                if codes[c] == MEDIAN:
+                    out[i, col, c] = _weighted_median(
+                        median_values[: count[col], col],
+                        median_weights[: count[col], col],
+                    )
+                else:
+                    out[i, col, c] = _result(
+                        codes[c],
+                        count[col],
+                        sum_weights[col],
+                        sum_weighted_values[col],
+                        min_value[col],
+                        max_value[col],
+                        sum_squares[col],
+                    )
+
+    return counts, out
+
+
+@numba.jit(nogil=True, cache=True)
+def _result(
+    code: int,
+    count: int,
+    sum_weights: float,
+    sum_weighted_values: float,
+    min_value: float,
+    max_value: float,
+    sum_squares: float,
+) -> float:
+    """
+    The result of any aggregation but the median from the running totals of one origin
+    """
+    if code == SUM:
+        return sum_weighted_values
+    elif code == MEAN:
+        if sum_weights > 0:
+            return sum_weighted_values / sum_weights
+    elif code == MIN:
+        # min and max never apply weights
+        return min_value
+    elif code == MAX:
+        return max_value
+    elif code == STD:
+        if sum_weights > 0:
+            return np.sqrt(sum_squares / sum_weights)
+    elif code == COUNT:
+        return count
+    return np.nan
+
+
+@numba.jit(nogil=True, cache=True)
+def _aggregate_symmetric(
+    origins: np.array,  # reachability origins (dense ints)
+    offsets: np.array,  # reachability offsets, one segment per origin
+    destinations: np.array,  # reachability destinations (dense ints), all >= the origin
+    prefix_offsets: np.array,  # offsets of the pairs of each origin within max_weight
+    weights: np.array,  # reachability weights aligned with destinations, or DECAYED ones
+    #   aligned with prefix_offsets
+    decay_code: int,  # see PandanaDecayFunction.compiled_code, or DECAYED
+    max_weight: float,
+    decay_params: np.array,  # see PandanaDecayFunction.params
+    value_offsets: np.array,  # see values_to_csr
+    value_data: np.array,  # see values_to_csr, one column per value column
+    codes: np.array,  # the aggregations to compute, any but MEDIAN
+):
+    """
+    Same as _aggregate_segments for a symmetric Reachability, where each pair is stored
+        once.  Every pair adds the values at the destination to the totals of the origin
+        and the values at the origin to the totals of the destination, so the results are
+        for every node rather than every origin.
+    """
+    num_nodes = len(value_offsets) - 1
+    num_columns = value_data.shape[1]
+    count = np.zeros((num_nodes, num_columns), dtype=np.int64)
+    sum_weights = np.zeros((num_nodes, num_columns))
+    sum_weighted_values = np.zeros((num_nodes, num_columns))
+    min_value = np.full((num_nodes, num_columns), np.inf)
+    max_value = np.full((num_nodes, num_columns), -np.inf)
+    sum_squares = np.zeros((num_nodes, num_columns))
+
+    for i in range(len(origins)):
+        origin = origins[i]
+        shift = offsets[i] - prefix_offsets[i]
+        for j in range(prefix_offsets[i], prefix_offsets[i + 1]):
+            weight = decay_weight(
+                decay_code,
+                max_weight,
+                decay_params,
+                weights[j if decay_code == DECAYED else shift + j],
+            )
+            destination = destinations[shift + j]
+            # values at the destination go to the origin, and then (unless the pair is
+            #   the origin itself) values at the origin go to the destination
+            for direction in range(1 if destination == origin else 2):
+                node = origin if direction == 0 else destination
+                other = destination if direction == 0 else origin
+                for k in range(value_offsets[other], value_offsets[other + 1]):
+                    for col in range(num_columns):
+                        value = value_data[k, col]
+                        if np.isnan(value):
+                            continue
+                        count[node, col] += 1
+                        sum_weighted_values[node, col] += weight * value
+                        min_value[node, col] = min(min_value[node, col], value)
+                        max_value[node, col] = max(max_value[node, col], value)
+                        sum_weights[node, col] += weight
+
+    if (codes == STD).any():
+        mean = sum_weighted_values / sum_weights
+        for i in range(len(origins)):
+            origin = origins[i]
+            shift = offsets[i] - prefix_offsets[i]
+            for j in range(prefix_offsets[i], prefix_offsets[i + 1]):
+                weight = decay_weight(
+                    decay_code,
+                    max_weight,
+                    decay_params,
+                    weights[j if decay_code == DECAYED else shift + j],
+                )
+                destination = destinations[shift + j]
+                for direction in range(1 if destination == origin else 2):
+                    node = origin if direction == 0 else destination
+                    other = destination if direction == 0 else origin
+                    for k in range(value_offsets[other], value_offsets[other + 1]):
+                        for col in range(num_columns):
+                            value = value_data[k, col]
+                            if not np.isnan(value):
+                                sum_squares[node, col] += (
+                                    weight * (value - mean[node, col]) ** 2
+                                )
+
+    out = np.full((num_nodes, num_columns, len(codes)), np.nan)
+    for node in range(num_nodes):
+        for col in range(num_columns):
+            if count[node, col] == 0:
+                continue
+            for c in range(len(codes)):
+                out[node, col, c] = _result(
+                    codes[c],
+                    count[node, col],
+                    sum_weights[node, col],
+                    sum_weighted_values[node, col],
+                    min_value[node, col],
+                    max_value[node, col],
+                    sum_squares[node, col],
+                )
+    return count, out
+
+
+@numba.jit(nogil=True, cache=True)
+def _grow(array: np.array) -> np.array:
+    """
+    Double the number of rows of a 2-D array, keeping its contents
+    """
+    grown = np.empty((len(array) * 2, array.shape[1]), dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+def _select_pairs(
+    chunk: Reachability, decay_func: PandanaDecayFunction, impedance: str = None
+) -> tuple[np.array, np.array]:
+    """
+    The pairs of chunk that decay_func applies to, see Reachability.prefix_indexes.
+        Decay functions with a mask of their own can select any pairs, so it's applied
+        to every pair instead of finding the prefix within max_weight.
+    """
+    if not decay_func.masks_prefix():
+        weights = pd.Series(chunk.impedance_weights(impedance))
+        return chunk.mask_indexes(np.asarray(decay_func.mask(weights), dtype=bool))
+    return chunk.prefix_indexes(decay_func.max_weight, impedance)
+
+
+def _split_chunks(chunks, max_weight: float, max_pairs: int):
+    """
+    Split each chunk (other than symmetric ones) into parts with about max_pairs pairs with
+        weights less than max_weight, to bound the memory of the decayed weights
+    """
+    for chunk in chunks:
+        prefix_offsets = chunk.prefix_offsets(max_weight)
+        if chunk.symmetric or prefix_offsets[-1] <= max_pairs:
+            yield chunk
+            continue
+        targets = np.arange(max_pairs, prefix_offsets[-1], max_pairs)
+        bounds = np.unique(
+            np.concatenate(
+                [[0], np.searchsorted(prefix_offsets, targets), [len(chunk.origins)]]
+            )
+        )
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield chunk.select_range(start, end)
+
+
+def aggregate_reachability(
+    reachability: Reachability | ChunkedReachability,
+    values: pd.DataFrame,
+    decay_func: PandanaDecayFunction,
+    aggregations: dict[str, Aggregation],
+    stats: Stats = None,
+    impedance: str = None,
+) -> pd.DataFrame:
+    """
+    Compute aggregations (a dict of output names to aggregations) of every column of values
+        for every origin in reachability, in one pass (per chunk).  Returns a DataFrame indexed by the
+        node ids of the origins that have at least one value within decay_func.max_weight,
+        with a column for every (values column, aggregation name) pair.
+    :param stats: If passed, the time of each stage, the number of values, origins and
+        pairs within max_weight, and the bytes of the arrays created are added to it
+    :param impedance: Apply decay_func to this impedance of reachability instead of the
+        weights (see Reachability.prefix_indexes)
+    """
+    stats = Stats("aggregate") if stats is None else stats
+    with stats.stage("values"):
+        value_offsets, value_data = values_to_csr(reachability.node_ids, values)
+    stats.add("values", len(value_data))
+    stats.add("bytes", value_offsets.nbytes + value_data.nbytes)
+    codes = np.array(
+        [AGGREGATION_CODES[v] for v in aggregations.values()], dtype=np.int64
+    )
+
+    results = []
+    chunks = reachability.chunks()
+    if (
+        impedance is None
+        and isinstance(decay_func, CompiledDecay)
+        and decay_func.masks_prefix()
+    ):
+        chunks = _split_chunks(chunks, decay_func.max_weight, DECAY_BATCH_PAIRS)
+    while True:
+        # chunks are read from disk, or computed by LazyReachability, as they're needed
+        with stats.stage("chunks"):
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            if chunk.symmetric and (codes == MEDIAN).any():
+                # the median needs all the values of an origin at once
+                chunk = chunk.expand()
+
+        with stats.stage("decay"):
+            # only the pairs within max_weight are scanned, and compiled decay functions
+            #   are applied to them in the kernels
+            offsets, destinations = chunk.offsets, chunk.destinations
+            weights = chunk.impedance_weights(impedance)
+            decay_code = decay_func.compiled_code()
+            if impedance is None and decay_code is not None:
+                prefix_offsets = chunk.prefix_offsets(decay_func.max_weight)
+            elif (
+                impedance is None
+                and isinstance(decay_func, CompiledDecay)
+                and decay_func.masks_prefix()
+            ):
+                # only the prefixes are decayed, into an array of their own
+                prefix_offsets = chunk.prefix_offsets(decay_func.max_weight)
+                weights = decay_func.decay_prefixes(weights, offsets, prefix_offsets)
+                decay_code = DECAYED
+            else:
+                # the pairs aren't a prefix of each segment, or are decayed here, so
+                #   they're gathered
+                prefix_offsets, take = _select_pairs(chunk, decay_func, impedance)
+                offsets, destinations = prefix_offsets, destinations[take]
+                weights = weights[take]
+                if decay_code is None:
+                    weights, decay_code = decay_func.decay(weights), DECAYED
+            decay_args = (
+                weights,
+                decay_code,
+                float(decay_func.max_weight),
+                np.asarray(decay_func.params, dtype=np.float64),
+            )
+        with stats.stage("aggregate"):
+            if chunk.symmetric:
+                counts, out = _aggregate_symmetric(
+                    chunk.origins,
+                    offsets,
+                    destinations,
+                    prefix_offsets,
+                    *decay_args,
+                    value_offsets,
+                    value_data,
+                    codes,
+                )
+                counts, out = counts[chunk.origins], out[chunk.origins]
+            else:
+                counts, out = _aggregate_segments(
+                    offsets,
+                    destinations,
+                    prefix_offsets,
+                    *decay_args,
+                    value_offsets,
+                    value_data,
+                    codes,
+                )
+            found = counts.max(axis=1, initial=0) > 0
+            results.append((chunk.origins[found], out[found]))
+        stats.add("origins", len(chunk.origins))
+        stats.add("pairs", prefix_offsets[-1] - prefix_offsets[0])
+        stats.add("bytes", counts.nbytes + out.nbytes)
+        if weights is not chunk.weights:
+            stats.add("bytes", weights.nbytes + destinations.nbytes)
+
+    with stats.stage("output"):
+        origins = np.concatenate([result[0] for result in results])
+        out = np.concatenate([result[1] for result in results])
+        return pd.DataFrame(
+            out.reshape(len(origins), len(values.columns) * len(aggregations)),
+            index=pd.Index(reachability.node_ids.take(origins), name="from"),
+            columns=pd.MultiIndex.from_product([values.columns, aggregations.keys()]),
+        )
+
+
+@numba.jit(nogil=True, cache=True)
+def _sum_by_node(
+    value_indexes: np.array,  # dense node index of each row of values
+    values: np.array,  # (rows x columns) values
+    num_nodes: int,
+):
+    """
+    Sum the non-NaN values at each node and count them, returning two (nodes x columns)
+        arrays
+    """
+    sums = np.zeros((num_nodes, values.shape[1]))
+    counts = np.zeros((num_nodes, values.shape[1]))
+    for i in range(len(value_indexes)):
+        for col in range(values.shape[1]):
+            value = values[i, col]
+            if not np.isnan(value):
+                sums[value_indexes[i], col] += value
+                counts[value_indexes[i], col] += 1
+    return sums, counts
+
+
+@numba.jit(nogil=True, cache=True)
+def _csr_matmul(
+    offsets: np.array,  # operator offsets, one row per origin
+    destinations: np.array,  # operator column indexes (dense node ints)
+    data: np.array,  # operator decayed weights
+    sums: np.array,  # (nodes x columns) sum of values at each node
+    counts: np.array,  # (nodes x columns) number of values at each node
+):
+    """
+    Multiply the operator by sums and by counts, and also count the values each origin
+        reaches regardless of weight.  Returns three (origins x columns) arrays.
+    """
+    num_origins = len(offsets) - 1
+    weighted_sums = np.zeros((num_origins, sums.shape[1]))
+    weighted_counts = np.zeros((num_origins, sums.shape[1]))
+    reached_counts = np.zeros((num_origins, sums.shape[1]))
+    for i in range(num_origins):
+        for j in range(offsets[i], offsets[i + 1]):
+            weight = data[j]
+            destination = destinations[j]
+            for col in range(sums.shape[1]):
+                weighted_sums[i, col] += weight * sums[destination, col]
+                weighted_counts[i, col] += weight * counts[destination, col]
+                reached_counts[i, col] += counts[destination, col]
+    return weighted_sums, weighted_counts, reached_counts
+
+
+@numba.jit(nogil=True, cache=True)
+def _csr_dot(
+    offsets: np.array,  # operator offsets, one row per origin
+    destinations: np.array,  # operator column indexes (dense node ints)
+    data: np.array,  # operator decayed weights
+    matrix: np.array,  # (nodes x columns) dense matrix
+):
+    """
+    Multiply the operator by matrix, returning an (origins x columns) array
+    """
+    num_origins = len(offsets) - 1
+    out = np.zeros((num_origins, matrix.shape[1]))
+    for i in range(num_origins):
+        for j in range(offsets[i], offsets[i + 1]):
+            weight = data[j]
+            destination = destinations[j]
+            for col in range(matrix.shape[1]):
+                out[i, col] += weight * matrix[destination, col]
+    return out
+
+
+class AccessibilityOperator:
+    """
+    The decayed weights of a PandanaNetwork for one decay function, as a sparse
+        (origins x nodes) matrix in CSR form.  This makes repeated weighted sums and means of
+        many different sets of values (e.g. land use scenarios or Monte Carlo draws) a sparse
+        matrix product, without touching the reachability arrays or decay function again.
+        Use PandanaNetwork.accessibility_operator to get one.
+    """
+
+    node_ids: pd.Index
+    origins: np.array
+    offsets: np.array
+    destinations: np.array
+    data: np.array
+
+    def __init__(
+        self,
+        reachability: Reachability | ChunkedReachability,
+        decay_func: PandanaDecayFunction,
+        impedance: str = None,
+    ):
+        """
+        :param impedance: See aggregate_reachability
+        """
+        origins, offsets, destinations, data = [], [np.zeros(1, np.int64)], [], []
+        for chunk in reachability.chunks():
+            if chunk.symmetric:
+                chunk = chunk.expand()
+            prefix_offsets, take = _select_pairs(chunk, decay_func, impedance)
+            origins.append(chunk.origins)
+            offsets.append(offsets[-1][-1] + prefix_offsets[1:])
+            destinations.append(chunk.destinations[take])
+            data.append(decay_func.decay(chunk.impedance_weights(impedance)[take]))
+
+        self.node_ids = reachability.node_ids
+        self.origins = np.concatenate(origins)
+        self.offsets = np.concatenate(offsets)
+        self.destinations = np.concatenate(destinations)
+        self.data = np.concatenate(data)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return len(self.origins), len(self.node_ids)
+
+    def _apply(self, values: pd.Series | pd.DataFrame):
+        values_df = values if isinstance(values, pd.DataFrame) else values.to_frame()
+        value_indexes = self.node_ids.get_indexer(values_df.index)
+        found = value_indexes >= 0
+        sums, counts = _sum_by_node(
+            value_indexes[found],
+            np.ascontiguousarray(values_df.to_numpy(dtype=np.float64)[found]),
+            len(self.node_ids),
+        )
+        return _csr_matmul(self.offsets, self.destinations, self.data, sums, counts)
+
+    def _to_pandas(self, values: pd.Series | pd.DataFrame, out: np.array):
+        index = pd.Index(self.node_ids.take(self.origins), name="from")
+        if isinstance(values, pd.DataFrame):
+            return pd.DataFrame(out, index=index, columns=values.columns)
+        return pd.Series(out[:, 0], index=index)
+
+    def dot(self, matrix: np.array) -> np.array:
+        """
+        Multiply the operator by a dense (nodes x columns) matrix whose rows are ordered
+            like node_ids, returning an (origins x columns) matrix
+        """
+        matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+        if matrix.ndim == 1:
+            return self.dot(matrix[:, None])[:, 0]
+        return _csr_dot(self.offsets, self.destinations, self.data, matrix)
+
+    def sum(self, values: pd.Series | pd.DataFrame) -> pd.Series | pd.DataFrame:
+        """
+        Weighted sum of values for every origin, the same as PandanaNetwork.aggregate with
+            'sum'.  Pass a DataFrame with one column per scenario to compute all of them in
+            one pass.  Origins with no values in range are NaN.
+        """
+        weighted_sums, _, reached_counts = self._apply(values)
+        weighted_sums[reached_counts == 0] = np.nan
+        return self._to_pandas(values, weighted_sums)
+
+    def mean(self, values: pd.Series | pd.DataFrame) -> pd.Series | pd.DataFrame:
+        """
+        Weighted mean of values for every origin, the same as PandanaNetwork.aggregate with
+            'mean'.  Pass a DataFrame with one column per scenario to compute all of them in
+            one pass.  Origins with no values in range are NaN.
+        """
+        weighted_sums, weighted_counts, reached_counts = self._apply(values)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = weighted_sums / weighted_counts
+        means[reached_counts == 0] = np.nan
+        return self._to_pandas(values, means)
@@ -1,8 +1,70 @@
-from typing import Callable
+from typing import Callable, Hashable
 
+import numba
 import numpy as np
 import pandas as pd
 
+# the decay functions compiled into the aggregation kernels, see PandanaDecayFunction.code,
+#   and the code for weights that were decayed before they were passed to a kernel
+NO_DECAY, LINEAR_DECAY, EXPONENTIAL_DECAY = range(3)
+DECAYED = -1
+
+
+@numba.jit(nogil=True, cache=True)
+def decay_weight(
+    code: int, max_weight: float, params: np.array, weight: float
+) -> float:
+    """
+    The decayed weight of one pair for a compiled decay function, which is inlined in the
+        aggregation kernels so the decayed weights are never stored
+    """
+    if code == NO_DECAY:
+        return 1.0
+    elif code == LINEAR_DECAY:
+        return (max_weight - weight) / max_weight
+    elif code == EXPONENTIAL_DECAY:
+        return np.exp(-1 * (weight / max_weight) * params[0])
+    return weight
+
+
+@numba.jit(nogil=True, cache=True)
+def _decay_weights(
+    code: int, max_weight: float, params: np.array, weights: np.array
+) -> np.array:
+    out = np.empty(len(weights))
+    for i in range(len(weights)):
+        out[i] = decay_weight(code, max_weight, params, weights[i])
+    return out
+
+
+@numba.jit(nogil=True)
+def _kernel_weights(
+    kernel: Callable, max_weight: float, params: np.array, weights: np.array
+) -> np.array:
+    out = np.empty(len(weights))
+    for i in range(len(weights)):
+        out[i] = kernel(weights[i], max_weight, params)
+    return out
+
+
+@numba.jit(nogil=True)
+def _kernel_prefix_weights(
+    kernel: Callable,
+    max_weight: float,
+    params: np.array,
+    weights: np.array,
+    offsets: np.array,
+    prefix_offsets: np.array,
+) -> np.array:
+    out = np.empty(prefix_offsets[-1] - prefix_offsets[0])
+    for i in range(len(offsets) - 1):
+        shift = offsets[i] - prefix_offsets[i]
+        for j in range(prefix_offsets[i], prefix_offsets[i + 1]):
+            out[j - prefix_offsets[0]] = kernel(
+                np.float64(weights[shift + j]), max_weight, params
+            )
+    return out
+
 
 class PandanaDecayFunction:
     """
@@ -15,11 +77,140 @@ class PandanaDecayFunction:
         mean, etc.)  For instance, observations at the origin could start with a weight
         of 1.0 and linearly decrease to 0.0 at the max_weight, but the choice of decay
         is up to the user.
+    :param impedance: The name of the edge cost column that max_weight and the weights
+        are in (e.g. a travel time column, see PandanaNetwork.preprocess), or None for the
+        edge_costs_col of the network
+    :param code: For the decay functions in this module, which one it is (e.g. LINEAR_DECAY),
+        so the aggregation kernels select the pairs within max_weight and compute each
+        decayed weight as they go instead of calling mask and weights (see compiled_code).
+        Subclasses which only set mask and weights are still supported, but they're
+        applied (in pandas) to every pair before aggregating.
+    :param params: The parameters of a compiled decay function other than max_weight
     """
 
     mask: Callable[[pd.Series], pd.Series]
     weights: Callable[[pd.Series], pd.Series]
     max_weight: float
+    impedance: str = None
+    code: int = None
+    params: np.array = np.empty(0)
+    # the mask and weights that code computes, see compiled_code
+    _compiled: tuple = None
+
+    def _compile(self, code: int, params: list[float] = ()):
+        """
+        Called at the end of __init__ by the decay functions in this module, after mask
+            and weights are set
+        """
+        self.code = code
+        self.params = np.asarray(params, dtype=np.float64)
+        self._compiled = (self.mask, self.weights)
+
+    def compiled_code(self) -> int | None:
+        """
+        The code the aggregation kernels use for this decay function, or None to apply
+            mask and weights instead, which is also the case when either of them was
+            replaced after __init__ (e.g. by a subclass of LinearDecay with its own mask)
+        """
+        if self._compiled is None or self._compiled != (self.mask, self.weights):
+            return None
+        return self.code
+
+    def masks_prefix(self) -> bool:
+        """
+        Whether mask is still the one set in __init__, which keeps the pairs within
+            max_weight.  Those are a prefix of the pairs of each origin (which are sorted by
+            weight), so they're found by binary search instead of applying mask to every pair.
+        """
+        return self._compiled is not None and self._compiled[0] is self.mask
+
+    def cache_key(self) -> Hashable:
+        """
+        A key which is equal for decay functions that decay weights the same way, so
+            results can be cached by value (see PandanaNetwork.accessibility_operator).
+            That's only known for compiled decay functions - any other is its own key.
+        """
+        code = self.compiled_code()
+        if code is None:
+            return self
+        return code, float(self.max_weight), tuple(self.params), self.impedance
+
+    def decay(self, weights: np.array) -> np.array:
+        """
+        The decayed weights (as float64) of an array of weights within max_weight
+        """
+        code = self.compiled_code()
+        if code is not None:
+            return _decay_weights(
+                code,
+                float(self.max_weight),
+                np.asarray(self.params, dtype=np.float64),
+                weights,
+            )
+        return np.asarray(self.weights(pd.Series(weights)), dtype=np.float64)
+
+
+class CompiledDecay(PandanaDecayFunction):
+    """
+    A user-defined decay function (e.g. gravity, step or gaussian) written as a numba
+        function of one weight, which is run without pandas.  For example
+
+        @numba.njit
+        def gaussian(weight, max_weight, params):
+            return np.exp(-0.5 * (weight / params[0]) ** 2)
+
+        decay_func = CompiledDecay(1000, gaussian, [300])
+
+    :param max_weight: Values beyond max_weight will not be considered
+    :param kernel: A numba.njit function of (weight, max_weight, params) which returns the
+        decayed weight
+    :param params: Passed to kernel as a float64 array
+    :param impedance: See PandanaDecayFunction
+    """
+
+    kernel: Callable[[float, float, np.array], float]
+
+    def __init__(
+        self,
+        max_weight: float,
+        kernel: Callable[[float, float, np.array], float],
+        params: list[float] = (),
+        impedance: str = None,
+    ):
+        self.max_weight = max_weight
+        self.kernel = kernel
+        self.params = np.asarray(params, dtype=np.float64)
+        self.impedance = impedance
+        self.mask = lambda weights: weights < max_weight
+        self.weights = lambda weights: pd.Series(
+            self.decay(weights.to_numpy()), index=weights.index
+        )
+        # there's no code for the kernels, but see masks_prefix
+        self._compiled = (self.mask, self.weights)
+
+    def decay(self, weights: np.array) -> np.array:
+        return _kernel_weights(
+            self.kernel,
+            float(self.max_weight),
+            self.params,
+            np.asarray(weights, dtype=np.float64),
+        )
+
+    def decay_prefixes(
+        self, weights: np.array, offsets: np.array, prefix_offsets: np.array
+    ) -> np.array:
+        """
+        The decayed weights of the prefix of each segment of weights (see
+            Reachability.prefix_offsets), without gathering the prefixes first
+        """
+        return _kernel_prefix_weights(
+            self.kernel,
+            float(self.max_weight),
+            self.params,
+            weights,
+            offsets,
+            prefix_offsets,
+        )
 
 
 class NoDecay(PandanaDecayFunction):
@@ -29,13 +220,16 @@ class NoDecay(PandanaDecayFunction):
         will be weighted equally to a value at the origin node.
     :param max_weight: Values beyond max_weight (sum of the edge weight in network
         distance) will not be considered
+    :param impedance: See PandanaDecayFunction
     :return: A value for the given origin node
     """
 
-    def __init__(self, max_weight: float):
+    def __init__(self, max_weight: float, impedance: str = None):
         self.max_weight = max_weight
+        self.impedance = impedance
         self.mask = lambda weights: weights < max_weight
         self.weights = lambda weights: pd.Series(1, index=weights.index)
+        self._compile(NO_DECAY)
 
 
 class LinearDecay(PandanaDecayFunction):
@@ -46,13 +240,16 @@ class LinearDecay(PandanaDecayFunction):
         halfway to max_weight will be weighted as 0.5.
     :param max_weight: Values beyond max_weight (sum of weight_col in network distance)
         will not be considered
+    :param impedance: See PandanaDecayFunction
     :return: A value for the given origin node
     """
 
-    def __init__(self, max_weight: float):
+    def __init__(self, max_weight: float, impedance: str = None):
         self.max_weight = max_weight
+        self.impedance = impedance
         self.mask = lambda weights: weights < max_weight
         self.weights = lambda weights: (max_weight - weights) / max_weight
+        self._compile(LINEAR_DECAY)
 
 
 class ExponentialDecay(PandanaDecayFunction):
@@ -69,6 +266,7 @@ class ExponentialDecay(PandanaDecayFunction):
         self,
         max_weight: float,
         flatness_param: float = 1,
+        impedance: str = None,
     ):
         """
         :param max_weight:
@@ -76,9 +274,12 @@ class ExponentialDecay(PandanaDecayFunction):
             shallower.  At 1, a weight equal to max_weight will decay to .37, at 0.5
             it will decay to only 0.61, and at 2 it will decay to .13.  See the formula
             in the code.
+        :param impedance: See PandanaDecayFunction
         """
         self.max_weight = max_weight
+        self.impedance = impedance
         self.mask = lambda weights: weights < max_weight
         self.weights = lambda weights: np.exp(
             -1 * (weights / max_weight) * flatness_param
         )
+        self._compile(EXPONENTIAL_DECAY, [flatness_param])
@@ -1,121 +1,566 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from heapq import heappop, heappush
+from typing import Callable
 
 import numba
 import numpy as np
 import pandas as pd
-from numba.types import DictType, Tuple, float64, int64
+from numba.typed import List
+from numba.types import ListType, Tuple, boolean, float64, int32, int64
+
+# results are collected in blocks which start at the min size and double up to the max
+#   size, so calls for a few sources don't allocate a big block, see _dijkstra_all_pairs
+MIN_RESULTS_BLOCK_SIZE = 1 << 12
+RESULTS_BLOCK_SIZE = 1 << 20
 
 # early code (heavily modified) from https://gist.github.com/kachayev/5990802
 
 
 @numba.jit(
-    (DictType(int64, float64))(
+    int64(
         int64[:],
         int64[:],
         float64[:],
+        float64[:, ::1],
         int64,
         float64,
-        DictType(int64, int64),
-    )
+        int64,
+        float64[:],
+        float64[:, ::1],
+        int64[:],
+        int64[:],
+        int64[:],
+        float64[:],
+        float64[:, ::1],
+    ),
+    cache=True,
 )
 def _dijkstra(
-    from_nodes: np.array,  # node ids (ints)
-    to_nodes: np.array,  # node ids (ints)
-    edge_costs: np.array,  # weights (floats)
-    source: int,  # source node
+    offsets: np.array,  # CSR offsets, out-edges of node i are offsets[i]:offsets[i + 1]
+    neighbors: np.array,  # CSR "to" nodes (dense ints)
+    edge_costs: np.array,  # CSR weights (floats)
+    edge_impedances: np.array,  # CSR (edges x impedances) other costs, see below
+    source: int,  # source node (dense int)
     cutoff: float,  # cutoff weight (float)
-    indexes: DictType(int64, int64),  # first occurrence of each node_id in from_nodes
+    epoch: int,  # unique stamp for this run, so scratch arrays never need a reset
+    dist: np.array,  # scratch, min cost seen so far, valid where reached == epoch
+    impedance_dist: np.array,  # scratch, other costs along the path of dist
+    reached: np.array,  # scratch, epoch stamp of nodes with a valid dist
+    settled: np.array,  # scratch, epoch stamp of nodes whose min cost is final
+    out_nodes: np.array,  # output, settled nodes in the order they are settled
+    out_weights: np.array,  # output, min cost for each of out_nodes
+    out_impedances: np.array,  # output, other costs for each of out_nodes
 ):
     """
-    Internal function should not be called except by dijkstra_all_pairs
+    Internal function should not be called except by _dijkstra_all_pairs.  Returns the
+        number of nodes written to out_nodes / out_weights, which are sorted by weight
+        because nodes are settled in order of increasing cost.  The other costs in
+        edge_impedances (e.g. travel time, when edge_costs is length) are summed along the
+        same shortest paths, so they don't need a search of their own.
     """
+    num_impedances = edge_impedances.shape[1]
     # q is the heapq instance
-    # seen is a set of which nodes we've seen so far
-    # min_weight is a dict where keys are node ids and values are the minimum costs we've seen so far
-    q, seen, min_costs = [(0.0, source)], set(), {source: 0.0}
+    q = [(0.0, source)]
+    dist[source] = 0.0
+    impedance_dist[source, :] = 0.0
+    reached[source] = epoch
+    count = 0
     while q:
         current_cost, from_node = heappop(q)
-        if from_node in seen or from_node not in indexes:
+        if settled[from_node] == epoch:
             continue
 
-        seen.add(from_node)
-        ind = indexes[from_node]
+        settled[from_node] = epoch
+        out_nodes[count] = from_node
+        out_weights[count] = current_cost
+        for m in range(num_impedances):
+            out_impedances[count, m] = impedance_dist[from_node, m]
+        count += 1
 
-        while ind < len(from_nodes) and from_nodes[ind] == from_node:
-            to_node, cost = to_nodes[ind], edge_costs[ind]
-            ind += 1
-            if to_node in seen:
+        for ind in range(offsets[from_node], offsets[from_node + 1]):
+            to_node = neighbors[ind]
+            if settled[to_node] == epoch:
                 continue
 
-            prev_cost = min_costs.get(to_node)
-            new_cost = current_cost + cost
+            new_cost = current_cost + edge_costs[ind]
             if new_cost > cutoff:
                 continue
 
-            if prev_cost is None or new_cost < prev_cost:
-                min_costs[to_node] = new_cost
+            if reached[to_node] != epoch or new_cost < dist[to_node]:
+                dist[to_node] = new_cost
+                for m in range(num_impedances):
+                    impedance_dist[to_node, m] = (
+                        impedance_dist[from_node, m] + edge_impedances[ind, m]
+                    )
+                reached[to_node] = epoch
                 heappush(q, (new_cost, to_node))
 
-    return min_costs
+    return count
 
 
-@numba.jit(
-    Tuple((int64[:], int64[:], float64[:]))(int64[:], int64[:], float64[:], float64)
-)
-def _dijkstra_all_pairs(
-    from_nodes: np.array,  # node ids (ints)
-    to_nodes: np.array,  # node ids (ints)
+@numba.jit(int64[:](int64[:], int64[:], float64[:], int64), cache=True)
+def _build_csr(
+    from_nodes: np.array,  # node ids (dense ints)
+    to_nodes: np.array,  # node ids (dense ints)
     edge_costs: np.array,  # weights (floats)
-    cutoff: float,  # cutoff weight (float)
+    num_nodes: int,  # number of dense node ids
 ):
     """
-    Run dijkstra for every node in from_nodes
+    Validate the edges and return the CSR offsets - the out-edges of node i are at
+        offsets[i]:offsets[i + 1] in to_nodes and edge_costs, which works because
+        from_nodes is sorted
     """
     assert (
         len(from_nodes) == len(to_nodes) == len(edge_costs)
     ), "from_nodes, to_nodes, and edge_weights must be same length"
 
-    # indexes[node_id] holds the first array index that from_node is seen in from_nodes
-    indexes = DictType.empty(key_type=int64, value_type=int64)
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
     for i in range(len(from_nodes)):
         assert edge_costs[i] > 0, "Edge costs cannot be negative"
         if i > 1:
             # we require from_nodes to be sorted
             assert from_nodes[i] >= from_nodes[i - 1], "from_nodes must be sorted"
-        if from_nodes[i] not in indexes:
-            indexes[from_nodes[i]] = i
-
-    # results is a dictionary where keys are "from" nodes and values are dictionaries
-    #   the sub-dictionary contains keys which are "to" nodes and the min const between
-    #   from and to
-    results = DictType.empty(
-        key_type=int64, value_type=DictType.empty(key_type=int64, value_type=float64)
+        assert (
+            from_nodes[i] < num_nodes and to_nodes[i] < num_nodes
+        ), "Node ids must be less than num_nodes"
+        offsets[from_nodes[i] + 1] += 1
+
+    return np.cumsum(offsets)
+
+
+@numba.jit(
+    Tuple(
+        (
+            int64[:],
+            ListType(int32[::1]),
+            ListType(float64[::1]),
+            ListType(float64[:, ::1]),
+        )
+    )(
+        int64[:],
+        int64[:],
+        float64[:],
+        float64[:, ::1],
+        int64[:],
+        float64,
+        boolean,
+        int64[:],
+        int64[:],
+        int64,
+    ),
+    nogil=True,
+    cache=True,
+)
+def _dijkstra_all_pairs(
+    offsets: np.array,  # CSR offsets from _build_csr
+    neighbors: np.array,  # CSR "to" nodes (dense ints)
+    edge_costs: np.array,  # CSR weights (floats)
+    edge_impedances: np.array,  # CSR (edges x impedances) other costs, see _dijkstra
+    sources: np.array,  # source nodes to run dijkstra from (dense ints)
+    cutoff: float,  # cutoff weight (float)
+    symmetric: bool,  # only keep nodes >= the source, see dijkstra_from_sources
+    reached: np.array,  # scratch, see DijkstraScratch
+    settled: np.array,  # scratch, see DijkstraScratch
+    first_epoch: int,  # the epoch of the first source, which is followed by one per source
+):
+    """
+    Run dijkstra for every node in sources.  Returns the number of nodes within the cutoff
+        of each source, and the blocks of those nodes, their weights and their other costs
+        for all sources in order.  This releases the GIL so that dijkstra_all_pairs can run
+        chunks of sources on several threads at once, each with its own scratch space.
+    """
+    num_nodes = len(offsets) - 1
+    num_impedances = edge_impedances.shape[1]
+
+    # scratch space shared by every run in this call, see _dijkstra - only the parts
+    #   each run reaches are touched, so this doesn't cost O(num_nodes) per call
+    dist = np.empty(num_nodes, dtype=np.float64)
+    impedance_dist = np.empty((num_nodes, num_impedances), dtype=np.float64)
+    out_nodes = np.empty(num_nodes, dtype=np.int64)
+    out_weights = np.empty(num_nodes, dtype=np.float64)
+    out_impedances = np.empty((num_nodes, num_impedances), dtype=np.float64)
+
+    # results are appended straight into fixed-size blocks as each source finishes, so
+    #   nothing is held per source and the blocks are only copied once, when
+    #   dijkstra_from_sources concatenates them
+    counts = np.empty(len(sources), dtype=np.int64)
+    node_blocks = List.empty_list(int32[::1])
+    weight_blocks = List.empty_list(float64[::1])
+    impedance_blocks = List.empty_list(float64[:, ::1])
+    block_nodes = np.empty(0, dtype=np.int32)
+    block_weights = np.empty(0, dtype=np.float64)
+    block_impedances = np.empty((0, num_impedances), dtype=np.float64)
+    used = 0
+    for i in range(len(sources)):
+        count = _dijkstra(
+            offsets,
+            neighbors,
+            edge_costs,
+            edge_impedances,
+            sources[i],
+            cutoff,
+            first_epoch + i,
+            dist,
+            impedance_dist,
+            reached,
+            settled,
+            out_nodes,
+            out_weights,
+            out_impedances,
+        )
+        if symmetric:
+            kept = 0
+            for k in range(count):
+                if out_nodes[k] >= sources[i]:
+                    out_nodes[kept] = out_nodes[k]
+                    out_weights[kept] = out_weights[k]
+                    out_impedances[kept] = out_impedances[k]
+                    kept += 1
+            count = kept
+        counts[i] = count
+
+        copied = 0
+        while copied < count:
+            if used == len(block_nodes):
+                block_size = min(
+                    max(2 * len(block_nodes), MIN_RESULTS_BLOCK_SIZE),
+                    RESULTS_BLOCK_SIZE,
+                )
+                block_nodes = np.empty(block_size, dtype=np.int32)
+                block_weights = np.empty(block_size, dtype=np.float64)
+                block_impedances = np.empty(
+                    (block_size, num_impedances), dtype=np.float64
+                )
+                node_blocks.append(block_nodes)
+                weight_blocks.append(block_weights)
+                impedance_blocks.append(block_impedances)
+                used = 0
+            n = min(count - copied, len(block_nodes) - used)
+            block_nodes[used : used + n] = out_nodes[copied : copied + n]
+            block_weights[used : used + n] = np.round(
+                out_weights[copied : copied + n], 2
+            )
+            block_impedances[used : used + n] = np.round(
+                out_impedances[copied : copied + n], 2
+            )
+            used += n
+            copied += n
+
+    if len(node_blocks):
+        # trim the unused tail of the last block
+        node_blocks[-1] = block_nodes[:used].copy()
+        weight_blocks[-1] = block_weights[:used].copy()
+        impedance_blocks[-1] = block_impedances[:used].copy()
+
+    return counts, node_blocks, weight_blocks, impedance_blocks
+
+
+def edges_to_csr(
+    edges_df: pd.DataFrame,
+    from_nodes_col="from",
+    to_nodes_col="to",
+    edge_costs_col="edge_cost",
+) -> tuple[pd.Index, np.array, np.array, np.array]:
+    """
+    Translate the edges DataFrame to the CSR arrays the numba code works with.  Node ids
+        need to be ints by the time they get into numba, so they are mapped to their position
+        in the returned (sorted) node_ids Index.
+    :return: node_ids, offsets, neighbors and edge_costs - the out-edges of node_ids[i] go to
+        node_ids[neighbors[offsets[i]:offsets[i + 1]]]
+    """
+    node_ids = pd.Index(
+        pd.concat([edges_df[from_nodes_col], edges_df[to_nodes_col]]).unique()
+    ).sort_values()
+    assert (
+        len(node_ids) < np.iinfo(np.int32).max
+    ), "Too many nodes for int32 node indexes"
+
+    from_nodes = node_ids.get_indexer(edges_df[from_nodes_col]).astype(np.int64)
+    to_nodes = node_ids.get_indexer(edges_df[to_nodes_col]).astype(np.int64)
+    edge_costs = edges_df[edge_costs_col].to_numpy(dtype=np.float64, copy=True)
+
+    order = np.lexsort((to_nodes, from_nodes))
+    from_nodes, to_nodes, edge_costs = (
+        from_nodes[order],
+        to_nodes[order],
+        edge_costs[order],
     )
+    offsets = _build_csr(from_nodes, to_nodes, edge_costs, len(node_ids))
 
-    for from_node in indexes.keys():
-        results[from_node] = _dijkstra(
-            from_nodes, to_nodes, edge_costs, from_node, cutoff, indexes
+    return node_ids, offsets, to_nodes, edge_costs
+
+
+def indexes_to_csr(
+    from_nodes: np.array, to_nodes: np.array, num_nodes: int
+) -> tuple[np.array, np.array, np.array]:
+    """
+    Sort edges given as dense node indexes (which have already been validated) into CSR
+        form, like edges_to_csr
+    :return: offsets, neighbors and the order of the edges in CSR form, which sorts the
+        edge costs to match neighbors
+    """
+    order = np.lexsort((to_nodes, from_nodes))
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(from_nodes, minlength=num_nodes), out=offsets[1:])
+    return offsets, to_nodes[order].astype(np.int64), order
+
+
+def sample_ball_sizes(
+    offsets: np.array,
+    neighbors: np.array,
+    edge_costs: np.array,
+    sources: np.array,
+    cutoff: float,
+    symmetric: bool = False,
+    max_seconds: float = None,
+) -> tuple[np.array, float]:
+    """
+    The number of nodes within cutoff of each of sources (dense ints), i.e. the number of
+        results dijkstra_from_sources would return for each, without keeping the results.
+        Sources are run a few hundred at a time, and if max_seconds is passed this stops
+        early (after the first few) once that much time has passed.
+    :return: The counts of the sources that were run (the first len(counts) of sources),
+        and the number of seconds they took
+    """
+    counts = []
+    scratch = DijkstraScratch(len(offsets) - 1)
+    t0 = time.perf_counter()
+    for start in range(0, len(sources), 250):
+        chunk = sources[start : start + 250]
+        counts.append(
+            _dijkstra_all_pairs(
+                offsets,
+                neighbors,
+                edge_costs,
+                np.empty((len(edge_costs), 0)),
+                chunk,
+                cutoff,
+                symmetric,
+                scratch.reached,
+                scratch.settled,
+                scratch.take_epochs(len(chunk)),
+            )[0]
         )
+        if max_seconds is not None and time.perf_counter() - t0 > max_seconds:
+            break
+    seconds = time.perf_counter() - t0
+    return np.concatenate(counts) if counts else np.empty(0, dtype=np.int64), seconds
+
+
+@numba.jit(
+    int64[:](int64[:], int64[:], float64[:], int64[:], float64),
+    nogil=True,
+    cache=True,
+)
+def _nodes_within(
+    offsets: np.array,
+    neighbors: np.array,
+    edge_costs: np.array,
+    sources: np.array,
+    cutoff: float,
+) -> np.array:
+    """
+    Internal function for nodes_within, which runs one dijkstra from all of sources at
+        once (i.e. every source starts at cost 0)
+    """
+    dist = np.full(len(offsets) - 1, np.inf)
+    settled = np.zeros(len(offsets) - 1, dtype=np.bool_)
+    q = [(0.0, sources[0])]
+    for source in sources:
+        dist[source] = 0.0
+        heappush(q, (0.0, source))
+    while q:
+        current_cost, from_node = heappop(q)
+        if settled[from_node]:
+            continue
+        settled[from_node] = True
+        for ind in range(offsets[from_node], offsets[from_node + 1]):
+            to_node = neighbors[ind]
+            new_cost = current_cost + edge_costs[ind]
+            if new_cost <= cutoff and new_cost < dist[to_node]:
+                dist[to_node] = new_cost
+                heappush(q, (new_cost, to_node))
+    return np.flatnonzero(settled)
+
+
+def nodes_within(
+    offsets: np.array,
+    neighbors: np.array,
+    edge_costs: np.array,
+    sources: np.array,
+    cutoff: float,
+) -> np.array:
+    """
+    The sorted dense indexes of every node within cutoff of any of sources, found with a
+        single search from all of them, so it costs about as much as one dijkstra over the
+        area they cover
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    if len(sources) == 0:
+        return np.empty(0, dtype=np.int64)
+    return _nodes_within(
+        offsets.astype(np.int64, copy=False),
+        neighbors.astype(np.int64, copy=False),
+        edge_costs.astype(np.float64, copy=False),
+        sources,
+        float(cutoff),
+    )
+
 
-    # from here down we convert from dictionaries to arrays
-    # dictionaries are much more expensive to pass back to python
-    total_len = 0
-    for to_node_dict in results.values():
-        total_len += len(to_node_dict)
+def subgraph_csr(
+    offsets: np.array, neighbors: np.array, edge_costs: np.array, nodes: np.array
+) -> tuple[np.array, np.array, np.array]:
+    """
+    The CSR arrays of the edges between nodes (sorted dense indexes), with the nodes
+        renumbered to their positions in nodes.  Edges stay in the same order and nodes in
+        the same relative order, so dijkstra settles nodes (and breaks ties) exactly like
+        it does on the whole network, as long as nodes has every node it reaches.
+    """
+    counts = offsets[nodes + 1] - offsets[nodes]
+    starts = np.repeat(offsets[nodes] - np.cumsum(counts) + counts, counts)
+    take = starts + np.arange(counts.sum())
+    positions = np.searchsorted(nodes, neighbors[take])
+    inside = nodes[np.minimum(positions, len(nodes) - 1)] == neighbors[take]
+
+    from_positions = np.repeat(np.arange(len(nodes)), counts)[inside]
+    sub_offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(from_positions, minlength=len(nodes)), out=sub_offsets[1:])
+    return sub_offsets, positions[inside].astype(np.int64), edge_costs[take][inside]
+
+
+class DijkstraScratch:
+    """
+    The arrays dijkstra stamps with the epoch of each run (a number that's never used
+        twice) to mark the nodes it reached and settled, so they never need a reset.  They
+        have an entry per node, so a LazyReachability keeps them to reuse on every call
+        instead of initializing new ones.  Only one thread at a time can use an object.
+    """
+
+    reached: np.array
+    settled: np.array
+    # the epoch of the next run
+    epoch: int
+
+    def __init__(self, num_nodes: int):
+        self.reached = np.full(num_nodes, -1, dtype=np.int64)
+        self.settled = np.full(num_nodes, -1, dtype=np.int64)
+        self.epoch = 0
+
+    def take_epochs(self, n: int) -> int:
+        """
+        Reserve n epochs, returning the first
+        """
+        self.epoch += n
+        return self.epoch - n
+
+
+def dijkstra_from_sources(
+    offsets: np.array,
+    neighbors: np.array,
+    edge_costs: np.array,
+    sources: np.array,
+    cutoff: float,
+    n_threads: int = 1,
+    weight_dtype=np.float64,
+    symmetric: bool = False,
+    progress: Callable[[int, int], None] = None,
+    edge_impedances: np.array = None,
+    scratch: DijkstraScratch = None,
+) -> tuple[np.array, np.array, np.array, np.array]:
+    """
+    Run dijkstra for every node in sources (dense ints) on the CSR arrays from edges_to_csr,
+        split into contiguous chunks across n_threads threads when n_threads > 1.  Chunks
+        are concatenated in order, so the result is identical to a single-threaded run.
+        Pass symmetric=True for undirected networks (where every edge has a reverse edge
+        with the same cost) to only return the nodes that are >= each source, since the
+        weight from b to a is the same as from a to b.
+    :param progress: Called with the number of sources done and the total number of
+        sources as the work goes on, e.g. to report the progress of long runs
+    :param edge_impedances: Other costs of the edges (an edges x impedances array, in the
+        same order as edge_costs), which are summed along the shortest paths by edge_costs
+    :param scratch: Reused instead of a new DijkstraScratch for each chunk of sources,
+        which saves initializing it on every call when there are few sources (only with
+        n_threads <= 1, since each thread needs its own)
+    :return: The number of results for each source, followed by the flat int32 "to" nodes,
+        the weights and an (impedances x pairs) array of the other costs (rounded to 2
+        decimals and stored as weight_dtype).  The results of each source are sorted by
+        weight.
+    """
+    if edge_impedances is None:
+        edge_impedances = np.empty((len(edge_costs), 0))
+    edge_impedances = np.ascontiguousarray(edge_impedances, dtype=np.float64)
+
+    # a few chunks per thread keeps threads busy when some parts of the network are much
+    #   denser than others, and progress is reported after each chunk (about every 1% of
+    #   sources)
+    num_chunks = 1 if n_threads <= 1 else n_threads * 4
+    if progress is not None:
+        num_chunks = max(num_chunks, 100)
+    chunks = np.array_split(sources, max(min(len(sources), num_chunks), 1))
+
+    if scratch is not None:
+        assert n_threads <= 1, "A scratch can only be used by one thread"
+    # otherwise each thread makes one scratch, which it uses for all of its chunks
+    thread_scratches = threading.local()
+
+    def run(chunk: np.array):
+        chunk_scratch = scratch or getattr(thread_scratches, "scratch", None)
+        if chunk_scratch is None:
+            chunk_scratch = thread_scratches.scratch = DijkstraScratch(len(offsets) - 1)
+        return _dijkstra_all_pairs(
+            offsets,
+            neighbors,
+            edge_costs,
+            edge_impedances,
+            chunk,
+            cutoff,
+            symmetric,
+            chunk_scratch.reached,
+            chunk_scratch.settled,
+            chunk_scratch.take_epochs(len(chunk)),
+        )
 
-    from_nodes = np.empty(total_len, dtype=np.int64)
-    to_nodes = np.empty(total_len, dtype=np.int64)
-    weights = np.empty(total_len, dtype=np.float64)
+    results = []
+    with ThreadPoolExecutor(max_workers=max(n_threads, 1)) as executor:
+        chunk_results = executor.map(run, chunks) if n_threads > 1 else map(run, chunks)
+        done = 0
+        for chunk, result in zip(chunks, chunk_results):
+            results.append(result)
+            done += len(chunk)
+            if progress is not None:
+                progress(done, len(sources))
 
+    counts = np.concatenate([result[0] for result in results])
+    to_nodes = np.empty(counts.sum(), dtype=np.int32)
+    weights = np.empty(len(to_nodes), dtype=weight_dtype)
+    impedances = np.empty((edge_impedances.shape[1], len(to_nodes)), dtype=weight_dtype)
     i = 0
-    for from_node, to_node_dict in results.items():
-        for to_node, weight in to_node_dict.items():
-            from_nodes[i] = from_node
-            to_nodes[i] = to_node
-            weights[i] = weight
-            i += 1
+    while results:
+        _, node_blocks, weight_blocks, impedance_blocks = results.pop(0)
+        _copy_blocks(weight_blocks, weights, i)
+        _copy_blocks(impedance_blocks, impedances.T, i)
+        i = _copy_blocks(node_blocks, to_nodes, i)
+    return counts, to_nodes, weights, impedances
 
-    return from_nodes, to_nodes, weights
+
+@numba.jit(nogil=True, cache=True)
+def _copy_blocks(blocks, out: np.array, start: int) -> int:
+    """
+    Copy blocks into out from position start, releasing each block as soon as it has been
+        copied so that peak memory stays close to the size of the output.  This is compiled
+        (and cached) because iterating typed Lists from python compiles numba's list helpers
+        again in every new process.
+    :return: The position in out after the last block
+    """
+    i = start
+    for b in range(len(blocks)):
+        block = blocks[b]
+        out[i : i + len(block)] = block
+        i += len(block)
+        blocks[b] = block[:0].copy()
+    return i
 
 
 def dijkstra_all_pairs(
@@ -124,35 +569,32 @@ def dijkstra_all_pairs(
     from_nodes_col="from",
     to_nodes_col="to",
     edge_costs_col="edge_cost",
+    n_threads: int = 1,
 ) -> pd.DataFrame:
     """
     Run dijkstra for every node in the edges DataFrame.  Edges should have from, to, and edge_cost
       columns which can be specified using the optional parameters.  The return value will be node
       from-to connections and the associated weight of the shortest path between them.  Cutoff
       must be passed to keep the result performant and is the maximum weight to consider between
-      nearby nodes.
+      nearby nodes.  Pass n_threads > 1 to split the work across that many threads, which
+      returns exactly the same result as a single thread.
     """
-    # it's not the prettiest code, but node ids need to be ints by the time they get into numba
-    #  so we translate them here, which is very similar to pd.factorize
-    index_to_node_id = pd.Series(
-        np.unique([edges_df[from_nodes_col], edges_df[to_nodes_col]])
-    )
-    node_id_to_index = pd.Series(index_to_node_id.index, index=index_to_node_id.values)
-    edges_df[from_nodes_col] = edges_df[from_nodes_col].map(node_id_to_index)
-    edges_df[to_nodes_col] = edges_df[to_nodes_col].map(node_id_to_index)
-    edges_df = edges_df.sort_values(by=[from_nodes_col, to_nodes_col])
-
-    from_nodes, to_nodes, weight = _dijkstra_all_pairs(
-        edges_df[from_nodes_col].values,
-        edges_df[to_nodes_col].values,
-        edges_df[edge_costs_col].astype("float").values,
-        cutoff,
+    node_ids, offsets, neighbors, edge_costs = edges_to_csr(
+        edges_df, from_nodes_col, to_nodes_col, edge_costs_col
     )
 
-    ret_df = pd.DataFrame({"from": from_nodes, "to": to_nodes, "weight": weight})
-    ret_df["from"] = ret_df["from"].map(index_to_node_id)
-    ret_df["to"] = ret_df["to"].map(index_to_node_id)
-    ret_df.sort_values(by=["from", "weight"], inplace=True)
-    ret_df["weight"] = ret_df["weight"].round(2)
+    # every node with out-edges is a source
+    sources = np.flatnonzero(np.diff(offsets))
+    counts, to_nodes, weights, _ = dijkstra_from_sources(
+        offsets, neighbors, edge_costs, sources, cutoff, n_threads=n_threads
+    )
 
-    return ret_df
+    # no need to sort - results come back ordered by "from" and then by "weight", since
+    #   node indexes are assigned in sorted order and nodes are settled in order of weight
+    return pd.DataFrame(
+        {
+            "from": node_ids.take(np.repeat(sources, counts)),
+            "to": node_ids.take(to_nodes),
+            "weight": weights,
+        }
+    )
@@ -1,20 +1,67 @@
-import geopandas as gpd
-import osmnx
+from __future__ import annotations
+
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
 import pandas as pd
 
+from pandana2.aggregation import AccessibilityOperator, aggregate_reachability
 from pandana2.decay_functions import PandanaDecayFunction
-from pandana2.dijkstra import dijkstra_all_pairs
-from pandana2.utils import Aggregation, do_single_aggregation
+from pandana2.dijkstra import indexes_to_csr, nodes_within, sample_ball_sizes
+from pandana2.reachability import (
+    ChunkedReachability,
+    LazyReachability,
+    Reachability,
+    check_new_directory,
+    dense_origins,
+    load_reachability,
+)
+from pandana2.spatial import NodeIndex, assign_tiles
+from pandana2.stats import Stats
+from pandana2.utils import Aggregation
+
+if TYPE_CHECKING:
+    # geopandas, pyproj and osmnx are slow to import, so they're only imported by the
+    #   methods that use them
+    import geopandas as gpd
+
+# how many AccessibilityOperators a network keeps, see accessibility_operator
+MAX_ACCESSIBILITY_OPERATORS = 16
 
 
 class PandanaNetwork:
+    """
+    After preprocess (or load_preprocessed), aggregate, aggregate_async and
+        accessibility_operator can be called from many threads at once, e.g. by a web
+        service sharing one network between its workers.  The compiled kernels release the
+        GIL, so the threads run on as many cores.  Methods that change the network
+        (preprocess, update_edges, ...) shouldn't run at the same time as anything else.
+    """
+
     edges: gpd.GeoDataFrame | pd.DataFrame
     nodes: gpd.GeoDataFrame | pd.DataFrame
-    min_weights_df: pd.DataFrame = None
+    reachability: Reachability | ChunkedReachability | LazyReachability = None
     weight_cutoff: float = None
+    # the origins passed to preprocess, or None for all nodes
+    origins: pd.Index = None
     from_nodes_col: str
     to_nodes_col: str
     edge_costs_col: str
+    # the sorted node ids, whose positions are the dense node indexes used everywhere
+    node_ids: pd.Index
+    # the dense indexes of the from and to nodes of each edge
+    _from_indexes: np.array
+    _to_indexes: np.array
+    # method name (preprocess) -> the Stats of its last call, see aggregate for its stats
+    stats: dict[str, Stats]
+    # held while the cache of accessibility operators is changed
+    _lock: threading.Lock
 
     def __init__(
         self,
@@ -38,7 +85,7 @@ class PandanaNetwork:
         :param edge_costs_col: The name of the "from" nodes column (e.g. osmnx uses "distance")
             for Euclidian distance, but any impedance (like travel time) could also be used here.
         """
-        edges_columns = edges.reset_index().columns
+        edges_columns = list(edges.columns) + list(edges.index.names)
         if from_nodes_col not in edges_columns:
             raise Exception(
                 f"from_nodes_col='{from_nodes_col}' not found in edges DataFrame"
@@ -51,139 +98,827 @@ class PandanaNetwork:
             raise Exception(
                 f"edge_costs_col='{edge_costs_col}' not found in edges DataFrame"
             )
-        assert (
-            edges.reset_index()[from_nodes_col].isin(nodes.index).all()
-        ), "All 'from' node ids should be in the node DataFrame"
-        assert (
-            edges.reset_index()[to_nodes_col].isin(nodes.index).all()
-        ), "All 'to' node ids should be in the node DataFrame"
+        assert nodes.index.is_unique, "Node ids should be unique"
 
-        self.edges = edges
         self.nodes = nodes
         self.from_nodes_col = from_nodes_col
         self.to_nodes_col = to_nodes_col
         self.edge_costs_col = edge_costs_col
+        # node ids are mapped to dense indexes once, here, and everything else reuses them
+        self.node_ids = (
+            nodes.index
+            if nodes.index.is_monotonic_increasing
+            else nodes.index.sort_values()
+        )
+        assert (
+            len(self.node_ids) < np.iinfo(np.int32).max
+        ), "Too many nodes for int32 node indexes"
+        self._set_edges(edges, *self._index_edges(edges))
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def _edges_column(
+        self, edges: gpd.GeoDataFrame | pd.DataFrame, column: str
+    ) -> pd.Series | pd.Index:
+        """
+        A column of edges, which can also be a level of its index, without copying the
+            whole DataFrame like reset_index
+        """
+        if column in edges.columns:
+            return edges[column]
+        return edges.index.get_level_values(column)
+
+    def _index_edges(
+        self, edges: gpd.GeoDataFrame | pd.DataFrame
+    ) -> tuple[np.array, np.array]:
+        """
+        Map the from and to node ids of edges to dense node indexes, which also checks
+            that they are all in the nodes DataFrame
+        """
+        from_indexes = self.node_ids.get_indexer(
+            self._edges_column(edges, self.from_nodes_col)
+        )
+        assert (
+            from_indexes >= 0
+        ).all(), "All 'from' node ids should be in the node DataFrame"
+        to_indexes = self.node_ids.get_indexer(
+            self._edges_column(edges, self.to_nodes_col)
+        )
+        assert (
+            to_indexes >= 0
+        ).all(), "All 'to' node ids should be in the node DataFrame"
+        return from_indexes, to_indexes
+
+    def _set_edges(
+        self,
+        edges: gpd.GeoDataFrame | pd.DataFrame,
+        from_indexes: np.array,
+        to_indexes: np.array,
+    ):
+        self.edges = edges
+        self._from_indexes = from_indexes
+        self._to_indexes = to_indexes
+        self._csr_structure = None
+
+    def _edge_costs(self, edges: gpd.GeoDataFrame | pd.DataFrame) -> np.array:
+        edge_costs = self._edges_column(edges, self.edge_costs_col).to_numpy(
+            dtype=np.float64, copy=True
+        )
+        assert (edge_costs > 0).all(), "Edge costs cannot be negative"
+        return edge_costs
+
+    def _csr_impedances(self, impedances: list[str]) -> dict[str, np.array]:
+        """
+        The impedance columns of the edges in the CSR order of to_csr, by name
+        """
+        self.to_csr()
+        order = self._csr_structure[2]
+        edge_impedances = {}
+        for impedance in impedances:
+            if impedance not in list(self.edges.columns) + list(self.edges.index.names):
+                raise Exception(f"Impedance '{impedance}' not found in edges DataFrame")
+            edge_impedances[impedance] = self._edges_column(
+                self.edges, impedance
+            ).to_numpy(dtype=np.float64)[order]
+        return edge_impedances
+
+    def to_csr(self) -> tuple[pd.Index, np.array, np.array, np.array]:
+        """
+        The edges as CSR arrays of dense node indexes, see dijkstra.edges_to_csr.  Edges are
+            sorted into CSR order once, and only the edge costs are read again each time.
+        """
+        if self._csr_structure is None:
+            self._csr_structure = indexes_to_csr(
+                self._from_indexes, self._to_indexes, len(self.node_ids)
+            )
+        offsets, neighbors, order = self._csr_structure
+        return self.node_ids, offsets, neighbors, self._edge_costs(self.edges)[order]
 
     def preprocess(
         self,
         weight_cutoff: float,
+        n_threads: int = 1,
+        weight_dtype=np.float64,
+        cache_dir: str = None,
+        mmap: bool = False,
+        origins: pd.Index | list = None,
+        symmetric: bool = False,
+        progress: Callable[[int, int], None] = None,
+        max_bytes: int = None,
+        impedances: list[str] = None,
     ):
         """
         Convert the edges DataFrame (which represents the connections in a network), to a "minimum
             weights" DataFrame which contains all the from-to pairs with the shortest path weight
             between from and to nodes, for all pairs such that the minimum weight is less than the
             weight cutoff passed here.  This can be a very expensive operation, but for well-chosen
-            networks and cutoffs it should be very fast.
+            networks and cutoffs it should be very fast (see estimate_preprocess to check first).
         :param weight_cutoff: Don't investigate from-to pairs whose minimum path is larger than
             this cutoff.
+        :param n_threads: Split the work across this many threads.  The result is identical
+            to using a single thread.
+        :param weight_dtype: Pass np.float32 to store the weights in half the memory, at the
+            cost of some precision
+        :param cache_dir: If passed, the result is saved in a subdirectory of cache_dir named
+            by the fingerprint of the edges and these settings, and later calls (in any
+            process) with the same edges and settings load it instead of recomputing it.
+        :param mmap: Memory-map the result from cache_dir, see load_preprocessed
+        :param origins: Only compute the nodes near these node ids (e.g. the nodes of a few
+            thousand sites), which is proportionally faster.  aggregate then only returns
+            these origins.
+        :param symmetric: For undirected networks (see is_symmetric), store each pair of
+            nodes once instead of in both directions, which halves the memory and disk used.
+            Aggregations give the same results either way.
+        :param progress: Called with the number of origins done and the total number of
+            origins every 1% or so of the way through dijkstra, for long runs.  The time
+            of each stage and counts of the work done are in self.stats["preprocess"]
+            afterwards.
+        :param max_bytes: If passed, raise an Exception instead of computing the result if
+            estimate_preprocess predicts it would need more memory than this
+        :param impedances: Other edge cost columns (e.g. drive and walk times, when
+            edge_costs_col is length) to sum along the same shortest paths, so decay
+            functions can use any of them (see PandanaDecayFunction.impedance) with a
+            single run of dijkstra and a single copy of the pairs.  The pairs are the ones
+            within weight_cutoff by edge_costs_col, so pick a weight_cutoff that covers
+            the largest max_weight used for every impedance.
+        :return:
+        """
+        impedances = [] if impedances is None else list(impedances)
+        if symmetric:
+            if origins is not None:
+                raise Exception("Origins can't be passed with symmetric=True")
+            if impedances:
+                raise Exception("Impedances can't be passed with symmetric=True")
+            if not self.is_symmetric():
+                raise Exception(
+                    "symmetric=True requires a reverse edge with the same cost for every edge"
+                )
+
+        stats = self.stats["preprocess"] = Stats("preprocess")
+        with stats.stage("csr"):
+            node_ids, offsets, neighbors, edge_costs = self.to_csr()
+            dense = dense_origins(node_ids, offsets, origins)
+            requested = None
+            if origins is not None:
+                # every origin asked for is kept, so update_edges adds the ones without
+                #   out-edges if they get one
+                requested = np.unique(node_ids.get_indexer(origins)).astype(np.int64)
+                origins = node_ids.take(requested)
+            edge_impedances = self._csr_impedances(impedances)
+        with stats.stage("fingerprint"):
+            fingerprint = self.fingerprint(
+                weight_cutoff, weight_dtype, origins, symmetric, impedances
+            )
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, fingerprint)
+            if os.path.exists(cache_path):
+                with stats.stage("load"):
+                    self.load_preprocessed(cache_path, mmap=mmap)
+                self._add_reachability_counts(stats)
+                return
+
+        if max_bytes is not None:
+            with stats.stage("estimate"):
+                estimate = self.estimate_preprocess(
+                    weight_cutoff,
+                    weight_dtype,
+                    n_threads,
+                    origins,
+                    symmetric,
+                    impedances,
+                )
+            if estimate["peak_bytes"] > max_bytes:
+                raise Exception(
+                    f"preprocess would need about {estimate['peak_bytes'] / 1e9:.1f} GB, "
+                    f"which is more than max_bytes - use a smaller weight_cutoff, or "
+                    f"preprocess_to_disk or preprocess_lazy"
+                )
+
+        with stats.stage("dijkstra"):
+            reachability = Reachability.from_csr(
+                node_ids,
+                offsets,
+                neighbors,
+                edge_costs,
+                dense,
+                weight_cutoff,
+                n_threads=n_threads,
+                weight_dtype=weight_dtype,
+                symmetric=symmetric,
+                progress=progress,
+                edge_impedances=edge_impedances,
+            )
+        reachability.fingerprint = fingerprint
+        reachability.requested_origins = requested
+        self._set_reachability(reachability, origins)
+        self._add_reachability_counts(stats)
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with stats.stage("save"):
+                try:
+                    self.save_preprocessed(cache_path)
+                except FileExistsError:
+                    # another process saved the same result first
+                    pass
+                if mmap:
+                    # switch to the mapped copy so this process shares it with the others
+                    self.load_preprocessed(cache_path, mmap=True)
+
+    def estimate_preprocess(
+        self,
+        weight_cutoff: float,
+        weight_dtype=np.float64,
+        n_threads: int = 1,
+        origins: pd.Index | list = None,
+        symmetric: bool = False,
+        impedances: list[str] = None,
+        sample_size: int = 1000,
+        max_seconds: float = 10.0,
+        seed: int = 0,
+    ) -> dict[str, float]:
+        """
+        Predict the size and runtime of preprocess with these arguments before committing to
+            it, by running dijkstra from a random sample of the origins and scaling up.  Dense
+            cities and large cutoffs can need far more memory than expected, since the number
+            of pairs grows with the square of the cutoff.
+        :param weight_cutoff: See preprocess
+        :param weight_dtype: See preprocess
+        :param n_threads: See preprocess, the estimated seconds assume perfect scaling
+        :param origins: See preprocess
+        :param symmetric: See preprocess
+        :param impedances: See preprocess, each of which is stored for every pair
+        :param sample_size: The number of origins to sample
+        :param max_seconds: Stop sampling early once this much time has passed, which
+            still gives a rough estimate for very large cutoffs
+        :param seed: The random seed for the sample
+        :return: A dict with the number of origins, the estimated number of pairs,
+            pairs_per_origin, bytes (of the result), peak_bytes (while preprocess runs)
+            and seconds, and sampled_origins (the number of origins the estimate is from)
+        """
+        node_ids, offsets, neighbors, edge_costs = self.to_csr()
+        dense = dense_origins(node_ids, offsets, origins)
+        sample = np.sort(
+            np.random.default_rng(seed).choice(
+                dense, min(sample_size, len(dense)), replace=False
+            )
+        )
+        counts, seconds = sample_ball_sizes(
+            offsets,
+            neighbors,
+            edge_costs,
+            sample,
+            weight_cutoff,
+            symmetric=symmetric,
+            max_seconds=max_seconds,
+        )
+
+        pairs_per_origin = counts.mean() if len(counts) else 0.0
+        pairs = pairs_per_origin * len(dense)
+        num_impedances = 0 if impedances is None else len(impedances)
+        # int32 destinations, the weights and the impedances, plus int64 origins and offsets
+        nbytes = (
+            pairs * (4 + (1 + num_impedances) * np.dtype(weight_dtype).itemsize)
+            + (len(dense) * 2 + 1) * 8
+        )
+        return {
+            "origins": len(dense),
+            "pairs": pairs,
+            "pairs_per_origin": pairs_per_origin,
+            "bytes": nbytes,
+            # dijkstra collects the pairs in blocks of int32 nodes, float64 weights and
+            #   float64 impedances before copying them into the result
+            "peak_bytes": nbytes + pairs * (12 + num_impedances * 8),
+            "seconds": (
+                seconds / len(counts) * len(dense) / max(n_threads, 1)
+                if len(counts)
+                else 0.0
+            ),
+            "sampled_origins": len(counts),
+        }
+
+    def _add_reachability_counts(self, stats: Stats):
+        """
+        Add the number of origins, pairs and the bytes used by self.reachability to stats
+        """
+        stats.add("origins", len(self.reachability.origins))
+        stats.add("pairs", len(self.reachability))
+        stats.add("bytes", self.reachability.nbytes)
+
+    def preprocess_to_disk(
+        self,
+        weight_cutoff: float,
+        directory: str,
+        chunk_size: int = 100_000,
+        n_threads: int = 1,
+        weight_dtype=np.float64,
+        max_bytes: int = None,
+    ):
+        """
+        Same as preprocess, but for networks where the result doesn't fit in memory.  Origins
+            are processed chunk_size at a time and the result of each chunk is written to
+            directory (which should not exist yet) as soon as it's computed, so memory use is
+            bounded by the chunk size.  aggregate then works one chunk at a time, and the
+            result can be loaded again later with load_preprocessed.
+        :param weight_cutoff: See preprocess
+        :param directory: Where to write the result
+        :param chunk_size: The number of origins in each chunk
+        :param n_threads: See preprocess
+        :param weight_dtype: See preprocess
+        :param max_bytes: If passed, chunk_size is picked so that each chunk needs about
+            this much memory, using estimate_preprocess
         :return:
         """
-        self.min_weights_df = dijkstra_all_pairs(
-            self.edges.reset_index(),
-            cutoff=weight_cutoff,
-            from_nodes_col=self.from_nodes_col,
-            to_nodes_col=self.to_nodes_col,
-            edge_costs_col=self.edge_costs_col,
+        check_new_directory(directory)
+        if max_bytes is not None:
+            estimate = self.estimate_preprocess(weight_cutoff, weight_dtype, n_threads)
+            bytes_per_origin = estimate["peak_bytes"] / max(estimate["origins"], 1)
+            chunk_size = max(int(max_bytes / max(bytes_per_origin, 1)), 1)
+
+        self._set_reachability(
+            ChunkedReachability.from_csr(
+                *self.to_csr(),
+                weight_cutoff=weight_cutoff,
+                directory=directory,
+                chunk_size=chunk_size,
+                n_threads=n_threads,
+                weight_dtype=weight_dtype,
+                fingerprint=self.fingerprint(weight_cutoff, weight_dtype),
+            )
+        )
+
+    def preprocess_tiles(
+        self,
+        weight_cutoff: float,
+        directory: str,
+        tile_size: float,
+        executor: Executor = None,
+        chunk_size: int = 100_000,
+        weight_dtype=np.float64,
+    ):
+        """
+        Same as preprocess_to_disk, split across processes (or machines) for networks too
+            big for one.  The nodes are split into square tiles by their geometry, and each
+            tile is preprocessed by a worker of executor on only the part of the network
+            within weight_cutoff of it (the tile plus a halo), keeping the origins in the
+            tile.  The tiles are then merged into the same chunks as preprocess_to_disk.
+        :param weight_cutoff: See preprocess
+        :param directory: Where to write the result
+        :param tile_size: The width of the tiles, in the units of the crs of the nodes.
+            Tiles a few times wider than the distance covered by weight_cutoff keep the
+            halos, which are searched again by each tile next to them, a small part of the
+            work.
+        :param executor: See ChunkedReachability.from_tiles, by default a process per core
+        :param chunk_size: The number of origins in each chunk
+        :param weight_dtype: See preprocess
+        :return:
+        """
+        if "geometry" not in self.nodes.columns:
+            raise Exception("Nodes need point geometries to be split into tiles")
+        check_new_directory(directory)
+        geometry = self.nodes.geometry.loc[self.node_ids]
+        tiles = assign_tiles(geometry.x.to_numpy(), geometry.y.to_numpy(), tile_size)
+
+        self._set_reachability(
+            ChunkedReachability.from_tiles(
+                *self.to_csr(),
+                tiles=tiles,
+                weight_cutoff=weight_cutoff,
+                directory=directory,
+                executor=executor,
+                chunk_size=chunk_size,
+                weight_dtype=weight_dtype,
+                fingerprint=self.fingerprint(weight_cutoff, weight_dtype),
+            )
         )
-        self.weight_cutoff = weight_cutoff
 
-    def nearest_nodes(self, values_gdf: gpd.GeoDataFrame) -> pd.Series:
+    def preprocess_lazy(
+        self,
+        weight_cutoff: float,
+        max_cached_origins: int = 100_000,
+        weight_dtype=np.float64,
+    ):
         """
-        Map each point in values_gdf to its nearest node in nodes_gdf
+        Instead of computing every origin up front like preprocess, compute each origin the
+            first time it's passed to aggregate (see the origins parameter), and keep the
+            results of the max_cached_origins most recently used origins.  This is the
+            fastest option when each query only touches a small part of the network.
+        :param weight_cutoff: See preprocess
+        :param max_cached_origins: Bounds the memory used by cached results
+        :param weight_dtype: See preprocess
+        :return:
+        """
+        self._set_reachability(
+            LazyReachability(
+                *self.to_csr(),
+                weight_cutoff=weight_cutoff,
+                max_cached_origins=max_cached_origins,
+                weight_dtype=weight_dtype,
+                fingerprint=self.fingerprint(weight_cutoff, weight_dtype),
+            )
+        )
+
+    def update_edges(
+        self, edges: gpd.GeoDataFrame | pd.DataFrame, n_threads: int = 1
+    ) -> int:
+        """
+        Replace the edges of this network with an edited copy (e.g. with a street closed,
+            a bridge added or some edge costs changed) and update the result of preprocess
+            to match, without calling preprocess again.  Only the origins within
+            weight_cutoff of an edited edge are recomputed, so small edits take a fraction
+            of the time of preprocess.
+        :param edges: The full edges DataFrame after the edits, in the same format as the
+            one passed to the constructor
+        :param n_threads: See preprocess
+        :return: The number of origins that were recomputed
+        """
+        assert self.reachability is not None, "Call preprocess before updating edges"
+        assert isinstance(
+            self.reachability, Reachability
+        ), "The result of preprocess_to_disk can't be updated, call it again instead"
+
+        assert self.reachability.node_ids.equals(
+            self.node_ids
+        ), "Preprocessed data from an older version can't be updated"
+        old_from, old_to = self._from_indexes, self._to_indexes
+        old_costs = self._edge_costs(self.edges)
+        new_from, new_to = self._index_edges(edges)
+        new_costs = self._edge_costs(edges)
+        impedances = list(self.reachability.impedances)
+        if self.reachability.symmetric and not _is_symmetric(
+            new_from, new_to, new_costs
+        ):
+            raise Exception(
+                "The edges are no longer symmetric, call preprocess with symmetric=False"
+            )
+        changed = _changed_from_nodes(
+            (old_from, old_to, old_costs)
+            + tuple(np.asarray(self._edges_column(self.edges, i)) for i in impedances),
+            (new_from, new_to, new_costs)
+            + tuple(np.asarray(self._edges_column(edges, i)) for i in impedances),
+        )
+
+        # the origins that can reach a changed edge within the cutoff, before or after the
+        #   edits, found with dijkstra from the changed edges on the reversed networks
+        affected = []
+        for from_indexes, to_indexes, costs in [
+            (old_from, old_to, old_costs),
+            (new_from, new_to, new_costs),
+        ]:
+            offsets, neighbors, order = indexes_to_csr(
+                to_indexes, from_indexes, len(self.node_ids)
+            )
+            affected.append(
+                nodes_within(
+                    offsets, neighbors, costs[order], changed, self.weight_cutoff
+                )
+            )
+
+        self._set_edges(edges, new_from, new_to)
+        node_ids, offsets, neighbors, edge_costs = self.to_csr()
+        recomputed = self.reachability.recompute_origins(
+            offsets,
+            neighbors,
+            edge_costs,
+            np.union1d(*affected),
+            n_threads=n_threads,
+            edge_impedances=self._csr_impedances(impedances),
+        )
+
+        self.reachability.fingerprint = self.fingerprint(
+            self.weight_cutoff,
+            self.reachability.weights.dtype,
+            self.origins,
+            self.reachability.symmetric,
+            impedances,
+        )
+        self._set_reachability(self.reachability, self.origins)
+        return recomputed
+
+    def _set_reachability(
+        self,
+        reachability: Reachability | ChunkedReachability | LazyReachability,
+        origins: pd.Index = None,
+    ):
+        self.reachability = reachability
+        self.weight_cutoff = reachability.weight_cutoff
+        self.origins = origins
+        self._min_weights_df = None
+        # which also clears it after update_edges and load_preprocessed
+        self._accessibility_operators = OrderedDict()
+
+    def is_symmetric(self) -> bool:
+        """
+        Whether every edge has a reverse edge with the same cost, i.e. the network is
+            undirected, which is true for networks from from_osmnx_local_streets_place_query
+        """
+        return _is_symmetric(
+            self._from_indexes, self._to_indexes, self._edge_costs(self.edges)
+        )
+
+    def fingerprint(
+        self,
+        weight_cutoff: float,
+        weight_dtype=np.float64,
+        origins: pd.Index = None,
+        symmetric: bool = False,
+        impedances: list[str] = (),
+    ) -> str:
+        """
+        A hash of the from, to, edge cost and impedance columns of the edges and the
+            preprocess settings, which identifies the result of preprocess
+        """
+        edges_df = pd.DataFrame(
+            {
+                column: np.asarray(self._edges_column(self.edges, column))
+                for column in [
+                    self.from_nodes_col,
+                    self.to_nodes_col,
+                    self.edge_costs_col,
+                    *impedances,
+                ]
+            }
+        )
+        sha = hashlib.sha256()
+        sha.update(pd.util.hash_pandas_object(edges_df, index=False).to_numpy())
+        sha.update(f"{float(weight_cutoff)}-{np.dtype(weight_dtype).name}".encode())
+        if symmetric:
+            sha.update(b"symmetric")
+        if impedances:
+            sha.update(str(list(impedances)).encode())
+        if origins is not None:
+            sha.update(
+                pd.util.hash_pandas_object(
+                    pd.Series(origins.sort_values()), index=False
+                ).to_numpy()
+            )
+        return sha.hexdigest()
+
+    def save_preprocessed(self, directory: str):
+        """
+        Write the result of preprocess to a directory (which should not exist yet), so it
+            can be loaded by load_preprocessed instead of calling preprocess again
+        """
+        assert self.reachability is not None, "Call preprocess before saving it"
+        assert isinstance(
+            self.reachability, Reachability
+        ), "The result of preprocess_to_disk is already saved"
+        self.reachability.save(directory)
+
+    def load_preprocessed(self, directory: str, mmap: bool = False):
+        """
+        Read the result of preprocess written by save_preprocessed (or by
+            preprocess_to_disk).  Raises an Exception if it was computed from different edges.
+        :param mmap: Memory-map the preprocessed arrays read-only instead of reading them.
+            Loading is then nearly instant, and any number of worker processes on one host
+            share a single copy in the page cache, while aggregate works directly on the
+            mapped arrays.
+        """
+        reachability = load_reachability(directory, mmap=mmap)
+        chunk = next(reachability.chunks())
+        dtype, symmetric = chunk.weights.dtype, chunk.symmetric
+        impedances = list(chunk.impedances)
+        origins = None
+        if reachability.fingerprint != self.fingerprint(
+            reachability.weight_cutoff,
+            dtype,
+            symmetric=symmetric,
+            impedances=impedances,
+        ):
+            if isinstance(reachability, Reachability):
+                # it might have been computed for some origins (older versions only
+                #   stored the ones with out-edges)
+                requested = reachability.requested_origins
+                if requested is None:
+                    requested = reachability.origins
+                origins = reachability.node_ids.take(requested)
+            if origins is None or reachability.fingerprint != self.fingerprint(
+                reachability.weight_cutoff, dtype, origins, impedances=impedances
+            ):
+                raise Exception(
+                    "Preprocessed data was computed from different edges than this network"
+                )
+        self._set_reachability(reachability, origins)
+
+    @property
+    def min_weights_df(self) -> pd.DataFrame | None:
+        """
+        The result of preprocess as a long DataFrame with from, to and weight columns.  This
+            is built from self.reachability the first time it's used, and is kept for
+            compatibility - it uses several times the memory of self.reachability.
+        """
+        if self.reachability is None:
+            return None
+        if getattr(self, "_min_weights_df", None) is None:
+            self._min_weights_df = self.reachability.to_dataframe()
+        return self._min_weights_df
+
+    def node_index(self) -> NodeIndex:
+        """
+        The spatial index of the nodes used by nearest_nodes, which is built the first time
+            it's used and kept until self.nodes is replaced
+        """
+        if getattr(self, "_node_index_nodes", None) is not self.nodes:
+            points = self.nodes.geometry.to_crs(epsg=3857)
+            self._node_index = NodeIndex(points.x.to_numpy(), points.y.to_numpy())
+            self._node_index_nodes = self.nodes
+        return self._node_index
+
+    def nearest_nodes(
+        self, values_gdf: gpd.GeoDataFrame, max_distance: float = None
+    ) -> pd.Series:
+        """
+        Map each point in values_gdf to its nearest node in nodes_gdf.  The spatial index of
+            the nodes is built on the first call and reused after that.
 
         :param values_gdf: A GeoDataFrame (usually points) with columns for values (e.g. a
             GeoDataFrame of amenity locations, or population or jobs
+        :param max_distance: If passed, rows of values_gdf that are farther than this from
+            every node (in EPSG:3857 units, which are roughly meters) are left out
         :return: A series with the same index as values_gdf with values that come from the
             nodes GeoDataFrame of this network, i.e. the id of closest node for each row in
             values_gdf
         """
-        joined_gdf = values_gdf.to_crs(epsg=3857).sjoin_nearest(
-            self.nodes.to_crs(epsg=3857)
+        nearest = self.node_index().nearest_geometries(
+            np.asarray(values_gdf.geometry.to_crs(epsg=3857).values), max_distance
+        )
+        found = nearest >= 0
+        return pd.Series(
+            self.nodes.index.take(nearest[found]),
+            index=values_gdf.index[found],
+            name=self.nodes.index.name,
         )
 
-        if "index_right" in joined_gdf.columns:
-            # older versions of geopandas call it index_right
-            return joined_gdf["index_right"]
+    def nearest_nodes_xy(
+        self,
+        x: np.array,
+        y: np.array,
+        crs: str = "EPSG:4326",
+        max_distance: float = None,
+    ) -> pd.Series:
+        """
+        Same as nearest_nodes, but for arrays of point coordinates, which skips building
+            geometries when snapping millions of points
+        :param x: Longitudes (or x coordinates in crs)
+        :param y: Latitudes (or y coordinates in crs)
+        :param crs: The crs of x and y
+        :param max_distance: See nearest_nodes
+        :return: A series of node ids indexed by position in x and y
+        """
+        import pyproj
 
-        return joined_gdf[self.nodes.index.name]
+        x, y = pyproj.Transformer.from_crs(crs, "EPSG:3857", always_xy=True).transform(
+            np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        )
+        nearest = self.node_index().nearest(x, y, max_distance)
+        found = np.flatnonzero(nearest >= 0)
+        return pd.Series(
+            self.nodes.index.take(nearest[found]),
+            index=found,
+            name=self.nodes.index.name,
+        )
 
     def aggregate(
         self,
-        values: pd.Series,
+        values: pd.Series | pd.DataFrame,
         decay_func: PandanaDecayFunction,
         aggregation: Aggregation | dict[str, Aggregation],
+        origins: pd.Index | list = None,
+        stats: Stats = None,
     ) -> pd.Series | pd.DataFrame:
         """
         Perform a network-based aggregation - this is the whole point of this python library.
+            The time of each stage and counts of the work done are added to stats, which
+            belongs to one call, so concurrent calls (e.g. aggregate_async) each pass their
+            own.
         :param values: A series where the index is node_ids from the node dataframe and the
             values are floating point values you want to aggregate.  In other words, it's the
             values and the node_ids they are located at.  node_ids can and likely will be
-            repeated in the index (i.e. not unique).
+            repeated in the index (i.e. not unique).  Pass a DataFrame to aggregate every
+            column at once, which is much faster than one column at a time.
         :param decay_func: Typically one of the decay functions in this module, e.g.
             linear_decay, no_decay, etc., and can be customized.
-        :param aggregation: Anything you can pass to `.agg`  i.e. 'sum' or 'np.sum', etc.
+        :param aggregation: One of 'sum', 'mean', 'min', 'max', 'median', 'std' or 'count', or
+            a dict of output column names to aggregations to compute several at once.
+        :param origins: Only compute these origin node ids, which is required for
+            preprocess_lazy to avoid computing every origin.
+        :param stats: A Stats to add the work of this call to
         :return: A series indexed by all the origin node ids in 'self.nodes' with values computed
-            for this aggregation.
+            for this aggregation.  A DataFrame is returned if aggregation is a dict (one column
+            per aggregation) or values is a DataFrame (one column per values column), and
+            if both, the columns are a MultiIndex of (values column, aggregation).
         """
         assert isinstance(
-            values, pd.Series
-        ), "Values should be a Series (see docstring)"
-
-        assert values.index.isin(
-            self.nodes.index
-        ).all(), "Values should have an index which maps to the nodes DataFrame"
+            values, (pd.Series, pd.DataFrame)
+        ), "Values should be a Series or DataFrame (see docstring)"
 
-        # these column names are returned by the dijkstra function
-        weight_col = "weight"
-        origin_node_id_col = "from"
-        destination_node_id_col = "to"
+        stats = Stats("aggregate") if stats is None else stats
+        with stats.stage("validate"):
+            assert values.index.isin(
+                self.nodes.index
+            ).all(), "Values should have an index which maps to the nodes DataFrame"
 
-        # these column names are just internal to this function
-        values_col = "values"
-        decayed_weights_col = "decayed_weights"
-
-        if decay_func.max_weight > self.weight_cutoff:
+        impedance = self._impedance(decay_func)
+        if impedance is None and decay_func.max_weight > self.weight_cutoff:
             raise Exception(
                 "Decay function has a max weight greater than the value passed to preprocess"
             )
 
-        # for performance, we apply the max_weight filter first
-        filtered_weights = self.min_weights_df[
-            decay_func.mask(self.min_weights_df[weight_col])
-        ]
-
-        merged_df = filtered_weights.merge(
-            pd.DataFrame({values_col: values}),
-            how="inner",
-            left_on=destination_node_id_col,
-            right_index=True,
+        values_df = values if isinstance(values, pd.DataFrame) else values.to_frame()
+        aggregations = (
+            aggregation if isinstance(aggregation, dict) else {"values": aggregation}
+        )
+        reachability = self.reachability
+        if origins is not None:
+            with stats.stage("select_origins"):
+                origins = pd.Index(origins)
+                assert origins.isin(
+                    self.nodes.index
+                ).all(), "Origins should be ids from the nodes DataFrame"
+                indexes = reachability.node_ids.get_indexer(origins)
+                reachability = reachability.select_origins(indexes[indexes >= 0])
+        out_df = aggregate_reachability(
+            reachability, values_df, decay_func, aggregations, stats, impedance
         )
 
-        merged_df[decayed_weights_col] = decay_func.weights(merged_df[weight_col])
+        if isinstance(values, pd.DataFrame):
+            if isinstance(aggregation, dict):
+                return out_df
+            return out_df.droplevel(1, axis=1)
 
+        out_df = out_df.droplevel(0, axis=1)
         if isinstance(aggregation, dict):
-            # support multiple aggregation with one merge dataframe
-            return pd.DataFrame(
-                {
-                    k: do_single_aggregation(
-                        merged_df=merged_df,
-                        values_col=values_col,
-                        origin_node_id_col=origin_node_id_col,
-                        decayed_weights_col=decayed_weights_col,
-                        aggregation=v,
-                    )
-                    for k, v in aggregation.items()
-                }
-            )
-        else:
-            return do_single_aggregation(
-                merged_df=merged_df,
-                values_col=values_col,
-                origin_node_id_col=origin_node_id_col,
-                decayed_weights_col=decayed_weights_col,
-                aggregation=aggregation,
+            return out_df
+        return out_df["values"].rename(None)
+
+    async def aggregate_async(
+        self,
+        values: pd.Series | pd.DataFrame,
+        decay_func: PandanaDecayFunction,
+        aggregation: Aggregation | dict[str, Aggregation],
+        origins: pd.Index | list = None,
+        executor: Executor = None,
+        stats: Stats = None,
+    ) -> pd.Series | pd.DataFrame:
+        """
+        aggregate for asyncio code (e.g. a web service), which runs it in a thread so the
+            event loop keeps serving other requests meanwhile
+        :param executor: The thread pool to run in, by default the event loop's default
+            executor.  Pass a ThreadPoolExecutor with one thread per core to run that many
+            aggregations in parallel.
+        """
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(
+            executor,
+            functools.partial(
+                self.aggregate, values, decay_func, aggregation, origins, stats
+            ),
+        )
+
+    def accessibility_operator(
+        self, decay_func: PandanaDecayFunction
+    ) -> AccessibilityOperator:
+        """
+        Get the sparse (origins x nodes) matrix of decayed weights for decay_func, which
+            computes weighted sums and means of many scenarios (columns of a values DataFrame)
+            at once, and much faster than aggregate when the same decay_func is used over and
+            over.  The last MAX_ACCESSIBILITY_OPERATORS operators are cached (by
+            decay_func.cache_key, so equal built-in decay functions share one) until the
+            reachability changes.
+        """
+        impedance = self._impedance(decay_func)
+        if impedance is None and decay_func.max_weight > self.weight_cutoff:
+            raise Exception(
+                "Decay function has a max weight greater than the value passed to preprocess"
             )
 
+        operators = self._accessibility_operators
+        key = decay_func.cache_key()
+        with self._lock:
+            operator = operators.get(key)
+            if operator is not None:
+                operators.move_to_end(key)
+                return operator
+        # built without the lock, so another thread may build the same one meanwhile
+        operator = AccessibilityOperator(self.reachability, decay_func, impedance)
+        with self._lock:
+            operator = operators.setdefault(key, operator)
+            operators.move_to_end(key)
+            while len(operators) > MAX_ACCESSIBILITY_OPERATORS:
+                operators.popitem(last=False)
+        return operator
+
+    def _impedance(self, decay_func: PandanaDecayFunction) -> str | None:
+        """
+        The impedance passed to preprocess which decay_func uses, or None for the weights
+            (i.e. edge_costs_col).  The pairs only go as far as weight_cutoff in the
+            weights, so max_weight can't be checked against it for other impedances.
+        """
+        if decay_func.impedance in (None, self.edge_costs_col):
+            return None
+        return decay_func.impedance
+
     def write(self, edges_filename: str, nodes_filename: str):
         """
         Write this object to 2 geoparquet files
@@ -202,6 +937,8 @@ class PandanaNetwork:
         """
         Read a PandanaNetwork from 2 parquet files
         """
+        import geopandas as gpd
+
         return PandanaNetwork(
             edges=gpd.read_parquet(edges_filename),
             nodes=gpd.read_parquet(nodes_filename),
@@ -215,6 +952,8 @@ class PandanaNetwork:
         """
         Use osmnx to grab local street network using settings appropriate for this library
         """
+        import osmnx
+
         osmnx.settings.bidirectional_network_types = ["drive"]
         graph = osmnx.graph_from_place(
             place_query,
@@ -227,3 +966,44 @@ class PandanaNetwork:
             edges=edges.reset_index(level=2, drop=True)[["length", "geometry"]],
             nodes=nodes[["geometry"]],
         )
+
+
+def _changed_from_nodes(
+    edges: tuple[np.array, ...],
+    new_edges: tuple[np.array, ...],
+) -> np.array:
+    """
+    The dense "from" node indexes of every edge (a tuple of from indexes, to indexes and
+        costs, then any impedances) which is in only one of edges and new_edges (counting
+        duplicate edges), i.e. edges that were added, removed or changed cost
+    """
+    edges_df = pd.DataFrame(dict(enumerate(edges))).rename(columns={0: "from"})
+    new_edges_df = pd.DataFrame(dict(enumerate(new_edges))).rename(columns={0: "from"})
+    hashes = pd.util.hash_pandas_object(edges_df, index=False)
+    new_hashes = pd.util.hash_pandas_object(new_edges_df, index=False)
+    diff = hashes.value_counts().sub(new_hashes.value_counts(), fill_value=0)
+    changed = diff.index[diff != 0]
+
+    return np.unique(
+        np.concatenate(
+            [
+                edges_df["from"][hashes.isin(changed)].to_numpy(),
+                new_edges_df["from"][new_hashes.isin(changed)].to_numpy(),
+            ]
+        )
+    ).astype(np.int64)
+
+
+def _is_symmetric(
+    from_indexes: np.array, to_indexes: np.array, edge_costs: np.array
+) -> bool:
+    """
+    Whether the edges (reversed) are the same as the edges
+    """
+    order = np.lexsort((edge_costs, to_indexes, from_indexes))
+    reverse_order = np.lexsort((edge_costs, from_indexes, to_indexes))
+    return (
+        np.array_equal(from_indexes[order], to_indexes[reverse_order])
+        and np.array_equal(to_indexes[order], from_indexes[reverse_order])
+        and np.array_equal(edge_costs[order], edge_costs[reverse_order])
+    )
@@ -0,0 +1,1081 @@
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Callable
+
+import numba
+import numpy as np
+import pandas as pd
+
+from pandana2.dijkstra import (
+    DijkstraScratch,
+    dijkstra_from_sources,
+    nodes_within,
+    subgraph_csr,
+)
+
+# the number of tiles submitted to the executor by ChunkedReachability.from_tiles before
+#   it waits for one to finish, which bounds the memory used by their subgraphs
+MAX_PENDING_TILES = 64
+
+# how many max_weights a Reachability keeps the prefix_ends of
+MAX_PREFIX_ENDS = 16
+
+
+class Reachability:
+    """
+    Compact storage of the result of preprocessing, i.e. every node within weight_cutoff of
+        each origin node and the shortest path weight to it.  Nodes are stored as dense int32
+        indexes into node_ids, and the destinations of origins[i] are
+        destinations[offsets[i]:offsets[i + 1]], sorted by weight.  This takes 8 bytes per
+        pair by default (or 12 for float64 weights) instead of the 24+ of a long DataFrame.
+        For undirected networks, symmetric objects only store the destinations that are >=
+        each origin, which halves the memory used, since the weight from b to a is the same
+        as from a to b (see expand).  Other costs of each pair (e.g. travel time, when the
+        weights are lengths) can be stored in impedances, see from_csr.
+    """
+
+    node_ids: pd.Index
+    origins: np.array
+    offsets: np.array
+    destinations: np.array
+    weights: np.array
+    weight_cutoff: float
+    # identifies the edges and settings this was computed from, see
+    #   PandanaNetwork.fingerprint
+    fingerprint: str = None
+    symmetric: bool = False
+    # impedance name -> the other cost of each pair along its shortest path by weight
+    impedances: dict[str, np.array]
+    # the dense indexes of the origins that were asked for, including the ones without
+    #   out-edges (which aren't in origins until they get one), or None for every node
+    requested_origins: np.array = None
+
+    # the arrays written by save, one .npy file each
+    ARRAYS = ["origins", "offsets", "destinations", "weights"]
+
+    # max_weight -> the results of prefix_ends, in order of use
+    _prefix_ends: OrderedDict
+    # held while _prefix_ends is read or changed
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        node_ids: pd.Index,
+        origins: np.array,
+        offsets: np.array,
+        destinations: np.array,
+        weights: np.array,
+        weight_cutoff: float,
+        fingerprint: str = None,
+        symmetric: bool = False,
+        impedances: dict[str, np.array] = None,
+        requested_origins: np.array = None,
+    ):
+        """
+        :param node_ids: Maps dense node indexes to node ids
+        :param origins: Dense indexes of the origin nodes, sorted ascending
+        :param offsets: len(origins) + 1 offsets into destinations and weights
+        :param destinations: Dense indexes of the nodes reachable from each origin
+        :param weights: Shortest path weight from the origin to each destination
+        :param weight_cutoff: The cutoff that was passed to dijkstra
+        :param fingerprint: Identifies the edges and settings this was computed from
+        :param symmetric: Whether only destinations >= each origin are stored
+        :param impedances: Other costs of each pair, by name
+        :param requested_origins: Sorted dense indexes of the origins that were asked for,
+            which are kept up to date by recompute_origins, or None for every node
+        """
+        impedances = {} if impedances is None else impedances
+        assert len(offsets) == len(origins) + 1, "Need one more offset than origins"
+        assert all(
+            len(destinations) == len(array) == offsets[-1]
+            for array in [weights, *impedances.values()]
+        ), "destinations, weights and impedances should have offsets[-1] elements"
+        assert not (symmetric and impedances), "Symmetric objects can't have impedances"
+
+        self.node_ids = node_ids
+        self.origins = origins
+        self.offsets = offsets
+        self.destinations = destinations
+        self.weights = weights
+        self.weight_cutoff = weight_cutoff
+        self.fingerprint = fingerprint
+        self.symmetric = symmetric
+        self.impedances = impedances
+        self.requested_origins = requested_origins
+        self._prefix_ends = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_csr(
+        node_ids: pd.Index,
+        offsets: np.array,
+        neighbors: np.array,
+        edge_costs: np.array,
+        origins: np.array,
+        weight_cutoff: float,
+        n_threads: int = 1,
+        weight_dtype=np.float64,
+        symmetric: bool = False,
+        progress: Callable[[int, int], None] = None,
+        edge_impedances: dict[str, np.array] = None,
+        scratch: DijkstraScratch = None,
+    ):
+        """
+        Run dijkstra from each of origins (sorted dense node indexes) on the CSR arrays
+            returned by edges_to_csr
+        :param symmetric: Store each pair once, which is only correct if every edge has a
+            reverse edge with the same cost and origins is every node with edges
+        :param progress: See dijkstra_from_sources
+        :param edge_impedances: Other costs of the edges by name (in the same order as
+            edge_costs), which are summed along the shortest paths by edge_costs and stored
+            in impedances.  This is much cheaper than running dijkstra for each cost.
+        :param scratch: See dijkstra_from_sources
+        """
+        edge_impedances = {} if edge_impedances is None else edge_impedances
+        counts, destinations, weights, impedances = dijkstra_from_sources(
+            offsets,
+            neighbors,
+            edge_costs,
+            origins,
+            weight_cutoff,
+            n_threads=n_threads,
+            weight_dtype=weight_dtype,
+            symmetric=symmetric,
+            progress=progress,
+            edge_impedances=np.column_stack(
+                [np.empty((len(edge_costs), 0))] + list(edge_impedances.values())
+            ),
+            scratch=scratch,
+        )
+
+        return Reachability(
+            node_ids=node_ids,
+            origins=origins,
+            offsets=np.concatenate([[0], np.cumsum(counts)]),
+            destinations=destinations,
+            weights=weights,
+            weight_cutoff=weight_cutoff,
+            symmetric=symmetric,
+            impedances=dict(zip(edge_impedances, impedances)),
+        )
+
+    def recompute_origins(
+        self,
+        offsets: np.array,
+        neighbors: np.array,
+        edge_costs: np.array,
+        affected: np.array,
+        n_threads: int = 1,
+        edge_impedances: dict[str, np.array] = None,
+    ) -> int:
+        """
+        Update this object in place after some edges are edited (which doesn't change the
+            nodes), by running dijkstra again on the new CSR arrays from just the affected
+            origins (dense node indexes).  Every other origin keeps its current result.
+            Edits can add or remove origins, by giving one of requested_origins its first
+            out-edge or removing its last.
+        :param edge_impedances: The other costs of the edges, for each of impedances
+        :return: The number of origins that were recomputed
+        """
+        assert set(edge_impedances or {}) == set(
+            self.impedances
+        ), "Pass the edge costs of every impedance"
+        has_edges = np.diff(offsets) > 0
+        if self.requested_origins is None:
+            origins = np.flatnonzero(has_edges)
+        else:
+            origins = self.requested_origins[has_edges[self.requested_origins]]
+        keep = ~np.isin(self.origins, affected)
+        affected = np.intersect1d(affected, origins)
+        patch = Reachability.from_csr(
+            self.node_ids,
+            offsets,
+            neighbors,
+            edge_costs,
+            affected,
+            self.weight_cutoff,
+            n_threads=n_threads,
+            weight_dtype=self.weights.dtype,
+            symmetric=self.symmetric,
+            edge_impedances=edge_impedances,
+        )
+        self._splice(keep, patch)
+        return len(affected)
+
+    def _splice(self, keep: np.array, patch: "Reachability"):
+        """
+        Replace the arrays of this object with its origins where keep is True merged with
+            all of the origins in patch, which shouldn't overlap
+        """
+        counts = np.diff(self.offsets)
+        origins = np.concatenate([self.origins[keep], patch.origins])
+        starts = np.concatenate(
+            [self.offsets[:-1][keep], patch.offsets[:-1] + len(self)]
+        )
+        counts = np.concatenate([counts[keep], np.diff(patch.offsets)])
+
+        order = np.argsort(origins, kind="stable")
+        origins = origins[order]
+        offsets, take = _gather_segments(starts[order], counts[order])
+
+        self.node_ids = patch.node_ids
+        self.origins = origins
+        self.offsets = offsets
+        self.destinations = np.concatenate([self.destinations, patch.destinations])[
+            take
+        ]
+        self.weights = np.concatenate([self.weights, patch.weights])[take]
+        self.impedances = {
+            name: np.concatenate([array, patch.impedances[name]])[take]
+            for name, array in self.impedances.items()
+        }
+        with self._lock:
+            self._prefix_ends.clear()
+
+    def prefix_ends(self, max_weight: float) -> np.array:
+        """
+        For each origin, the end of the prefix of its segment with weights less than
+            max_weight, which is found by binary search because segments are sorted by
+            weight.  The last MAX_PREFIX_ENDS are cached, so using the same few max_weights
+            over and over (e.g. 500, 1000 and 1500 meters) costs nothing after the first time.
+        """
+        # compared in the dtype of the weights, like weights < max_weight in numpy
+        max_weight = self.weights.dtype.type(max_weight)
+        with self._lock:
+            ends = self._prefix_ends.get(max_weight)
+            if ends is not None:
+                self._prefix_ends.move_to_end(max_weight)
+                return ends
+        ends = _prefix_ends(self.offsets, self.weights, max_weight)
+        with self._lock:
+            self._prefix_ends[max_weight] = ends
+            while len(self._prefix_ends) > MAX_PREFIX_ENDS:
+                self._prefix_ends.popitem(last=False)
+        return ends
+
+    def prefix_indexes(
+        self, max_weight: float, impedance: str = None
+    ) -> tuple[np.array, np.array]:
+        """
+        The offsets of the pairs with weights less than max_weight if they were stored
+            on their own, and the indexes of those pairs in destinations and weights (or a
+            slice of everything, if that's all of them)
+        :param impedance: Use this impedance instead of the weights.  Pairs aren't sorted
+            by other impedances, so the pairs of each origin that are selected aren't a
+            prefix of its segment (unlike for the weights).
+        """
+        if impedance is not None:
+            return self.mask_indexes(self.impedance_weights(impedance) < max_weight)
+
+        ends = self.prefix_ends(max_weight)
+        if np.array_equal(ends, self.offsets[1:]):
+            # every pair is within max_weight, so there is nothing to copy
+            return self.offsets, slice(None)
+        starts = self.offsets[:-1]
+        return _gather_segments(starts, ends - starts)
+
+    def mask_indexes(self, within: np.array) -> tuple[np.array, np.array]:
+        """
+        Same as prefix_indexes, for the pairs where within (a boolean array aligned with
+            destinations) is True
+        """
+        positions = np.concatenate([[0], np.cumsum(within)])
+        return positions[self.offsets], np.flatnonzero(within)
+
+    def prefix_offsets(self, max_weight: float) -> np.array:
+        """
+        The offsets of the pairs with weights less than max_weight if they were stored on
+            their own, i.e. the first part of prefix_indexes without the indexes
+        """
+        counts = self.prefix_ends(max_weight) - self.offsets[:-1]
+        return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def impedance_weights(self, impedance: str = None) -> np.array:
+        """
+        The weights, or the other costs of an impedance, of every pair
+        """
+        if impedance is None:
+            return self.weights
+        if impedance not in self.impedances:
+            raise Exception(f"Impedance '{impedance}' wasn't passed to preprocess")
+        return self.impedances[impedance]
+
+    def select_origins(self, origins: np.array) -> "Reachability":
+        """
+        A Reachability with only the origins (dense node indexes) that are in both origins
+            and this object
+        """
+        if self.symmetric:
+            return self.expand(origins)
+
+        positions = np.flatnonzero(np.isin(self.origins, origins))
+        offsets, take = _gather_segments(
+            self.offsets[positions], np.diff(self.offsets)[positions]
+        )
+        return Reachability(
+            node_ids=self.node_ids,
+            origins=self.origins[positions],
+            offsets=offsets,
+            destinations=self.destinations[take],
+            weights=self.weights[take],
+            weight_cutoff=self.weight_cutoff,
+            impedances={name: array[take] for name, array in self.impedances.items()},
+        )
+
+    def select_range(self, start: int, end: int) -> "Reachability":
+        """
+        A Reachability with the origins from position start to end of this object
+        """
+        first, last = self.offsets[start], self.offsets[end]
+        return Reachability(
+            node_ids=self.node_ids,
+            origins=self.origins[start:end],
+            offsets=self.offsets[start : end + 1] - first,
+            destinations=self.destinations[first:last],
+            weights=self.weights[first:last],
+            weight_cutoff=self.weight_cutoff,
+            impedances={
+                name: array[first:last] for name, array in self.impedances.items()
+            },
+        )
+
+    def expand(self, origins: np.array = None) -> "Reachability":
+        """
+        The Reachability with both directions of every pair of this symmetric one, for all
+            origins or just some origins (dense node indexes)
+        """
+        assert self.symmetric, "Only symmetric Reachability objects can be expanded"
+        pair_origins = self.origin_indexes()
+        forward = np.ones(len(self), dtype=bool)
+        backward = self.destinations != pair_origins
+        if origins is not None:
+            forward &= np.isin(pair_origins, origins)
+            backward &= np.isin(self.destinations, origins)
+
+        from_nodes = np.concatenate(
+            [pair_origins[forward], self.destinations[backward]]
+        ).astype(np.int64)
+        to_nodes = np.concatenate([self.destinations[forward], pair_origins[backward]])
+        weights = np.concatenate([self.weights[forward], self.weights[backward]])
+        order = np.lexsort((to_nodes, weights, from_nodes))
+
+        expanded_origins, counts = np.unique(from_nodes, return_counts=True)
+        return Reachability(
+            node_ids=self.node_ids,
+            origins=expanded_origins,
+            offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            destinations=to_nodes[order].astype(np.int32),
+            weights=weights[order],
+            weight_cutoff=self.weight_cutoff,
+        )
+
+    @staticmethod
+    def concatenate(reachabilities: list["Reachability"]) -> "Reachability":
+        """
+        Join Reachability objects for consecutive ranges of origins into one
+        """
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for reachability in reachabilities:
+            offsets.append(offsets[-1][-1] + reachability.offsets[1:])
+
+        return Reachability(
+            node_ids=reachabilities[0].node_ids,
+            origins=np.concatenate([r.origins for r in reachabilities]),
+            offsets=np.concatenate(offsets),
+            destinations=np.concatenate([r.destinations for r in reachabilities]),
+            weights=np.concatenate([r.weights for r in reachabilities]),
+            weight_cutoff=reachabilities[0].weight_cutoff,
+            impedances={
+                name: np.concatenate([r.impedances[name] for r in reachabilities])
+                for name in reachabilities[0].impedances
+            },
+        )
+
+    def __len__(self):
+        return len(self.destinations)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory used by the arrays of this object (not including node_ids)
+        """
+        return (
+            self.origins.nbytes
+            + self.offsets.nbytes
+            + self.destinations.nbytes
+            + self.weights.nbytes
+            + sum(array.nbytes for array in self.impedances.values())
+        )
+
+    def chunks(self):
+        """
+        Iterate over the Reachability objects that make up this one, which is just this one
+            (see ChunkedReachability)
+        """
+        yield self
+
+    def origin_indexes(self) -> np.array:
+        """
+        The dense index of the origin of every pair, i.e. the "from" column
+        """
+        return np.repeat(self.origins, np.diff(self.offsets))
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        The long from / to / weight DataFrame with node ids, ordered by "from" then "weight",
+            with a column for each impedance
+        """
+        if self.symmetric:
+            return self.expand().to_dataframe()
+        return pd.DataFrame(
+            {
+                "from": self.node_ids.take(self.origin_indexes()),
+                "to": self.node_ids.take(self.destinations),
+                "weight": self.weights,
+                **self.impedances,
+            }
+        )
+
+    def save(self, directory: str):
+        """
+        Write this object to a directory with one .npy file per array and a metadata.json.
+            The directory is written under a temporary name and then renamed, so other
+            processes never see a partially written directory.
+        """
+        with _writing_directory(directory) as tmp_directory:
+            self._save_arrays(tmp_directory)
+            _save_metadata(
+                tmp_directory,
+                self.node_ids,
+                weight_cutoff=self.weight_cutoff,
+                fingerprint=self.fingerprint,
+                symmetric=self.symmetric,
+                impedances=list(self.impedances),
+                requested_origins=self.requested_origins is not None,
+            )
+            if self.requested_origins is not None:
+                np.save(
+                    os.path.join(tmp_directory, "requested_origins.npy"),
+                    self.requested_origins,
+                )
+
+    def _save_arrays(self, directory: str, prefix: str = ""):
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, f"{prefix}{name}.npy"), getattr(self, name))
+        # impedance names can be any column name, so the files are numbered instead
+        for i, array in enumerate(self.impedances.values()):
+            np.save(os.path.join(directory, f"{prefix}impedance_{i}.npy"), array)
+
+    @staticmethod
+    def load(directory: str, mmap: bool = False):
+        """
+        Read a Reachability written by save
+        :param mmap: Memory-map the arrays read-only instead of reading them into memory.  The
+            OS then only reads the pages that are used, and every process that maps the same
+            files on a host shares one copy of them in the page cache.
+        """
+        node_ids, metadata = _load_metadata(directory)
+        reachability = Reachability._load_arrays(
+            directory,
+            node_ids,
+            weight_cutoff=metadata["weight_cutoff"],
+            fingerprint=metadata["fingerprint"],
+            mmap=mmap,
+            symmetric=metadata.get("symmetric", False),
+            impedances=metadata.get("impedances", []),
+        )
+        if metadata.get("requested_origins", False):
+            reachability.requested_origins = np.load(
+                os.path.join(directory, "requested_origins.npy")
+            )
+        return reachability
+
+    @staticmethod
+    def _load_arrays(
+        directory: str,
+        node_ids: pd.Index,
+        weight_cutoff: float,
+        fingerprint: str,
+        mmap: bool,
+        prefix: str = "",
+        symmetric: bool = False,
+        impedances: list[str] = (),
+    ):
+        def load(name: str) -> np.array:
+            return np.load(
+                os.path.join(directory, f"{prefix}{name}.npy"),
+                mmap_mode="r" if mmap else None,
+            )
+
+        return Reachability(
+            node_ids=node_ids,
+            **{name: load(name) for name in Reachability.ARRAYS},
+            weight_cutoff=weight_cutoff,
+            fingerprint=fingerprint,
+            symmetric=symmetric,
+            impedances={
+                impedance: load(f"impedance_{i}")
+                for i, impedance in enumerate(impedances)
+            },
+        )
+
+
+class ChunkedReachability:
+    """
+    A Reachability which is stored on disk in chunks of consecutive origins, for networks
+        where all the pairs don't fit in memory.  Each chunk is memory-mapped when it's used,
+        so only one chunk at a time needs to be in memory.  Build one with
+        ChunkedReachability.from_csr (or PandanaNetwork.preprocess_to_disk), or with
+        from_tiles, which preprocesses each spatial tile separately.
+    """
+
+    directory: str
+    node_ids: pd.Index
+    weight_cutoff: float
+    fingerprint: str = None
+    chunk_lengths: list[int]
+
+    def __init__(
+        self,
+        directory: str,
+        node_ids: pd.Index,
+        weight_cutoff: float,
+        chunk_lengths: list[int],
+        fingerprint: str = None,
+    ):
+        self.directory = directory
+        self.node_ids = node_ids
+        self.weight_cutoff = weight_cutoff
+        self.chunk_lengths = chunk_lengths
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def from_csr(
+        node_ids: pd.Index,
+        offsets: np.array,
+        neighbors: np.array,
+        edge_costs: np.array,
+        weight_cutoff: float,
+        directory: str,
+        chunk_size: int = 100_000,
+        n_threads: int = 1,
+        weight_dtype=np.float64,
+        fingerprint: str = None,
+    ):
+        """
+        Run dijkstra from every node with out-edges in the CSR arrays returned by
+            edges_to_csr, chunk_size origins at a time, writing the result of each chunk to
+            directory (which should not exist yet) as soon as it's computed, so memory use is
+            bounded by the chunk size
+        """
+        origins = dense_origins(node_ids, offsets)
+
+        chunk_lengths = []
+        with _writing_directory(directory) as tmp_directory:
+            for start in range(0, len(origins), chunk_size):
+                chunk = Reachability.from_csr(
+                    node_ids,
+                    offsets,
+                    neighbors,
+                    edge_costs,
+                    origins[start : start + chunk_size],
+                    weight_cutoff,
+                    n_threads=n_threads,
+                    weight_dtype=weight_dtype,
+                )
+                chunk._save_arrays(
+                    tmp_directory, prefix=_chunk_prefix(len(chunk_lengths))
+                )
+                chunk_lengths.append(len(chunk))
+
+            _save_metadata(
+                tmp_directory,
+                node_ids,
+                weight_cutoff=weight_cutoff,
+                fingerprint=fingerprint,
+                chunk_lengths=chunk_lengths,
+            )
+
+        return ChunkedReachability(
+            directory, node_ids, weight_cutoff, chunk_lengths, fingerprint
+        )
+
+    @staticmethod
+    def from_tiles(
+        node_ids: pd.Index,
+        offsets: np.array,
+        neighbors: np.array,
+        edge_costs: np.array,
+        tiles: np.array,
+        weight_cutoff: float,
+        directory: str,
+        executor: Executor = None,
+        chunk_size: int = 100_000,
+        weight_dtype=np.float64,
+        fingerprint: str = None,
+    ):
+        """
+        Same as from_csr, with the origins in each tile computed by a worker of executor on
+            only the nodes within weight_cutoff of the tile (the tile plus its halo).  The
+            tiles are then merged into chunks of chunk_size origins, so the result is
+            identical to from_csr.
+        :param tiles: The tile of each node (see spatial.assign_tiles)
+        :param executor: Runs the tiles, by default in a ProcessPoolExecutor with a worker
+            per core.  Any concurrent.futures Executor works, as long as its workers can
+            write to directory.
+        """
+        origins = dense_origins(node_ids, offsets)
+        origin_tiles = tiles[origins]
+        order = np.argsort(origin_tiles, kind="stable")
+        tile_origins = np.split(
+            origins[order], np.cumsum(np.bincount(origin_tiles))[:-1]
+        )
+
+        own_executor = executor is None
+        executor = ProcessPoolExecutor() if own_executor else executor
+        futures = []
+        try:
+            with _writing_directory(directory) as tmp_directory:
+                tiles_directory = os.path.join(tmp_directory, "tiles")
+                os.makedirs(tiles_directory)
+                try:
+                    pending = set()
+                    for origins in tile_origins:
+                        if len(origins) == 0:
+                            continue
+                        nodes = nodes_within(
+                            offsets, neighbors, edge_costs, origins, weight_cutoff
+                        )
+                        future = executor.submit(
+                            _preprocess_tile,
+                            tiles_directory,
+                            _chunk_prefix(len(futures)),
+                            nodes,
+                            *subgraph_csr(offsets, neighbors, edge_costs, nodes),
+                            np.searchsorted(nodes, origins),
+                            weight_cutoff,
+                            weight_dtype,
+                        )
+                        futures.append(future)
+                        pending.add(future)
+                        if len(pending) >= MAX_PENDING_TILES:
+                            _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    # stop the other tiles before their directory is removed
+                    for future in futures:
+                        future.cancel()
+                    wait(futures)
+                    raise
+
+                chunk_lengths = _merge_tiles(
+                    tiles_directory,
+                    len(futures),
+                    node_ids,
+                    weight_cutoff,
+                    tmp_directory,
+                    chunk_size,
+                )
+                shutil.rmtree(tiles_directory)
+
+                _save_metadata(
+                    tmp_directory,
+                    node_ids,
+                    weight_cutoff=weight_cutoff,
+                    fingerprint=fingerprint,
+                    chunk_lengths=chunk_lengths,
+                )
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+        return ChunkedReachability(
+            directory, node_ids, weight_cutoff, chunk_lengths, fingerprint
+        )
+
+    @staticmethod
+    def load(directory: str):
+        node_ids, metadata = _load_metadata(directory)
+        return ChunkedReachability(
+            directory,
+            node_ids,
+            weight_cutoff=metadata["weight_cutoff"],
+            chunk_lengths=metadata["chunk_lengths"],
+            fingerprint=metadata["fingerprint"],
+        )
+
+    def __len__(self):
+        return sum(self.chunk_lengths)
+
+    def chunks(self):
+        """
+        Iterate over the chunks, each of which is a memory-mapped Reachability for some of
+            the origins
+        """
+        for i in range(len(self.chunk_lengths)):
+            yield Reachability._load_arrays(
+                self.directory,
+                self.node_ids,
+                weight_cutoff=self.weight_cutoff,
+                fingerprint=self.fingerprint,
+                mmap=True,
+                prefix=_chunk_prefix(i),
+            )
+
+    def select_origins(self, origins: np.array) -> Reachability:
+        """
+        See Reachability.select_origins
+        """
+        return Reachability.concatenate(
+            [chunk.select_origins(origins) for chunk in self.chunks()]
+        )
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        The long from / to / weight DataFrame with node ids, which needs to fit in memory
+        """
+        return pd.concat(
+            [chunk.to_dataframe() for chunk in self.chunks()], ignore_index=True
+        )
+
+
+class LazyReachability:
+    """
+    A Reachability which runs dijkstra from each origin the first time it's used (by
+        select_origins), and keeps the results for up to max_cached_origins origins,
+        dropping the least recently used ones first.  This is much faster than computing
+        every origin up front when only a small part of the network is ever queried.  It's
+        safe to use from several threads at once.
+    """
+
+    node_ids: pd.Index
+    weight_cutoff: float
+    fingerprint: str = None
+    max_cached_origins: int
+    weight_dtype: np.dtype
+    # the CSR arrays from edges_to_csr
+    offsets: np.array
+    neighbors: np.array
+    edge_costs: np.array
+    # dense origin index -> (destinations, weights), in order of use
+    _cache: OrderedDict
+    # held while _cache is read or changed, but not while dijkstra runs
+    _lock: threading.Lock
+    # scratches not in use by a thread, see _compute
+    _scratches: list[DijkstraScratch]
+
+    def __init__(
+        self,
+        node_ids: pd.Index,
+        offsets: np.array,
+        neighbors: np.array,
+        edge_costs: np.array,
+        weight_cutoff: float,
+        max_cached_origins: int = 100_000,
+        weight_dtype=np.float64,
+        fingerprint: str = None,
+    ):
+        self.node_ids = node_ids
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.edge_costs = edge_costs
+        self.weight_cutoff = weight_cutoff
+        self.max_cached_origins = max_cached_origins
+        self.weight_dtype = np.dtype(weight_dtype)
+        self.fingerprint = fingerprint
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._scratches = []
+
+    def _compute(self, origins: np.array) -> Reachability:
+        # each thread takes a scratch of its own, which is kept for the next call
+        with self._lock:
+            scratch = (
+                self._scratches.pop()
+                if self._scratches
+                else DijkstraScratch(len(self.offsets) - 1)
+            )
+        try:
+            return Reachability.from_csr(
+                self.node_ids,
+                self.offsets,
+                self.neighbors,
+                self.edge_costs,
+                origins,
+                self.weight_cutoff,
+                weight_dtype=self.weight_dtype,
+                scratch=scratch,
+            )
+        finally:
+            with self._lock:
+                self._scratches.append(scratch)
+
+    def select_origins(self, origins: np.array) -> Reachability:
+        """
+        A Reachability for the origins (dense node indexes) with out-edges, computing the
+            ones that aren't cached yet
+        """
+        origins = np.unique(origins).astype(np.int64)
+        origins = origins[np.diff(self.offsets)[origins] > 0]
+
+        with self._lock:
+            found = {
+                origin: self._cache[origin]
+                for origin in origins
+                if origin in self._cache
+            }
+        missing = np.array(
+            [origin for origin in origins if origin not in found], dtype=np.int64
+        )
+        computed = self._compute(missing)
+        for i, origin in enumerate(missing):
+            start, end = computed.offsets[i], computed.offsets[i + 1]
+            # copies, so that evicting an origin frees its memory
+            found[origin] = (
+                computed.destinations[start:end].copy(),
+                computed.weights[start:end].copy(),
+            )
+
+        results = [found[origin] for origin in origins]
+        with self._lock:
+            # other threads may have cached or evicted some of these origins meanwhile
+            for origin in origins:
+                self._cache[origin] = found[origin]
+                self._cache.move_to_end(origin)
+            while len(self._cache) > self.max_cached_origins:
+                self._cache.popitem(last=False)
+
+        return Reachability(
+            node_ids=self.node_ids,
+            origins=origins,
+            offsets=np.concatenate(
+                [[0], np.cumsum([len(result[0]) for result in results], dtype=np.int64)]
+            ),
+            destinations=np.concatenate(
+                [np.empty(0, dtype=np.int32)] + [result[0] for result in results]
+            ),
+            weights=np.concatenate(
+                [np.empty(0, dtype=self.weight_dtype)]
+                + [result[1] for result in results]
+            ),
+            weight_cutoff=self.weight_cutoff,
+        )
+
+    def chunks(self):
+        """
+        Compute every origin, max_cached_origins at a time, without caching them
+        """
+        origins = dense_origins(self.node_ids, self.offsets)
+        for start in range(0, len(origins), self.max_cached_origins):
+            yield self._compute(origins[start : start + self.max_cached_origins])
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        The long from / to / weight DataFrame with node ids, which computes every origin
+        """
+        return pd.concat(
+            [chunk.to_dataframe() for chunk in self.chunks()], ignore_index=True
+        )
+
+
+def load_reachability(
+    directory: str, mmap: bool = False
+) -> Reachability | ChunkedReachability:
+    """
+    Read a Reachability or ChunkedReachability from a directory
+    """
+    with open(os.path.join(directory, "metadata.json")) as f:
+        chunked = "chunk_lengths" in json.load(f)
+    if chunked:
+        return ChunkedReachability.load(directory)
+    return Reachability.load(directory, mmap=mmap)
+
+
+@numba.jit(nogil=True, cache=True)
+def _prefix_ends(
+    offsets: np.array,  # reachability offsets, one segment per origin
+    weights: np.array,  # reachability weights, sorted within each segment
+    max_weight: float,
+):
+    ends = np.empty(len(offsets) - 1, dtype=np.int64)
+    for i in range(len(ends)):
+        segment = weights[offsets[i] : offsets[i + 1]]
+        ends[i] = offsets[i] + np.searchsorted(segment, max_weight)
+    return ends
+
+
+def dense_origins(
+    node_ids: pd.Index, offsets: np.array, origins: pd.Index = None
+) -> np.array:
+    """
+    The sorted dense indexes of origins (node ids), or of every node if origins is None,
+        leaving out nodes without out-edges
+    """
+    has_edges = np.diff(offsets) > 0
+    if origins is None:
+        return np.flatnonzero(has_edges)
+
+    indexes = node_ids.get_indexer(origins)
+    assert (indexes >= 0).all(), "All origins should be nodes in the edges"
+    indexes = np.unique(indexes).astype(np.int64)
+    return indexes[has_edges[indexes]]
+
+
+def _gather_segments(starts: np.array, counts: np.array) -> tuple[np.array, np.array]:
+    """
+    The offsets of segments of counts elements copied from starts, and the indexes to take
+        those elements from
+    """
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return offsets, np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+
+
+def _preprocess_tile(
+    directory: str,
+    prefix: str,
+    nodes: np.array,
+    offsets: np.array,
+    neighbors: np.array,
+    edge_costs: np.array,
+    origins: np.array,
+    weight_cutoff: float,
+    weight_dtype,
+) -> int:
+    """
+    Run by a worker of ChunkedReachability.from_tiles.  Preprocess origins (positions in
+        nodes) on the subgraph of nodes (see subgraph_csr), and write the result as a chunk
+        with the dense node indexes of the whole network.
+    :return: The number of pairs
+    """
+    chunk = Reachability.from_csr(
+        pd.RangeIndex(len(nodes)),
+        offsets,
+        neighbors,
+        edge_costs,
+        origins,
+        weight_cutoff,
+        weight_dtype=weight_dtype,
+    )
+    chunk.origins = nodes[chunk.origins]
+    chunk.destinations = nodes[chunk.destinations].astype(np.int32)
+    chunk._save_arrays(directory, prefix=prefix)
+    return len(chunk)
+
+
+def _merge_tiles(
+    tiles_directory: str,
+    num_tiles: int,
+    node_ids: pd.Index,
+    weight_cutoff: float,
+    directory: str,
+    chunk_size: int,
+) -> list[int]:
+    """
+    Write the tiles written by _preprocess_tile to directory as chunks of chunk_size
+        origins in order, like ChunkedReachability.from_csr.  Only one chunk is in memory
+        at a time, and the tiles are memory-mapped.
+    :return: The number of pairs in each chunk
+    """
+    tiles = [
+        Reachability._load_arrays(
+            tiles_directory,
+            node_ids,
+            weight_cutoff=weight_cutoff,
+            fingerprint=None,
+            mmap=True,
+            prefix=_chunk_prefix(i),
+        )
+        for i in range(num_tiles)
+    ]
+    origins = np.sort(np.concatenate([tile.origins for tile in tiles]))
+
+    chunk_lengths = []
+    for start in range(0, len(origins), chunk_size):
+        end = origins[min(start + chunk_size, len(origins)) - 1] + 1
+        pieces = []
+        for tile in tiles:
+            # the origins of each tile are sorted, so the ones in this chunk are a slice
+            lo, hi = np.searchsorted(tile.origins, [origins[start], end])
+            if lo < hi:
+                pieces.append(tile.select_range(lo, hi))
+
+        chunk = Reachability.concatenate(pieces)
+        order = np.argsort(chunk.origins, kind="stable")
+        offsets, take = _gather_segments(
+            chunk.offsets[:-1][order], np.diff(chunk.offsets)[order]
+        )
+        chunk.origins = chunk.origins[order]
+        chunk.offsets = offsets
+        chunk.destinations = chunk.destinations[take]
+        chunk.weights = chunk.weights[take]
+        chunk._save_arrays(directory, prefix=_chunk_prefix(len(chunk_lengths)))
+        chunk_lengths.append(len(chunk))
+    return chunk_lengths
+
+
+def _chunk_prefix(i: int) -> str:
+    return f"chunk-{i:06d}-"
+
+
+def check_new_directory(directory: str):
+    """
+    Raise a FileExistsError if directory exists, before any work is done to fill it
+    """
+    if os.path.exists(directory):
+        raise FileExistsError(f"{directory} already exists")
+
+
+@contextmanager
+def _writing_directory(directory: str):
+    """
+    Yield a temporary directory to write to, which is renamed to directory when done so
+        other processes never see a partially written directory.  An existing directory is
+        checked for up front, and again by the rename in case it was created meanwhile.
+    """
+    check_new_directory(directory)
+    tmp_directory = f"{directory}.tmp-{os.getpid()}"
+    os.makedirs(tmp_directory)
+    try:
+        yield tmp_directory
+    except BaseException:
+        shutil.rmtree(tmp_directory)
+        raise
+
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        shutil.rmtree(tmp_directory)
+        if os.path.exists(directory):
+            raise FileExistsError(f"{directory} already exists")
+        raise
+
+
+def _save_metadata(directory: str, node_ids: pd.Index, **metadata):
+    node_ids = node_ids.to_numpy()
+    node_ids_dtype = None
+    if node_ids.dtype == object:
+        assert (
+            pd.api.types.infer_dtype(node_ids) == "string"
+        ), "Node ids must all be numbers or all be strings to be saved"
+        node_ids = node_ids.astype(str)
+        node_ids_dtype = "object"
+
+    np.save(os.path.join(directory, "node_ids.npy"), node_ids)
+    with open(os.path.join(directory, "metadata.json"), "w") as f:
+        json.dump({**metadata, "node_ids_dtype": node_ids_dtype}, f)
+
+
+def _load_metadata(directory: str) -> tuple[pd.Index, dict]:
+    with open(os.path.join(directory, "metadata.json")) as f:
+        metadata = json.load(f)
+
+    node_ids = np.load(os.path.join(directory, "node_ids.npy"))
+    if metadata["node_ids_dtype"] is not None:
+        node_ids = node_ids.astype(metadata["node_ids_dtype"])
+    return pd.Index(node_ids), metadata
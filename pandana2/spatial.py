@@ -0,0 +1,211 @@
+import numba
+import numpy as np
+import shapely
+
+# the most nodes in a leaf of the KD-tree of NodeIndex
+LEAF_SIZE = 8
+
+
+@numba.jit(cache=True)
+def _select(order: np.array, coordinates: np.array, lo: int, hi: int, k: int):
+    """
+    Rearrange order[lo:hi] so that order[k] is the point with the k-th smallest of
+        coordinates among them, with no larger ones before it and no smaller ones after
+    """
+    while hi - lo > 1:
+        pivot = coordinates[order[(lo + hi) // 2]]
+        i, j = lo, hi - 1
+        while i <= j:
+            while coordinates[order[i]] < pivot:
+                i += 1
+            while coordinates[order[j]] > pivot:
+                j -= 1
+            if i <= j:
+                order[i], order[j] = order[j], order[i]
+                i += 1
+                j -= 1
+        # order[lo:j + 1] are <= pivot, order[i:hi] are >= pivot, and any in between are
+        #   equal to it
+        if k <= j:
+            hi = j + 1
+        elif k >= i:
+            lo = i
+        else:
+            return
+
+
+@numba.jit(cache=True)
+def _build_kdtree(x: np.array, y: np.array, leaf_size: int):
+    """
+    Build a KD-tree of the points, which splits them in half at the median of the
+        coordinate they're most spread out in until there are at most leaf_size.  Node n
+        of the tree has children 2n + 1 and 2n + 2, and the points of a node are a range of
+        order (which halves at each split, so the ranges don't need to be stored).  Returns
+        order and the bounding box of each node, which is empty for unused node numbers.
+    """
+    depth, size = 0, len(x)
+    while size > leaf_size:
+        size = (size + 1) // 2
+        depth += 1
+    num_tree_nodes = 2 ** (depth + 1) - 1
+    boxes = np.empty((num_tree_nodes, 4))
+    boxes[:, 0] = boxes[:, 2] = np.inf
+    boxes[:, 1] = boxes[:, 3] = -np.inf
+
+    order = np.arange(len(x))
+    stack = [(0, 0, len(x))]
+    while stack:
+        node, lo, hi = stack.pop()
+        for k in range(lo, hi):
+            p = order[k]
+            boxes[node, 0] = min(boxes[node, 0], x[p])
+            boxes[node, 1] = max(boxes[node, 1], x[p])
+            boxes[node, 2] = min(boxes[node, 2], y[p])
+            boxes[node, 3] = max(boxes[node, 3], y[p])
+        if hi - lo <= leaf_size:
+            continue
+        mid = (lo + hi) // 2
+        if boxes[node, 1] - boxes[node, 0] >= boxes[node, 3] - boxes[node, 2]:
+            _select(order, x, lo, hi, mid)
+        else:
+            _select(order, y, lo, hi, mid)
+        stack.append((2 * node + 1, lo, mid))
+        stack.append((2 * node + 2, mid, hi))
+    return order, boxes
+
+
+@numba.jit(cache=True)
+def _box_distance(qx: float, qy: float, box: np.array) -> float:
+    """
+    The distance from a point to a bounding box (xmin, xmax, ymin, ymax)
+    """
+    dx = max(box[0] - qx, 0.0, qx - box[1])
+    dy = max(box[2] - qy, 0.0, qy - box[3])
+    return np.sqrt(dx * dx + dy * dy)
+
+
+@numba.jit(nogil=True, cache=True)
+def _kdtree_nearest(
+    qx: np.array,  # projected x coordinates of the query points
+    qy: np.array,  # projected y coordinates of the query points
+    x: np.array,  # projected x coordinates of the indexed points
+    y: np.array,  # projected y coordinates of the indexed points
+    order: np.array,  # see _build_kdtree
+    boxes: np.array,  # see _build_kdtree
+    leaf_size: int,
+    max_distance: float,  # np.inf for no limit
+):
+    """
+    For each query point, search the KD-tree depth first, nearer child first, skipping
+        nodes whose bounding box is farther than the nearest point found so far.  Returns
+        the position of the nearest point, or -1 if there is none within max_distance.
+    """
+    nearest = np.full(len(qx), -1, dtype=np.int64)
+    # (node, lo, hi) of the nodes left to search, which is at most one more than the
+    #   depth of the tree
+    stack = np.empty((128, 3), dtype=np.int64)
+    for q in range(len(qx)):
+        px, py = qx[q], qy[q]
+        best = max_distance
+        stack[0] = (0, 0, len(x))
+        size = 1
+        while size:
+            size -= 1
+            node, lo, hi = stack[size]
+            if _box_distance(px, py, boxes[node]) > best:
+                continue
+            if hi - lo <= leaf_size:
+                for k in range(lo, hi):
+                    p = order[k]
+                    distance = np.sqrt((x[p] - px) ** 2 + (y[p] - py) ** 2)
+                    if distance < best or (distance == best and nearest[q] == -1):
+                        best = distance
+                        nearest[q] = p
+                continue
+            mid = (lo + hi) // 2
+            first, second = 2 * node + 1, 2 * node + 2
+            if _box_distance(px, py, boxes[second]) < _box_distance(
+                px, py, boxes[first]
+            ):
+                # the nearer child is pushed last, so it's searched first
+                stack[size] = (first, lo, mid)
+                stack[size + 1] = (second, mid, hi)
+            else:
+                stack[size] = (second, mid, hi)
+                stack[size + 1] = (first, lo, mid)
+            size += 2
+    return nearest
+
+
+class NodeIndex:
+    """
+    A spatial index for finding the nearest node to many points at once, which is a
+        KD-tree of the nodes (projected to EPSG:3857), so it adapts to networks that are
+        dense in some places and sparse in others.  Nearest node queries for points only
+        look at the few leaves around each point, in compiled code.  Other geometries (e.g.
+        parcel polygons) use a shapely STRtree instead.
+    """
+
+    x: np.array
+    y: np.array
+    # see _build_kdtree
+    order: np.array
+    boxes: np.array
+    _tree: shapely.STRtree = None
+
+    def __init__(self, x: np.array, y: np.array):
+        """
+        :param x: The projected x coordinates of the nodes
+        :param y: The projected y coordinates of the nodes
+        """
+        assert len(x) > 0, "Need at least one node"
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.y = np.ascontiguousarray(y, dtype=np.float64)
+        self.order, self.boxes = _build_kdtree(self.x, self.y, LEAF_SIZE)
+
+    def nearest(self, x: np.array, y: np.array, max_distance: float = None) -> np.array:
+        """
+        The position of the nearest node to each point (in the same projection as the
+            nodes), or -1 for points with no node within max_distance
+        """
+        return _kdtree_nearest(
+            np.ascontiguousarray(x, dtype=np.float64),
+            np.ascontiguousarray(y, dtype=np.float64),
+            self.x,
+            self.y,
+            self.order,
+            self.boxes,
+            LEAF_SIZE,
+            np.inf if max_distance is None else float(max_distance),
+        )
+
+    def nearest_geometries(
+        self, geometries: np.array, max_distance: float = None
+    ) -> np.array:
+        """
+        Same as nearest, for an array of shapely geometries
+        """
+        x, y = shapely.get_x(geometries), shapely.get_y(geometries)
+        if (shapely.get_type_id(geometries) == 0).all() and np.isfinite(x + y).all():
+            # all (non-empty) points
+            return self.nearest(x, y, max_distance)
+
+        if self._tree is None:
+            self._tree = shapely.STRtree(shapely.points(self.x, self.y))
+        positions, node_positions = self._tree.query_nearest(
+            geometries, max_distance=max_distance, all_matches=False
+        )
+        nearest = np.full(len(geometries), -1, dtype=np.int64)
+        nearest[positions] = node_positions
+        return nearest
+
+
+def assign_tiles(x: np.array, y: np.array, tile_size: float) -> np.array:
+    """
+    Split points into square tiles of tile_size (in the units of x and y) on a grid that
+        starts at their bottom left corner, and return the tile of each point as a number
+        from 0 to the number of tiles with any points, row by row
+    """
+    column = ((x - x.min()) // tile_size).astype(np.int64)
+    row = ((y - y.min()) // tile_size).astype(np.int64)
+    return np.unique(row * (column.max() + 1) + column, return_inverse=True)[1]
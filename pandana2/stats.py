@@ -0,0 +1,72 @@
+import time
+from contextlib import contextmanager
+
+
+class Stats:
+    """
+    The wall time of each stage of one preprocess or aggregate call, and counts of the work
+        it did (e.g. origins, pairs and bytes), for finding out where the time goes in slow
+        runs and tuning cutoffs.  PandanaNetwork keeps the Stats of its last preprocess in
+        network.stats, aggregate adds to the Stats passed to it, and to_dict flattens them
+        for a metrics system.
+    """
+
+    operation: str
+    # stage name -> seconds, in the order the stages first ran
+    seconds: dict[str, float]
+    # e.g. origins, pairs, bytes -> count
+    counts: dict[str, int]
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.seconds = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time the body of the with statement, adding to any earlier time for the same stage
+            (e.g. for each chunk)
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - t0
+
+    def add(self, name: str, count: int):
+        """
+        Add to a count
+        """
+        self.counts[name] = self.counts.get(name, 0) + int(count)
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(self.seconds.values())
+
+    @property
+    def pairs_per_origin(self) -> float:
+        """
+        The average number of pairs per origin, i.e. the size of the ball of nodes within
+            the cutoff (or max_weight) of each origin
+        """
+        origins = self.counts.get("origins", 0)
+        return self.counts.get("pairs", 0) / origins if origins else 0.0
+
+    def to_dict(self) -> dict[str, float]:
+        """
+        Every time (as "<stage>_seconds") and count in one flat dict
+        """
+        return {
+            **{f"{name}_seconds": seconds for name, seconds in self.seconds.items()},
+            "total_seconds": self.total_seconds,
+            **self.counts,
+            "pairs_per_origin": self.pairs_per_origin,
+        }
+
+    def __repr__(self) -> str:
+        stages = ", ".join(
+            f"{name}={seconds:.3f}s" for name, seconds in self.seconds.items()
+        )
+        counts = ", ".join(f"{name}={count}" for name, count in self.counts.items())
+        return f"Stats({self.operation}: {stages}; {counts})"
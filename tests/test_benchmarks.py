@@ -0,0 +1,33 @@
+import numpy as np
+
+from benchmarks.networks import synthetic_grid
+from benchmarks.run import run_benchmarks
+from pandana2 import PandanaNetwork
+
+
+def test_synthetic_grid():
+    nodes, edges = synthetic_grid(10_000)
+    assert abs(len(edges) - 10_000) < 500
+    assert nodes.crs == "EPSG:3857"
+    assert edges.u.isin(nodes.index).all() and edges.v.isin(nodes.index).all()
+    assert (edges.length > 0).all()
+    assert PandanaNetwork(edges, nodes).is_symmetric()
+
+    # the same seed gives the same network
+    _, same_edges = synthetic_grid(10_000)
+    assert same_edges.equals(edges)
+    _, other_edges = synthetic_grid(10_000, seed=1)
+    assert not other_edges.equals(edges)
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(1000, weight_cutoff=300)
+    assert {
+        "dijkstra_all_pairs",
+        "preprocess",
+        "aggregate_median_exponential",
+        "nearest_nodes",
+        "load_preprocessed",
+    } <= set(results.benchmark)
+    assert (results.seconds >= 0).all()
+    assert np.isfinite(results.throughput).all()
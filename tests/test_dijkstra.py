@@ -1,5 +1,7 @@
+import numpy as np
 import pandas as pd
 
+import pandana2
 from pandana2.dijkstra import dijkstra_all_pairs
 
 
@@ -47,3 +49,31 @@ def test_dijkstra_basic():
         {"from": 6, "to": 6, "weight": 0.0},
         {"from": 6, "to": 7, "weight": 11.0},
     ]
+
+
+def test_dijkstra_threads(monkeypatch):
+    # a random network with a few edges per node
+    rng = np.random.default_rng(0)
+    edges = pd.DataFrame(
+        {
+            "from": rng.integers(0, 300, 1200),
+            "to": rng.integers(0, 300, 1200),
+            "edge_cost": rng.uniform(1, 10, 1200).round(1),
+        }
+    ).query("`from` != `to`")
+    expected = dijkstra_all_pairs(edges, 15)
+
+    # each thread makes one scratch for all of its chunks
+    scratches = []
+
+    class CountedScratch(pandana2.dijkstra.DijkstraScratch):
+        def __init__(self, num_nodes):
+            super().__init__(num_nodes)
+            scratches.append(self)
+
+    monkeypatch.setattr(pandana2.dijkstra, "DijkstraScratch", CountedScratch)
+    for n_threads in [1, 2, 3, 16]:
+        scratches.clear()
+        results = dijkstra_all_pairs(edges, 15, n_threads=n_threads)
+        pd.testing.assert_frame_equal(results, expected)
+        assert len(scratches) <= n_threads
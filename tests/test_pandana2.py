@@ -1,12 +1,18 @@
+import asyncio
+import os
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import geopandas as gpd
+import numba
 import numpy as np
 import osmnx
 import pandas as pd
 import pytest
 
 import pandana2
+from benchmarks.networks import synthetic_grid
+from pandana2.stats import Stats
 
 
 @pytest.fixture
@@ -346,3 +352,856 @@ def test_home_price_aggregation(redfin_df):
         "median_price": 806,
         "min_price": 543,
     }
+
+
+def test_reachability(simple_graph):
+    reachability = simple_graph.reachability
+    assert reachability.destinations.dtype == np.int32
+    assert list(reachability.node_ids.take(reachability.origins)) == list("abcdef")
+    assert len(reachability) == len(simple_graph.min_weights_df)
+
+    # float32 weights should give the same aggregations for this graph
+    simple_graph.preprocess(weight_cutoff=1.2, weight_dtype=np.float32)
+    assert simple_graph.reachability.weights.dtype == np.float32
+    assert simple_graph.reachability.nbytes < reachability.nbytes
+    aggregations_series = simple_graph.aggregate(
+        values=pd.Series([1, 2, 3], index=["b", "d", "c"]),
+        decay_func=pandana2.NoDecay(0.5),
+        aggregation="sum",
+    )
+    assert aggregations_series.to_dict() == {"a": 5, "b": 1, "c": 5, "d": 5}
+
+
+def test_prefix_ends(simple_graph):
+    reachability = simple_graph.reachability
+    weights_df = simple_graph.min_weights_df
+    for max_weight in [0.05, 0.3, 0.85, 5]:
+        ends = reachability.prefix_ends(max_weight)
+        expected = (weights_df["weight"] < max_weight).groupby(weights_df["from"]).sum()
+        assert list(ends - reachability.offsets[:-1]) == list(expected)
+        assert reachability.prefix_ends(max_weight) is ends
+
+    values = pd.Series([1, 2, 3], index=["b", "d", "c"])
+    assert simple_graph.aggregate(values, pandana2.NoDecay(0.3), "sum").to_dict() == {
+        "a": 3,
+        "b": 1,
+        "c": 5,
+        "d": 5,
+    }
+    assert simple_graph.aggregate(values, pandana2.NoDecay(1.2), "count").to_dict() == {
+        "a": 3,
+        "b": 3,
+        "c": 3,
+        "d": 3,
+        "e": 2,
+        "f": 2,
+    }
+
+
+def test_prefix_ends_float32():
+    nodes, edges = synthetic_grid(4000)
+    network = pandana2.PandanaNetwork(edges, nodes)
+    network.preprocess(400, weight_dtype=np.float32)
+    reachability = network.reachability
+    # a weight of some pairs, which float32 can't represent exactly
+    max_weight = round(float(np.median(reachability.weights)), 2)
+    assert (reachability.weights == np.float32(max_weight)).any()
+
+    within = reachability.weights < max_weight
+    positions = np.concatenate([[0], np.cumsum(within)])
+    ends = reachability.prefix_ends(max_weight) - reachability.offsets[:-1]
+    assert list(ends) == list(np.diff(positions[reachability.offsets]))
+
+    class MaskedNoDecay(pandana2.decay_functions.PandanaDecayFunction):
+        def __init__(self, max_weight):
+            self.max_weight = max_weight
+            self.mask = lambda weights: weights < max_weight
+            self.weights = lambda weights: pd.Series(1.0, index=weights.index)
+
+    values = pd.Series(1.0, index=nodes.index)
+    pd.testing.assert_series_equal(
+        network.aggregate(values, pandana2.NoDecay(max_weight), "count"),
+        network.aggregate(values, MaskedNoDecay(max_weight), "count"),
+    )
+
+    # only the last few max_weights are kept
+    for max_weight in range(2 * pandana2.reachability.MAX_PREFIX_ENDS):
+        reachability.prefix_ends(max_weight)
+    assert len(reachability._prefix_ends) == pandana2.reachability.MAX_PREFIX_ENDS
+
+
+def test_multiple_aggregations(simple_graph):
+    values = pd.Series([1, 2, 3, np.nan], index=["b", "d", "c", "c"])
+    out_df = simple_graph.aggregate(
+        values=values,
+        decay_func=pandana2.NoDecay(0.5),
+        aggregation={"count": "count", "mean": "mean", "std": "std", "min": "min"},
+    )
+    # NaN values are skipped
+    assert out_df.round(2).to_dict(orient="index") == {
+        "a": {"count": 2, "mean": 2.5, "std": 0.5, "min": 2},
+        "b": {"count": 1, "mean": 1.0, "std": 0.0, "min": 1},
+        "c": {"count": 2, "mean": 2.5, "std": 0.5, "min": 2},
+        "d": {"count": 2, "mean": 2.5, "std": 0.5, "min": 2},
+    }
+
+
+def test_dataframe_aggregation(simple_graph):
+    values = pd.DataFrame(
+        {"x": [1, 2, 3], "y": [np.nan, 20, 30]},
+        index=["b", "d", "c"],
+    )
+    decay_func = pandana2.LinearDecay(0.5)
+
+    out_df = simple_graph.aggregate(
+        values=values, decay_func=decay_func, aggregation="sum"
+    )
+    for col in values.columns:
+        pd.testing.assert_series_equal(
+            out_df[col].dropna(),
+            simple_graph.aggregate(values[col], decay_func, "sum"),
+            check_names=False,
+        )
+
+    out_df = simple_graph.aggregate(
+        values=values,
+        decay_func=decay_func,
+        aggregation={"total": "sum", "median": "median"},
+    )
+    assert list(out_df.columns) == [
+        ("x", "total"),
+        ("x", "median"),
+        ("y", "total"),
+        ("y", "median"),
+    ]
+    # b only reaches the missing y value
+    assert np.isnan(out_df.loc["b", ("y", "median")])
+    assert out_df.loc["b", ("x", "median")] == 1
+
+
+def test_accessibility_operator(simple_graph):
+    scenarios = pd.DataFrame(
+        np.arange(12, dtype="float").reshape(4, 3) + 1,
+        index=["b", "d", "c", "c"],
+        columns=["s1", "s2", "s3"],
+    )
+    decay_func = pandana2.LinearDecay(0.5)
+    operator = simple_graph.accessibility_operator(decay_func)
+    assert simple_graph.accessibility_operator(decay_func) is operator
+    # equal decay functions share the operator, and the cache is bounded
+    assert simple_graph.accessibility_operator(pandana2.LinearDecay(0.5)) is operator
+    assert simple_graph.accessibility_operator(pandana2.NoDecay(0.5)) is not operator
+    for max_weight in np.linspace(
+        0.1, 1.0, pandana2.network.MAX_ACCESSIBILITY_OPERATORS
+    ):
+        simple_graph.accessibility_operator(pandana2.LinearDecay(max_weight))
+    assert (
+        len(simple_graph._accessibility_operators)
+        == pandana2.network.MAX_ACCESSIBILITY_OPERATORS
+    )
+    assert operator.shape == (6, 6)
+
+    dense = np.zeros(operator.shape)
+    for i in range(len(operator.origins)):
+        row = slice(operator.offsets[i], operator.offsets[i + 1])
+        dense[i, operator.destinations[row]] = operator.data[row]
+    matrix = np.arange(12, dtype="float").reshape(6, 2)
+    np.testing.assert_allclose(operator.dot(matrix), dense @ matrix)
+    np.testing.assert_allclose(operator.dot(matrix[:, 0]), dense @ matrix[:, 0])
+
+    for aggregation in ["sum", "mean"]:
+        out_df = getattr(operator, aggregation)(scenarios)
+        assert list(out_df.columns) == ["s1", "s2", "s3"]
+        # e and f don't reach any values
+        assert out_df.loc[["e", "f"]].isna().all().all()
+        pd.testing.assert_frame_equal(
+            out_df.dropna(),
+            simple_graph.aggregate(scenarios, decay_func, aggregation),
+            check_names=False,
+        )
+
+
+def test_save_load_preprocessed(simple_graph, tmp_path):
+    directory = str(tmp_path / "preprocessed")
+    simple_graph.save_preprocessed(directory)
+
+    network = pandana2.PandanaNetwork(
+        edges=simple_graph.edges,
+        nodes=simple_graph.nodes,
+        from_nodes_col="from",
+        to_nodes_col="to",
+        edge_costs_col="edge_cost",
+    )
+    network.load_preprocessed(directory)
+    assert network.weight_cutoff == 1.2
+    pd.testing.assert_frame_equal(network.min_weights_df, simple_graph.min_weights_df)
+
+    # the cache should be used for the same edges and settings
+    cache_dir = str(tmp_path / "cache")
+    network.preprocess(weight_cutoff=1.2, cache_dir=cache_dir)
+    fingerprint = network.fingerprint(1.2)
+    assert os.listdir(cache_dir) == [fingerprint]
+    network.reachability = None
+    network.preprocess(weight_cutoff=1.2, cache_dir=cache_dir)
+    assert network.reachability.fingerprint == fingerprint
+    assert network.fingerprint(1.0) != fingerprint
+
+    edges = simple_graph.edges.copy()
+    edges["edge_cost"] *= 2
+    network = pandana2.PandanaNetwork(
+        edges=edges,
+        nodes=simple_graph.nodes,
+        from_nodes_col="from",
+        to_nodes_col="to",
+        edge_costs_col="edge_cost",
+    )
+    with pytest.raises(Exception) as e:
+        network.load_preprocessed(directory)
+    assert "computed from different edges" in str(e)
+
+
+def test_load_preprocessed_mmap(simple_graph, tmp_path):
+    directory = str(tmp_path / "preprocessed")
+    simple_graph.save_preprocessed(directory)
+    values = pd.Series([1, 2, 3], index=["b", "d", "c"])
+    decay_func = pandana2.LinearDecay(0.5)
+    expected = simple_graph.aggregate(values, decay_func, "mean")
+
+    simple_graph.load_preprocessed(directory, mmap=True)
+    assert isinstance(simple_graph.reachability.weights, np.memmap)
+    assert not simple_graph.reachability.weights.flags.writeable
+    pd.testing.assert_series_equal(
+        simple_graph.aggregate(values, decay_func, "mean"), expected
+    )
+    pd.testing.assert_series_equal(
+        simple_graph.accessibility_operator(decay_func).mean(values).dropna(),
+        expected,
+    )
+
+
+def test_preprocess_to_disk(simple_graph, tmp_path, monkeypatch):
+    values = pd.DataFrame({"x": [1, 2, 3], "y": [4, 5, 6]}, index=["b", "d", "c"])
+    decay_func = pandana2.LinearDecay(1.0)
+    expected_df = simple_graph.aggregate(values, decay_func, {"sum": "sum"})
+    expected_min_weights_df = simple_graph.min_weights_df
+
+    directory = str(tmp_path / "preprocessed")
+    simple_graph.preprocess_to_disk(
+        weight_cutoff=1.2, directory=directory, chunk_size=4
+    )
+    assert simple_graph.reachability.chunk_lengths == [22, 8]
+    pd.testing.assert_frame_equal(
+        simple_graph.aggregate(values, decay_func, {"sum": "sum"}), expected_df
+    )
+    pd.testing.assert_frame_equal(simple_graph.min_weights_df, expected_min_weights_df)
+
+    simple_graph.reachability = None
+    simple_graph.load_preprocessed(directory)
+    pd.testing.assert_frame_equal(
+        simple_graph.accessibility_operator(decay_func).sum(values).dropna(),
+        simple_graph.aggregate(values, decay_func, "sum"),
+    )
+
+    # an existing directory is found before any dijkstra runs
+    def from_csr(*args, **kwargs):
+        raise AssertionError("dijkstra ran")
+
+    monkeypatch.setattr(pandana2.reachability.Reachability, "from_csr", from_csr)
+    with pytest.raises(FileExistsError, match="already exists"):
+        simple_graph.preprocess_to_disk(1.2, directory=directory, max_bytes=300)
+    with pytest.raises(FileExistsError, match="already exists"):
+        pandana2.reachability.ChunkedReachability.from_csr(
+            *simple_graph.to_csr(), weight_cutoff=1.2, directory=directory
+        )
+
+
+def test_update_edges(simple_graph):
+    edges = simple_graph.edges.copy()
+    # close a-d, make a-b slower, and add a shortcut from b to d
+    edges = edges[~edges["from"].isin(["a", "d"]) | ~edges["to"].isin(["a", "d"])]
+    edges.loc[(edges["from"] == "a") & (edges["to"] == "b"), "edge_cost"] = 0.7
+    edges = pd.concat(
+        [edges, pd.DataFrame({"from": ["b"], "to": ["d"], "edge_cost": [0.2]})]
+    )
+
+    simple_graph.update_edges(edges)
+    expected = pandana2.PandanaNetwork(
+        edges=edges,
+        nodes=simple_graph.nodes,
+        from_nodes_col="from",
+        to_nodes_col="to",
+        edge_costs_col="edge_cost",
+    )
+    expected.preprocess(weight_cutoff=1.2)
+    pd.testing.assert_frame_equal(simple_graph.min_weights_df, expected.min_weights_df)
+    assert simple_graph.reachability.fingerprint == expected.reachability.fingerprint
+
+
+def test_update_edges_is_local():
+    # a line of 10 nodes, 1 apart in both directions
+    edges = pd.DataFrame({"from": range(9), "to": range(1, 10), "edge_cost": 1.0})
+    edges = pd.concat([edges, edges.rename(columns={"from": "to", "to": "from"})])
+    network = pandana2.PandanaNetwork(
+        edges=edges,
+        nodes=pd.DataFrame(index=range(10)),
+        from_nodes_col="from",
+        to_nodes_col="to",
+        edge_costs_col="edge_cost",
+    )
+    network.preprocess(weight_cutoff=2)
+
+    # only 3 to 7 can reach 5 within the cutoff
+    edges = edges.copy()
+    edges.loc[(edges["from"] == 5) & (edges["to"] == 6), "edge_cost"] = 0.5
+    assert network.update_edges(edges) == 5
+    assert network.min_weights_df.query("`from` == 4").to_dict(orient="records") == [
+        {"from": 4, "to": 4, "weight": 0.0},
+        {"from": 4, "to": 3, "weight": 1.0},
+        {"from": 4, "to": 5, "weight": 1.0},
+        {"from": 4, "to": 6, "weight": 1.5},
+        {"from": 4, "to": 2, "weight": 2.0},
+    ]
+
+
+def test_update_edges_adds_origins(tmp_path):
+    # a one way line, so 3 has no out-edges until 3 -> 0 is added
+    edges = pd.DataFrame({"from": [0, 1, 2], "to": [1, 2, 3], "edge_cost": 1.0})
+
+    def make_network(edges):
+        return pandana2.PandanaNetwork(
+            edges=edges,
+            nodes=pd.DataFrame(index=range(4)),
+            from_nodes_col="from",
+            to_nodes_col="to",
+            edge_costs_col="edge_cost",
+        )
+
+    network = make_network(edges)
+    network.preprocess(weight_cutoff=2, origins=[0, 3])
+    assert list(network.min_weights_df["from"].unique()) == [0]
+
+    directory = str(tmp_path / "preprocessed")
+    network.save_preprocessed(directory)
+    network.load_preprocessed(directory)
+    assert list(network.origins) == [0, 3]
+
+    edges = pd.concat(
+        [edges, pd.DataFrame({"from": [3], "to": [0], "edge_cost": [1.0]})]
+    )
+    network.update_edges(edges)
+    expected = make_network(edges)
+    expected.preprocess(weight_cutoff=2, origins=[0, 3])
+    assert list(network.min_weights_df["from"].unique()) == [0, 3]
+    pd.testing.assert_frame_equal(network.min_weights_df, expected.min_weights_df)
+    assert network.reachability.fingerprint == expected.reachability.fingerprint
+
+
+def test_preprocess_origins(simple_graph, tmp_path):
+    values = pd.Series([1, 2, 3], index=["b", "d", "c"])
+    decay_func = pandana2.LinearDecay(1.0)
+    expected = simple_graph.aggregate(values, decay_func, "sum")
+    pd.testing.assert_series_equal(
+        simple_graph.aggregate(values, decay_func, "sum", origins=["e", "a"]),
+        expected.loc[["a", "e"]],
+    )
+
+    simple_graph.preprocess(weight_cutoff=1.2, origins=["e", "a"])
+    assert list(simple_graph.min_weights_df["from"].unique()) == ["a", "e"]
+    pd.testing.assert_series_equal(
+        simple_graph.aggregate(values, decay_func, "sum"), expected.loc[["a", "e"]]
+    )
+
+    directory = str(tmp_path / "preprocessed")
+    simple_graph.save_preprocessed(directory)
+    simple_graph.load_preprocessed(directory)
+    assert list(simple_graph.origins) == ["a", "e"]
+
+
+def test_preprocess_lazy(simple_graph):
+    values = pd.Series([1, 2, 3], index=["b", "d", "c"])
+    decay_func = pandana2.LinearDecay(1.0)
+    expected = simple_graph.aggregate(values, decay_func, "sum")
+    expected_min_weights_df = simple_graph.min_weights_df
+
+    simple_graph.preprocess_lazy(weight_cutoff=1.2, max_cached_origins=2)
+    for origins in [["a", "e"], ["f"], ["a", "b", "c", "d", "e", "f"]]:
+        pd.testing.assert_series_equal(
+            simple_graph.aggregate(values, decay_func, "sum", origins=origins),
+            expected.loc[origins],
+        )
+        assert len(simple_graph.reachability._cache) <= 2
+    # every call reused the scratch of the first, which recomputes evicted origins
+    assert len(simple_graph.reachability._scratches) == 1
+    pd.testing.assert_series_equal(
+        simple_graph.aggregate(values, decay_func, "sum"), expected
+    )
+    pd.testing.assert_frame_equal(simple_graph.min_weights_df, expected_min_weights_df)
+
+
+def test_network_construction(simple_graph):
+    edges = simple_graph.edges.set_index(["from", "to"])
+    network = pandana2.PandanaNetwork(
+        edges=edges,
+        nodes=simple_graph.nodes.iloc[::-1],
+        from_nodes_col="from",
+        to_nodes_col="to",
+        edge_costs_col="edge_cost",
+    )
+    assert list(network.node_ids) == list("abcdef")
+    network.preprocess(weight_cutoff=1.2)
+    pd.testing.assert_frame_equal(network.min_weights_df, simple_graph.min_weights_df)
+
+    with pytest.raises(
+        AssertionError, match="All 'from' node ids should be in the node"
+    ):
+        pandana2.PandanaNetwork(
+            edges=edges,
+            nodes=simple_graph.nodes.drop("f"),
+            from_nodes_col="from",
+            to_nodes_col="to",
+            edge_costs_col="edge_cost",
+        )
+
+
+def test_symmetric_preprocess(simple_graph, tmp_path):
+    values = pd.DataFrame(
+        {"x": [1, 2, 3, 4], "y": [4, np.nan, 6, 1]}, index=["b", "d", "c", "b"]
+    )
+    aggregations = {
+        name: name for name in ["sum", "mean", "min", "max", "std", "count", "median"]
+    }
+    decay_func = pandana2.LinearDecay(1.0)
+    expected_df = simple_graph.aggregate(values, decay_func, aggregations)
+    expected_min_weights_df = simple_graph.min_weights_df
+    expected_len = len(simple_graph.reachability)
+
+    assert simple_graph.is_symmetric()
+    simple_graph.preprocess(weight_cutoff=1.2, symmetric=True)
+    assert len(simple_graph.reachability) == (expected_len + 6) / 2
+    pd.testing.assert_frame_equal(simple_graph.min_weights_df, expected_min_weights_df)
+    pd.testing.assert_frame_equal(
+        simple_graph.aggregate(values, decay_func, aggregations), expected_df
+    )
+    pd.testing.assert_frame_equal(
+        simple_graph.aggregate(values, decay_func, aggregations, origins=["e", "b"]),
+        expected_df.loc[["b", "e"]],
+    )
+    pd.testing.assert_frame_equal(
+        simple_graph.accessibility_operator(decay_func).sum(values).dropna(),
+        expected_df.xs("sum", axis=1, level=1),
+    )
+
+    directory = str(tmp_path / "preprocessed")
+    simple_graph.save_preprocessed(directory)
+    simple_graph.load_preprocessed(directory, mmap=True)
+    assert simple_graph.reachability.symmetric
+    pd.testing.assert_frame_equal(simple_graph.min_weights_df, expected_min_weights_df)
+
+    edges = simple_graph.edges.copy()
+    edges.loc[edges["from"] == "a", "edge_cost"] += 0.1
+    with pytest.raises(Exception, match="The edges are no longer symmetric"):
+        simple_graph.update_edges(edges)
+    with pytest.raises(Exception, match="requires a reverse edge with the same cost"):
+        pandana2.PandanaNetwork(
+            edges, simple_graph.nodes, "from", "to", "edge_cost"
+        ).preprocess(weight_cutoff=1.2, symmetric=True)
+
+    edges.loc[edges["to"] == "a", "edge_cost"] += 0.1
+    simple_graph.update_edges(edges)
+    expected = pandana2.PandanaNetwork(
+        edges, simple_graph.nodes, "from", "to", "edge_cost"
+    )
+    expected.preprocess(weight_cutoff=1.2)
+    pd.testing.assert_frame_equal(simple_graph.min_weights_df, expected.min_weights_df)
+
+
+def test_stats(simple_graph, tmp_path):
+    stats = simple_graph.stats["preprocess"]
+    assert list(stats.seconds) == ["csr", "fingerprint", "dijkstra"]
+    assert stats.counts["origins"] == 6
+    assert stats.counts["pairs"] == len(simple_graph.min_weights_df)
+    assert stats.counts["bytes"] == simple_graph.reachability.nbytes
+    assert stats.pairs_per_origin == stats.counts["pairs"] / 6
+
+    progress = []
+    simple_graph.preprocess(
+        1.2,
+        cache_dir=tmp_path,
+        progress=lambda done, total: progress.append((done, total)),
+    )
+    assert progress[-1] == (6, 6)
+    assert progress == sorted(progress)
+    assert "save" in simple_graph.stats["preprocess"].seconds
+    simple_graph.preprocess(1.2, cache_dir=tmp_path)
+    assert "load" in simple_graph.stats["preprocess"].seconds
+    assert "dijkstra" not in simple_graph.stats["preprocess"].seconds
+
+    values = pd.Series([1, 2, 3], index=["b", "d", "c"])
+    stats = Stats("aggregate")
+    simple_graph.aggregate(values, pandana2.LinearDecay(0.3), "sum", stats=stats)
+    assert "aggregate" not in simple_graph.stats
+    assert {"values", "chunks", "decay", "aggregate", "output"} <= set(stats.seconds)
+    assert stats.counts["values"] == 3
+    assert stats.counts["origins"] == 6
+    # pairs under 0.3: every node to itself, and a-c and c-d in both directions
+    assert stats.counts["pairs"] == 10
+    metrics = stats.to_dict()
+    assert metrics["pairs"] == 10 and metrics["pairs_per_origin"] == 10 / 6
+    assert metrics["total_seconds"] == pytest.approx(sum(stats.seconds.values()))
+
+
+def test_estimate_preprocess(simple_graph, tmp_path):
+    # the sample is every origin, so the estimate is exact
+    estimate = simple_graph.estimate_preprocess(1.2)
+    assert estimate["origins"] == estimate["sampled_origins"] == 6
+    assert estimate["pairs"] == len(simple_graph.reachability) == 30
+    assert estimate["pairs_per_origin"] == 5
+    assert estimate["bytes"] == simple_graph.reachability.nbytes
+    assert estimate["peak_bytes"] > estimate["bytes"] and estimate["seconds"] > 0
+
+    estimate = simple_graph.estimate_preprocess(1.2, np.float32, sample_size=3)
+    assert estimate["sampled_origins"] == 3
+    assert simple_graph.estimate_preprocess(1.2, symmetric=True)["pairs"] == 18
+
+    with pytest.raises(Exception, match="more than max_bytes"):
+        simple_graph.preprocess(1.2, max_bytes=500)
+    simple_graph.preprocess(1.0, max_bytes=10_000)
+    assert simple_graph.weight_cutoff == 1.0
+
+    simple_graph.preprocess_to_disk(
+        1.2, directory=str(tmp_path / "preprocessed"), max_bytes=300
+    )
+    assert len(simple_graph.reachability.chunk_lengths) == 3
+
+
+def test_impedances(simple_graph, tmp_path):
+    edges = simple_graph.edges.assign(time=simple_graph.edges["edge_cost"] * 2)
+    network = pandana2.PandanaNetwork(
+        edges=edges,
+        nodes=simple_graph.nodes,
+        from_nodes_col="from",
+        to_nodes_col="to",
+        edge_costs_col="edge_cost",
+    )
+    estimate = network.estimate_preprocess(1.2, impedances=["time"])
+    assert estimate["peak_bytes"] - estimate["bytes"] == 30 * (12 + 8)
+    network.preprocess(1.2, impedances=["time"])
+    assert estimate["bytes"] == network.reachability.nbytes
+    min_weights_df = network.min_weights_df
+    pd.testing.assert_frame_equal(
+        min_weights_df[["from", "to", "weight"]], simple_graph.min_weights_df
+    )
+    np.testing.assert_allclose(min_weights_df["time"], min_weights_df["weight"] * 2)
+
+    values = pd.Series([1, 2, 3], index=["b", "d", "c"])
+    by_time = network.aggregate(values, pandana2.LinearDecay(1.0, "time"), "sum")
+    pd.testing.assert_series_equal(
+        by_time, network.aggregate(values, pandana2.LinearDecay(0.5), "sum")
+    )
+    pd.testing.assert_series_equal(
+        network.accessibility_operator(pandana2.LinearDecay(1.0, "time")).sum(values),
+        network.accessibility_operator(pandana2.LinearDecay(0.5)).sum(values),
+    )
+    with pytest.raises(Exception, match="wasn't passed to preprocess"):
+        simple_graph.aggregate(values, pandana2.LinearDecay(1.0, "time"), "sum")
+
+    network.save_preprocessed(str(tmp_path / "preprocessed"))
+    loaded = pandana2.PandanaNetwork(
+        edges=edges,
+        nodes=simple_graph.nodes,
+        from_nodes_col="from",
+        to_nodes_col="to",
+        edge_costs_col="edge_cost",
+    )
+    loaded.load_preprocessed(str(tmp_path / "preprocessed"))
+    pd.testing.assert_frame_equal(loaded.min_weights_df, min_weights_df)
+
+    # only the time of c-e changes, which updates the times but not the weights
+    edges = edges.copy()
+    edges.loc[(edges["from"] == "c") & (edges["to"] == "e"), "time"] = 0.2
+    assert network.update_edges(edges) > 0
+    expected = pandana2.PandanaNetwork(
+        edges=edges,
+        nodes=simple_graph.nodes,
+        from_nodes_col="from",
+        to_nodes_col="to",
+        edge_costs_col="edge_cost",
+    )
+    expected.preprocess(1.2, impedances=["time"])
+    pd.testing.assert_frame_equal(network.min_weights_df, expected.min_weights_df)
+    assert network.reachability.fingerprint == expected.reachability.fingerprint
+    to_e = network.min_weights_df.query("`to` == 'e'").set_index("from")["time"]
+    assert to_e.to_dict() == {"a": 0.6, "c": 0.2, "d": 0.4, "e": 0.0}
+
+    with pytest.raises(Exception, match="symmetric"):
+        network.preprocess(1.2, impedances=["time"], symmetric=True)
+    with pytest.raises(Exception, match="not found"):
+        network.preprocess(1.2, impedances=["distance"])
+
+
+def test_compiled_decay(simple_graph, monkeypatch):
+    class PythonLinearDecay(pandana2.decay_functions.PandanaDecayFunction):
+        def __init__(self, max_weight):
+            self.max_weight = max_weight
+            self.mask = lambda weights: weights < max_weight
+            self.weights = lambda weights: (max_weight - weights) / max_weight
+
+    class PythonGaussianDecay(pandana2.decay_functions.PandanaDecayFunction):
+        def __init__(self, max_weight):
+            self.max_weight = max_weight
+            self.mask = lambda weights: weights < max_weight
+            self.weights = lambda weights: np.exp(-0.5 * (weights / 0.5) ** 2)
+
+    @numba.njit
+    def gaussian(weight, max_weight, params):
+        return np.exp(-0.5 * (weight / params[0]) ** 2)
+
+    values = pd.DataFrame({"x": [1, 2, 3], "y": [4, 5, 6]}, index=["b", "d", "c"])
+    aggregations = {"sum": "sum", "mean": "mean", "median": "median", "std": "std"}
+    weights = np.linspace(0, 0.9, 10)
+    for decay_func, python_decay_func, expected in [
+        (
+            pandana2.LinearDecay(1.0),
+            PythonLinearDecay(1.0),
+            (1.0 - weights) / 1.0,
+        ),
+        (
+            pandana2.CompiledDecay(1.0, gaussian, [0.5]),
+            PythonGaussianDecay(1.0),
+            np.exp(-0.5 * (weights / 0.5) ** 2),
+        ),
+        (
+            pandana2.ExponentialDecay(1.0, 2),
+            None,
+            np.exp(-1 * weights * 2),
+        ),
+    ]:
+        np.testing.assert_allclose(decay_func.decay(weights), expected)
+        np.testing.assert_allclose(
+            decay_func.weights(pd.Series(weights)).to_numpy(), expected
+        )
+        if python_decay_func is not None:
+            pd.testing.assert_frame_equal(
+                simple_graph.aggregate(values, decay_func, aggregations),
+                simple_graph.aggregate(values, python_decay_func, aggregations),
+            )
+            pd.testing.assert_frame_equal(
+                simple_graph.accessibility_operator(decay_func).sum(values),
+                simple_graph.accessibility_operator(python_decay_func).sum(values),
+            )
+
+    # the pairs within max_weight are found by binary search, also when pairs are stored
+    #   once each
+    decay_func = pandana2.CompiledDecay(0.6, gaussian, [0.5])
+    assert decay_func.masks_prefix()
+    expected = simple_graph.aggregate(values, PythonGaussianDecay(0.6), aggregations)
+    pd.testing.assert_frame_equal(
+        simple_graph.aggregate(values, decay_func, aggregations), expected
+    )
+    # and decayed a few pairs at a time
+    monkeypatch.setattr(pandana2.aggregation, "DECAY_BATCH_PAIRS", 4)
+    pd.testing.assert_frame_equal(
+        simple_graph.aggregate(values, decay_func, aggregations), expected
+    )
+    sums = {"sum": "sum", "mean": "mean"}
+    expected = simple_graph.aggregate(values, PythonGaussianDecay(0.6), sums)
+    simple_graph.preprocess(1.2, symmetric=True)
+    pd.testing.assert_frame_equal(
+        simple_graph.aggregate(values, decay_func, sums), expected
+    )
+
+    # a gaussian with a very wide curve is nearly no decay
+    pd.testing.assert_frame_equal(
+        simple_graph.aggregate(
+            values, pandana2.CompiledDecay(1.0, gaussian, [1e9]), aggregations
+        ),
+        simple_graph.aggregate(values, pandana2.NoDecay(1.0), aggregations),
+    )
+
+
+def test_concurrent_aggregate(simple_graph):
+    values = pd.Series([1, 2, 3], index=["b", "d", "c"])
+    decay_funcs = [
+        pandana2.LinearDecay(1.0),
+        pandana2.NoDecay(0.5),
+        pandana2.ExponentialDecay(1.2),
+    ]
+    queries = [
+        (decay_funcs[i % 3], ["sum", "mean", "median"][i % 2]) for i in range(30)
+    ]
+    expected = [simple_graph.aggregate(values, *query) for query in queries]
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(
+            executor.map(lambda query: simple_graph.aggregate(values, *query), queries)
+        )
+        for result, expected_result in zip(results, expected):
+            pd.testing.assert_series_equal(result, expected_result)
+
+        # with stats of their own, which concurrent calls don't mix up
+        stats = [Stats("aggregate") for _ in queries]
+
+        async def aggregate_all():
+            return await asyncio.gather(
+                *[
+                    simple_graph.aggregate_async(
+                        values, *query, executor=executor, stats=query_stats
+                    )
+                    for query, query_stats in zip(queries, stats)
+                ]
+            )
+
+        for result, expected_result in zip(asyncio.run(aggregate_all()), expected):
+            pd.testing.assert_series_equal(result, expected_result)
+        assert all(query_stats.counts["values"] == 3 for query_stats in stats)
+        assert all(query_stats.counts["origins"] == 6 for query_stats in stats)
+
+        operators = list(
+            executor.map(simple_graph.accessibility_operator, decay_funcs * 5)
+        )
+        assert all(operators[i] is operators[i % 3] for i in range(15))
+
+        # origins are computed, cached and evicted by many threads at once
+        simple_graph.preprocess_lazy(weight_cutoff=1.2, max_cached_origins=2)
+        origins = [["a", "e"], ["f"], ["b", "c", "d"], ["e", "a", "f"]] * 5
+        results = list(
+            executor.map(
+                lambda o: simple_graph.aggregate(values, decay_funcs[0], "sum", o),
+                origins,
+            )
+        )
+        for result, o in zip(results, origins):
+            pd.testing.assert_series_equal(result, expected[0].loc[sorted(o)])
+        assert len(simple_graph.reachability._cache) <= 2
+
+
+def test_preprocess_tiles(tmp_path):
+    nodes, edges = synthetic_grid(4000)
+    network = pandana2.PandanaNetwork(edges, nodes)
+    network.preprocess(300)
+    rng = np.random.default_rng(0)
+    values = pd.Series(rng.random(500), index=rng.choice(nodes.index, 500))
+    decay_func = pandana2.LinearDecay(250)
+    aggregations = {"sum": "sum", "median": "median", "std": "std"}
+
+    tiled = pandana2.PandanaNetwork(edges, nodes)
+    with ProcessPoolExecutor(2) as executor:
+        tiled.preprocess_tiles(
+            300,
+            str(tmp_path / "tiles"),
+            tile_size=1000,
+            executor=executor,
+            chunk_size=300,
+        )
+    assert len(tiled.reachability.chunk_lengths) == 4
+    assert not os.path.exists(str(tmp_path / "tiles" / "tiles"))
+
+    # the tiles are merged into chunks in order of origin, with the same pairs
+    pd.testing.assert_frame_equal(tiled.min_weights_df, network.min_weights_df)
+    pd.testing.assert_frame_equal(
+        tiled.aggregate(values, decay_func, aggregations),
+        network.aggregate(values, decay_func, aggregations),
+    )
+    pd.testing.assert_series_equal(
+        tiled.accessibility_operator(decay_func).mean(values),
+        network.accessibility_operator(decay_func).mean(values),
+    )
+
+    loaded = pandana2.PandanaNetwork(edges, nodes)
+    loaded.load_preprocessed(str(tmp_path / "tiles"))
+    pd.testing.assert_series_equal(
+        loaded.aggregate(values, decay_func, "sum"),
+        network.aggregate(values, decay_func, "sum"),
+    )
+
+    with pytest.raises(Exception, match="point geometries"):
+        pandana2.PandanaNetwork(
+            edges, pd.DataFrame(index=nodes.index)
+        ).preprocess_tiles(300, str(tmp_path / "no_geometry"), tile_size=1000)
+
+
+def test_custom_mask(simple_graph):
+    class BandDecay(pandana2.decay_functions.PandanaDecayFunction):
+        # only the pairs from 0.25 up to max_weight, which aren't a prefix of each origin
+        def __init__(self, max_weight):
+            self.max_weight = max_weight
+            self.mask = lambda weights: (weights >= 0.25) & (weights < max_weight)
+            self.weights = lambda weights: pd.Series(1.0, index=weights.index)
+
+    values = pd.Series([10, 20, 30, 40, 50, 60], index=["a", "b", "c", "d", "e", "f"])
+    min_weights_df = simple_graph.min_weights_df
+    in_band = min_weights_df[
+        (min_weights_df.weight >= 0.25) & (min_weights_df.weight < 1.0)
+    ]
+    expected = (
+        in_band.assign(value=values.reindex(in_band.to).to_numpy())
+        .groupby("from")
+        .value.sum()
+        .astype(float)
+        .rename(None)
+    )
+
+    decay_func = BandDecay(1.0)
+    pd.testing.assert_series_equal(
+        simple_graph.aggregate(values, decay_func, "sum"), expected
+    )
+    pd.testing.assert_series_equal(
+        simple_graph.accessibility_operator(decay_func).sum(values).dropna(),
+        expected,
+    )
+
+
+def test_replaced_mask_and_weights(simple_graph):
+    # decay functions whose mask or weights are replaced don't use the compiled kernels
+    class BandLinearDecay(pandana2.LinearDecay):
+        def __init__(self, max_weight):
+            super().__init__(max_weight)
+            self.mask = lambda weights: (weights >= 0.25) & (weights < max_weight)
+
+    class FlatLinearDecay(pandana2.LinearDecay):
+        def __init__(self, max_weight):
+            super().__init__(max_weight)
+            self.weights = lambda weights: pd.Series(1.0, index=weights.index)
+
+    values = pd.Series([10, 20, 30, 40, 50, 60], index=["a", "b", "c", "d", "e", "f"])
+    assert pandana2.LinearDecay(1.0).compiled_code() is not None
+    assert BandLinearDecay(1.0).compiled_code() is None
+    assert FlatLinearDecay(1.0).compiled_code() is None
+
+    min_weights_df = simple_graph.min_weights_df.assign(
+        value=lambda df: values.reindex(df.to).to_numpy()
+    )
+    in_band = min_weights_df.query("weight >= 0.25 and weight < 1.0")
+    expected = (
+        (in_band.value * (1.0 - in_band.weight))
+        .groupby(in_band["from"])
+        .sum()
+        .rename(None)
+        .rename_axis("from")
+    )
+    pd.testing.assert_series_equal(
+        simple_graph.aggregate(values, BandLinearDecay(1.0), "sum"), expected
+    )
+    pd.testing.assert_series_equal(
+        simple_graph.aggregate(values, FlatLinearDecay(1.0), "sum"),
+        simple_graph.aggregate(values, pandana2.NoDecay(1.0), "sum"),
+    )
+
+
+def test_aggregate_nothing_reached(simple_graph):
+    decay_func = pandana2.LinearDecay(1.0)
+    result = simple_graph.aggregate(pd.Series(dtype=float), decay_func, "sum")
+    assert isinstance(result, pd.Series) and len(result) == 0
+
+    # nothing within 0.5 of b
+    values = pd.DataFrame({"x": [1.0], "y": [2.0]}, index=["f"])
+    result = simple_graph.aggregate(
+        values, pandana2.LinearDecay(0.5), {"sum": "sum", "mean": "mean"}, origins=["b"]
+    )
+    assert len(result) == 0
+    assert list(result.columns) == [
+        ("x", "sum"),
+        ("x", "mean"),
+        ("y", "sum"),
+        ("y", "mean"),
+    ]
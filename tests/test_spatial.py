@@ -0,0 +1,86 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import pandana2
+from pandana2.spatial import NodeIndex
+
+
+@pytest.mark.parametrize("num_nodes", [1, 10, 2000])
+def test_node_index(num_nodes):
+    rng = np.random.default_rng(0)
+    x, y = rng.normal(0, 1000, num_nodes), rng.uniform(0, 3000, num_nodes)
+    # including points well outside the nodes
+    qx, qy = rng.uniform(-8000, 8000, 5000), rng.uniform(-8000, 8000, 5000)
+
+    nearest = NodeIndex(x, y).nearest(qx, qy)
+    distances = np.hypot(x[:, None] - qx, y[:, None] - qy)
+    np.testing.assert_allclose(
+        np.hypot(x[nearest] - qx, y[nearest] - qy), distances.min(axis=0)
+    )
+
+    nearest = NodeIndex(x, y).nearest(qx, qy, max_distance=300)
+    assert list(nearest >= 0) == list(distances.min(axis=0) <= 300)
+
+
+def test_node_index_clustered():
+    # a dense downtown in a sparse region, with repeated and collinear nodes
+    rng = np.random.default_rng(0)
+    x = np.concatenate(
+        [rng.normal(0, 20, 3000), rng.uniform(-50_000, 50_000, 300), np.zeros(50)]
+    )
+    y = np.concatenate(
+        [rng.normal(0, 20, 3000), rng.uniform(-50_000, 50_000, 300), np.arange(50.0)]
+    )
+    qx = np.concatenate([rng.normal(0, 50, 1000), rng.uniform(-60_000, 60_000, 1000)])
+    qy = np.concatenate([rng.normal(0, 50, 1000), rng.uniform(-60_000, 60_000, 1000)])
+
+    nearest = NodeIndex(x, y).nearest(qx, qy)
+    distances = np.hypot(x[:, None] - qx, y[:, None] - qy)
+    np.testing.assert_allclose(
+        np.hypot(x[nearest] - qx, y[nearest] - qy), distances.min(axis=0)
+    )
+
+
+def test_nearest_nodes():
+    nodes = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy([0, 100, 200], [0, 0, 100]),
+        index=pd.Index(["a", "b", "c"], name="osmid"),
+        crs="EPSG:3857",
+    )
+    edges = pd.DataFrame({"u": ["a", "b"], "v": ["b", "c"], "length": [100, 140]})
+    network = pandana2.PandanaNetwork(edges, nodes)
+
+    values_gdf = gpd.GeoDataFrame(
+        geometry=[
+            shapely.Point(10, 5),
+            shapely.Point(190, 90),
+            shapely.Point(500, 500),
+            shapely.box(90, -10, 110, 10),
+        ],
+        index=[10, 11, 12, 13],
+        crs="EPSG:3857",
+    )
+    assert network.nearest_nodes(values_gdf).to_dict() == {
+        10: "a",
+        11: "c",
+        12: "c",
+        13: "b",
+    }
+    assert network.nearest_nodes(values_gdf, max_distance=50).to_dict() == {
+        10: "a",
+        11: "c",
+        13: "b",
+    }
+
+    x, y = [10, 190, 500], [5, 90, 500]
+    assert network.nearest_nodes_xy(x, y, crs="EPSG:3857").to_dict() == {
+        0: "a",
+        1: "c",
+        2: "c",
+    }
+    assert network.nearest_nodes_xy(
+        x, y, crs="EPSG:3857", max_distance=50
+    ).to_dict() == {0: "a", 1: "c"}
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import pandana2
+from benchmarks.networks import synthetic_grid
+from pandana2.utils import Aggregation, weighted_median, weighted_std
+
+
+# pandas implementations of the aggregations, which are the reference for the compiled
+#   kernels in pandana2.aggregation
+def grouped_weighted_median(
+    groups: pd.Series, values: pd.Series, weights: pd.Series
+) -> pd.Series:
+    """
+    Same as weighted_median for every group at once, using one sort by (group, value) and a
+        cumulative sum within each group instead of a python call per group.
+
+    Parameters:
+    groups (pd.Series): The group of each value.
+    values (pd.Series): Values to take the median of.
+    weights (pd.Series): Weights corresponding to the values.
+
+    Returns:
+    pd.Series: The weighted median of each group, indexed by group.
+    """
+    order = np.lexsort((values.to_numpy(), groups.to_numpy()))
+    sorted_groups = pd.Series(groups.to_numpy()[order])
+    sorted_values = values.to_numpy()[order]
+    sorted_weights = pd.Series(weights.to_numpy()[order], dtype="float")
+
+    grouped_weights = sorted_weights.groupby(sorted_groups)
+    cumulative_weights = grouped_weights.cumsum().to_numpy()
+    half_weights = grouped_weights.transform("sum").to_numpy() / 2
+
+    # the median of each group is the first value where the cumulative weight passes half
+    #   the total weight of the group
+    passed = cumulative_weights >= half_weights
+    first_passed = pd.Series(sorted_values[passed]).groupby(
+        sorted_groups[passed].to_numpy()
+    )
+    return first_passed.first()
+
+
+def grouped_weighted_std(
+    groups: pd.Series, values: pd.Series, weights: pd.Series
+) -> pd.Series:
+    """
+    Same as weighted_std for every group at once, with grouped sums instead of a python call
+        per group.
+
+    Parameters:
+    groups (pd.Series): The group of each value.
+    values (pd.Series): Values to take the standard deviation of.
+    weights (pd.Series): Weights corresponding to the values.
+
+    Returns:
+    pd.Series: The weighted standard deviation of each group, indexed by group.
+    """
+    groups = groups.to_numpy()
+    values = pd.Series(values.to_numpy(), dtype="float")
+    weights = pd.Series(weights.to_numpy(), dtype="float")
+
+    sum_of_weights = weights.groupby(groups).sum()
+    average = (values * weights).groupby(groups).sum() / sum_of_weights
+    deviations = values - average.reindex(groups).to_numpy()
+    variance = (weights * deviations**2).groupby(groups).sum() / sum_of_weights
+    return np.sqrt(variance)
+
+
+def do_single_aggregation(
+    merged_df: pd.DataFrame,
+    values_col: str,
+    origin_node_id_col: str,
+    decayed_weights_col: str,
+    aggregation: Aggregation,
+):
+    if aggregation in ["median", "std"]:
+        grouped_func = {
+            "median": grouped_weighted_median,
+            "std": grouped_weighted_std,
+        }[aggregation]
+        return grouped_func(
+            merged_df[origin_node_id_col],
+            merged_df[values_col],
+            merged_df[decayed_weights_col],
+        )
+
+    if aggregation in ["min", "max"]:
+        # do not every apply weights for min / max
+        decayed_weights = 1
+    else:
+        decayed_weights = merged_df[decayed_weights_col]
+
+    def do_aggregation(values: pd.Series, _aggregation: Aggregation):
+        return values.groupby(merged_df[origin_node_id_col]).agg(_aggregation)
+
+    if aggregation == "mean":
+        # could do this with np.average, but it should be faster to do it with 2
+        # sums than a .apply like the median below
+        sum_of_values = do_aggregation(merged_df[values_col] * decayed_weights, "sum")
+        sum_of_weights = do_aggregation(decayed_weights, "sum")
+        return sum_of_values / sum_of_weights
+
+    return do_aggregation(merged_df[values_col] * decayed_weights, aggregation)
+
+
+@pytest.mark.parametrize(
+    "aggregation,func", [("median", weighted_median), ("std", weighted_std)]
+)
+def test_grouped_aggregations(aggregation, func):
+    rng = np.random.default_rng(0)
+    merged_df = pd.DataFrame(
+        {
+            "from": rng.integers(0, 50, 1000),
+            "values": rng.integers(0, 20, 1000).astype("float"),
+            "decayed_weights": rng.random(1000),
+        }
+    )
+    expected = merged_df.groupby("from").apply(
+        lambda group: func(
+            group["values"].values, weights=group["decayed_weights"].values
+        ),
+        include_groups=False,
+    )
+    result = do_single_aggregation(
+        merged_df=merged_df,
+        values_col="values",
+        origin_node_id_col="from",
+        decayed_weights_col="decayed_weights",
+        aggregation=aggregation,
+    )
+    assert result.index.equals(expected.index)
+    np.testing.assert_allclose(result.values, expected.values)
+
+
+@pytest.mark.parametrize(
+    "aggregation", ["count", "max", "mean", "median", "min", "std", "sum"]
+)
+def test_kernels_match_reference(aggregation):
+    # do_single_aggregation on the long DataFrame of pairs is the reference for the
+    #   compiled aggregation kernels
+    nodes, edges = synthetic_grid(2000)
+    network = pandana2.PandanaNetwork(edges, nodes)
+    network.preprocess(400)
+    rng = np.random.default_rng(0)
+    values = pd.Series(rng.random(300), index=rng.choice(nodes.index, 300))
+    decay_func = pandana2.LinearDecay(300)
+
+    pairs = network.min_weights_df
+    pairs = pairs[decay_func.mask(pairs["weight"])]
+    merged_df = pairs.merge(
+        values.rename("values"), left_on="to", right_index=True
+    ).assign(decayed_weights=lambda df: decay_func.weights(df["weight"]))
+    expected = do_single_aggregation(
+        merged_df=merged_df,
+        values_col="values",
+        origin_node_id_col="from",
+        decayed_weights_col="decayed_weights",
+        aggregation=aggregation,
+    )
+
+    result = network.aggregate(values, decay_func, aggregation)
+    assert result.index.equals(expected.index)
+    np.testing.assert_allclose(result.values, expected.values)